@@ -0,0 +1,265 @@
+"""
+On-disk index of the files under a few root directories, for the find_files
+tool in server.py.
+
+Paths, sizes and mtimes live in SQLite rather than in memory, so the server's
+footprint stays the same whether the roots hold a thousand files or ten
+million. Name lookups use an index, substring lookups an FTS5 trigram index.
+
+Refreshing is incremental by directory mtime: a directory whose mtime is
+unchanged since the last pass has the same entries, so only its
+subdirectories (already known from the index) are visited, one stat each.
+Files edited in place don't touch their directory's mtime; a full refresh
+(or rebuild) re-reads everything.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    id INTEGER PRIMARY KEY, path TEXT NOT NULL UNIQUE, root TEXT NOT NULL, parent_id INTEGER,
+    mtime_ns INTEGER);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent_id);
+CREATE TABLE IF NOT EXISTS entries (
+    id INTEGER PRIMARY KEY, dir_id INTEGER NOT NULL, name TEXT NOT NULL, ext TEXT NOT NULL,
+    is_dir INTEGER NOT NULL, size INTEGER, mtime_ns INTEGER, UNIQUE (dir_id, name));
+CREATE INDEX IF NOT EXISTS entries_name ON entries (name);
+CREATE INDEX IF NOT EXISTS entries_ext ON entries (ext);
+CREATE VIRTUAL TABLE IF NOT EXISTS entry_names USING fts5 (
+    name, content='entries', content_rowid='id', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS entries_ai AFTER INSERT ON entries BEGIN
+    INSERT INTO entry_names (rowid, name) VALUES (new.id, new.name);
+END;
+CREATE TRIGGER IF NOT EXISTS entries_ad AFTER DELETE ON entries BEGIN
+    INSERT INTO entry_names (entry_names, rowid, name) VALUES ('delete', old.id, old.name);
+END;
+"""
+
+MATCH_KINDS = ("substring", "name", "ext")
+
+
+def _ext(name):
+    return os.path.splitext(name)[1][1:].lower()
+
+
+class FileIndex:
+    """
+    Index of `roots` in the SQLite file `path`. search() may be called from
+    any thread while refresh() runs; refreshes themselves are serialized.
+    """
+
+    def __init__(self, path, roots, cache_kib=8192, batch_dirs=200):
+        self.path = path
+        self.roots = [os.path.realpath(r) for r in roots]
+        self.cache_kib = cache_kib    # SQLite page cache per connection
+        self.batch_dirs = batch_dirs  # directories per write transaction
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self.last_refresh = None  # dict from the last finished refresh()
+        self.refreshing = False
+
+    def _conn(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(f"PRAGMA cache_size=-{self.cache_kib}")
+            db.executescript(SCHEMA)
+            self._local.db = db
+        return db
+
+    # ---------------- refresh ----------------
+    def refresh(self, full=False):
+        """
+        Bring the index up to date with the roots and return what changed.
+        full=True re-reads every directory instead of trusting mtimes.
+        """
+        with self._refresh_lock:
+            self.refreshing = True
+            try:
+                t0 = time.perf_counter()
+                counts = {"dirs_visited": 0, "dirs_read": 0, "added": 0, "updated": 0, "removed": 0}
+                db = self._conn()
+                # roots dropped from the configuration go first, in case one of
+                # the remaining roots lies inside them
+                for (root,) in db.execute("SELECT DISTINCT root FROM dirs").fetchall():
+                    if root not in self.roots:
+                        counts["removed"] += self._remove_tree(db, root)
+                for root in self.roots:
+                    self._refresh_root(db, root, full, counts)
+                db.commit()
+                counts["seconds"] = round(time.perf_counter() - t0, 3)
+                counts["finished_at"] = time.time()
+                self.last_refresh = counts
+                return counts
+            finally:
+                self.refreshing = False
+
+    def rebuild(self):
+        """Drop everything and index the roots from scratch."""
+        with self._refresh_lock:
+            db = self._conn()
+            # without the delete trigger: emptying the name index row by row is slow
+            db.execute("DROP TRIGGER entries_ad")
+            db.execute("DELETE FROM entries")
+            db.execute("DELETE FROM dirs")
+            db.execute("INSERT INTO entry_names (entry_names) VALUES ('delete-all')")
+            db.executescript(SCHEMA)
+        return self.refresh(full=True)
+
+    def _refresh_root(self, db, root, full, counts):
+        if not os.path.isdir(root):
+            counts["removed"] += self._remove_tree(db, root)
+            return
+        # (path, parent dir id, the dir's (id, mtime_ns) row if already looked up)
+        stack = [(root, None, db.execute("SELECT id, mtime_ns FROM dirs WHERE path = ?", (root,)).fetchone())]
+        pending = 0
+        while stack:
+            path, parent_id, row = stack.pop()
+            try:
+                mtime_ns = os.stat(path).st_mtime_ns
+            except OSError:
+                counts["removed"] += self._remove_tree(db, path)
+                continue
+            counts["dirs_visited"] += 1
+            if row and row[1] == mtime_ns and not full:
+                stack.extend((sub, row[0], (sub_id, sub_mtime)) for sub_id, sub, sub_mtime in db.execute(
+                    "SELECT id, path, mtime_ns FROM dirs WHERE parent_id = ?", (row[0],)))
+                continue
+            try:
+                dir_id, subdirs = self._read_dir(db, path, root, parent_id, row, mtime_ns, counts)
+            except OSError:
+                continue  # unreadable: keep what the index had
+            counts["dirs_read"] += 1
+            for sub in subdirs:
+                stack.append((sub, dir_id, db.execute(
+                    "SELECT id, mtime_ns FROM dirs WHERE path = ?", (sub,)).fetchone()))
+            pending += 1
+            if pending >= self.batch_dirs:
+                db.commit()  # bounded transactions; searches see progress
+                pending = 0
+
+    def _read_dir(self, db, path, root, parent_id, row, mtime_ns, counts):
+        # is_dir: 0 file, 1 directory we don't descend into (symlink), 2 directory
+        found = {}
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        found[entry.name] = (1 if entry.is_symlink() else 2, None, None)
+                    elif entry.is_file():
+                        st = entry.stat()
+                        found[entry.name] = (0, st.st_size, st.st_mtime_ns)
+                except OSError:
+                    continue  # vanished while we looked
+        if row is None:
+            dir_id = db.execute("INSERT INTO dirs (path, root, parent_id, mtime_ns) VALUES (?, ?, ?, ?)",
+                                (path, root, parent_id, mtime_ns)).lastrowid
+            known = {}
+        else:
+            dir_id = row[0]
+            db.execute("UPDATE dirs SET mtime_ns = ? WHERE id = ?", (mtime_ns, dir_id))
+            known = {name: (eid, (is_dir, size, mtime)) for eid, name, is_dir, size, mtime in db.execute(
+                "SELECT id, name, is_dir, size, mtime_ns FROM entries WHERE dir_id = ?", (dir_id,))}
+
+        gone = [(name, eid, meta[0]) for name, (eid, meta) in known.items() if name not in found]
+        db.executemany("DELETE FROM entries WHERE id = ?", [(eid,) for _, eid, _ in gone])
+        counts["removed"] += len(gone)
+
+        changed = [(meta[0], meta[1], meta[2], known[name][0]) for name, meta in found.items()
+                   if name in known and known[name][1] != meta]
+        db.executemany("UPDATE entries SET is_dir = ?, size = ?, mtime_ns = ? WHERE id = ?", changed)
+        counts["updated"] += len(changed)
+
+        # indexed subdirectories that are gone or no longer directories we descend into
+        for name, (_, meta) in known.items():
+            if meta[0] == 2 and found.get(name, (None,))[0] != 2:
+                counts["removed"] += self._remove_tree(db, os.path.join(path, name))
+
+        added = [(dir_id, name, _ext(name), meta[0], meta[1], meta[2])
+                 for name, meta in found.items() if name not in known]
+        db.executemany("INSERT INTO entries (dir_id, name, ext, is_dir, size, mtime_ns) "
+                       "VALUES (?, ?, ?, ?, ?, ?)", added)
+        counts["added"] += len(added)
+        return dir_id, [os.path.join(path, name) for name, meta in found.items() if meta[0] == 2]
+
+    def _remove_tree(self, db, path):
+        # `path` and every directory below it: paths between "path/" and "path0"
+        # ('0' sorts right after '/')
+        ids = [i for (i,) in db.execute(
+            "SELECT id FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+            (path, path + os.sep, path + chr(ord(os.sep) + 1)))]
+        removed = 0
+        for dir_id in ids:
+            removed += db.execute("DELETE FROM entries WHERE dir_id = ?", (dir_id,)).rowcount
+        db.executemany("DELETE FROM dirs WHERE id = ?", [(i,) for i in ids])
+        return removed
+
+    # ---------------- background ----------------
+    def start(self, interval):
+        """Refresh now and then every `interval` seconds on a daemon thread."""
+        if self._thread is not None:
+            return
+
+        def loop():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as e:  # keep serving the old index
+                    self.last_refresh = {"error": str(e), "finished_at": time.time()}
+                self._wake.wait(interval)
+                self._wake.clear()
+
+        self._thread = threading.Thread(target=loop, name="file-index", daemon=True)
+        self._thread.start()
+
+    def wake(self):
+        """Start the next background refresh now."""
+        self._wake.set()
+
+    # ---------------- queries ----------------
+    def search(self, query, match="substring", root=None, limit=100):
+        """
+        Entries whose name contains `query` (case-insensitive), equals it, or
+        whose extension is `query`; at most `limit` of them, as dicts.
+        """
+        if match not in MATCH_KINDS:
+            raise ValueError(f"match must be one of {', '.join(MATCH_KINDS)}")
+        if match == "name":
+            where, params = "e.name = ?", [query]
+        elif match == "ext":
+            where, params = "e.ext = ?", [query.lstrip(".").lower()]
+        elif len(query) >= 3:
+            # trigram index; the query is quoted so FTS5 treats it as one string
+            where = "e.id IN (SELECT rowid FROM entry_names WHERE entry_names MATCH ?)"
+            params = ['"' + query.replace('"', '""') + '"']
+        else:
+            # too short for trigrams: scan the names
+            escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            where, params = "e.name LIKE ? ESCAPE '\\'", [f"%{escaped}%"]
+        if root:
+            where += " AND d.root = ?"
+            params.append(os.path.realpath(root))
+        rows = self._conn().execute(
+            f"SELECT d.path, e.name, e.is_dir, e.size, e.mtime_ns FROM entries e "
+            f"JOIN dirs d ON d.id = e.dir_id WHERE {where} LIMIT ?", (*params, limit)).fetchall()
+        return [{"path": os.path.join(path, name), "is_dir": bool(is_dir), "size": size,
+                 "mtime": mtime_ns / 1e9 if mtime_ns is not None else None}
+                for path, name, is_dir, size, mtime_ns in rows]
+
+    def stats(self):
+        db = self._conn()
+        return {
+            "roots": self.roots,
+            "entries": db.execute("SELECT COUNT(*) FROM entries").fetchone()[0],
+            "directories": db.execute("SELECT COUNT(*) FROM dirs").fetchone()[0],
+            "db_bytes": sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p)),
+            "refreshing": self.refreshing,
+            "last_refresh": self.last_refresh,
+        }
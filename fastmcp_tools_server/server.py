@@ -1,15 +1,340 @@
+import asyncio
+import bisect
+import fnmatch
 import os
-import subprocess
-from fastmcp import FastMCP
+import re
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from fastmcp import Context, FastMCP
+
+from file_index import MATCH_KINDS, FileIndex
 
 # Create a new MCP server instance
 server = FastMCP()
 
+# nmap results are reused for this many seconds; identical concurrent scans share one process
+NMAP_CACHE_TTL = 60
+NMAP_CACHE_ENTRIES = 128
+# A scan is killed (with any child processes) after this long
+NMAP_TIMEOUT = 300  # seconds
+# stdout kept per scan; nmap is stopped once it has written more than this
+NMAP_OUTPUT_LIMIT = 1_000_000  # bytes
+NMAP_STDERR_LIMIT = 64 * 1024  # bytes
+# How often nmap prints its progress, which is forwarded to the client
+NMAP_STATS_EVERY = "2s"
+
+# list_files: entries per page, and how long a finished walk is kept for the next pages
+LIST_PAGE_SIZE = 1000
+LIST_CACHE_TTL = 30  # seconds
+LIST_CACHE_ENTRIES = 8
+# Threads scanning subdirectories of a recursive list_files in parallel
+LIST_WORKERS = 8
+
+# find_files: directories indexed in the background (os.pathsep-separated), the
+# SQLite file holding the index, and how often it is refreshed
+FILE_INDEX_ROOTS = os.environ.get("FILE_INDEX_ROOTS", os.getcwd()).split(os.pathsep)
+FILE_INDEX_DB = os.environ.get("FILE_INDEX_DB", "file_index.db")
+FILE_INDEX_INTERVAL = 300  # seconds
+FILE_INDEX_MAX_RESULTS = 1000
+
+# "SYN Stealth Scan Timing: About 12.34% done; ETC: 10:01 (0:00:14 remaining)"
+NMAP_PROGRESS = re.compile(rb"About (\d+(?:\.\d+)?)% done")
+
+
+class NmapFailed(Exception):
+    """nmap exited with an error or timed out; `result` is the error dict returned to the client."""
+
+    def __init__(self, result):
+        super().__init__(result["error"])
+        self.result = result
+
+
+class _Flight:
+    __slots__ = ("task", "waiters", "listeners")
+
+    def __init__(self):
+        self.task = None
+        self.waiters = 0
+        self.listeners = []
+
+    async def report(self, progress, message):
+        for listener in list(self.listeners):
+            try:
+                await listener(progress, message)
+            except Exception:
+                pass  # a client that went away must not break the scan for the others
+
+
+class ScanCache:
+    """
+    TTL cache for nmap results with single-flight coalescing: callers asking for
+    a key that is already being scanned attach to that scan instead of starting
+    their own, and get its progress updates too. The scan is cancelled only when
+    every caller waiting on it has gone away. Failed scans (exceptions) are not
+    cached. Used from the event loop only.
+    """
+
+    def __init__(self, ttl=NMAP_CACHE_TTL, max_entries=NMAP_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (expires, result)
+        self._inflight = {}            # key -> _Flight
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_compute(self, key, compute, progress=None):
+        """compute(report) is a coroutine function; report(progress, message) fans out to callers."""
+        entry = self._entries.get(key)
+        if entry and entry[0] >= time.monotonic():
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry[1]
+        flight = self._inflight.get(key)
+        if flight is None:
+            self.misses += 1
+            flight = self._inflight[key] = _Flight()
+            flight.task = asyncio.create_task(compute(flight.report))
+            flight.task.add_done_callback(lambda task: self._finish(key, task))
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        if progress is not None:
+            flight.listeners.append(progress)
+        try:
+            # shielded: one caller being cancelled must not cancel the others' scan
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            if progress is not None:
+                flight.listeners.remove(progress)
+            if flight.waiters == 0 and not flight.task.done():
+                # nobody is waiting any more: kill the scan, and let the next
+                # caller start a new one rather than join the dying task
+                del self._inflight[key]
+                flight.task.cancel()
+
+    def _finish(self, key, task):
+        if self._inflight.get(key) is not None and self._inflight[key].task is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, task.result())
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, target=None):
+        keys = [k for k in self._entries if target is None or k[0] == target]
+        for k in keys:
+            del self._entries[k]
+        return len(keys)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "ttl": self.ttl,
+        }
+
+
+def _kill_process_tree(proc):
+    # nmap runs in its own session, so its pid is also its process group id;
+    # the group lives on while anything nmap started is still running
+    try:
+        if hasattr(os, "killpg"):
+            os.killpg(proc.pid, signal.SIGKILL)
+        elif proc.returncode is None:
+            proc.kill()
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def run_nmap(command, report):
+    """
+    Run nmap without blocking the event loop. Progress lines become report()
+    calls, stdout is capped at NMAP_OUTPUT_LIMIT and the whole process group is
+    killed on timeout, on cancellation, or when the cap is hit.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *command, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE, start_new_session=True)
+    stdout = bytearray()
+    stderr = bytearray()
+    truncated = False
+
+    async def read_stdout():
+        # reads to EOF even past the cap: a paused pipe would keep proc.wait() from returning
+        nonlocal truncated
+        while True:
+            try:
+                line = await proc.stdout.readline()
+            except ValueError:  # a line longer than the stream limit, already discarded
+                continue
+            if not line:
+                return
+            if truncated:
+                continue
+            match = NMAP_PROGRESS.search(line)
+            if match:
+                await report(float(match.group(1)), line.decode(errors="replace").strip())
+                continue
+            if line.startswith(b"Stats: "):
+                continue
+            if len(stdout) + len(line) > NMAP_OUTPUT_LIMIT:
+                truncated = True
+                _kill_process_tree(proc)
+                continue
+            stdout.extend(line)
+
+    async def read_stderr():
+        while True:
+            chunk = await proc.stderr.read(65536)
+            if not chunk:
+                return
+            stderr.extend(chunk[:NMAP_STDERR_LIMIT - len(stderr)])
+
+    def result(**extra):
+        return {
+            "command": " ".join(command),
+            "stdout": stdout.decode(errors="replace"),
+            "stderr": stderr.decode(errors="replace"),
+            "returncode": proc.returncode,
+            "truncated": truncated,
+            **extra,
+        }
+
+    readers = asyncio.gather(read_stdout(), read_stderr())
+    timed_out = False
+    try:
+        await asyncio.wait_for(proc.wait(), NMAP_TIMEOUT)
+    except asyncio.TimeoutError:
+        timed_out = True
+    finally:
+        # on timeout and client cancellation, and for children of nmap that
+        # still hold the pipes open after it exited
+        _kill_process_tree(proc)
+        await readers
+        await proc.wait()
+
+    if timed_out:
+        raise NmapFailed(result(error=f"Nmap timed out after {NMAP_TIMEOUT} seconds"))
+    if proc.returncode != 0 and not truncated:
+        raise NmapFailed(result(error="Nmap command failed"))
+    await report(100.0, "done")
+    return result()
+
+
+NMAP_CACHE = ScanCache()
+
+def _scan_dir(path, rel, match=None):
+    """
+    One directory in one pass: is_file()/is_dir() use the d_type that readdir
+    already returned, so only symlinks (and filesystems without d_type) cost
+    a stat. Returns (entries whose name passes `match`, subdirectories to
+    descend into).
+    """
+    entries = []
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            name = os.path.join(rel, entry.name) if rel else entry.name
+            if entry.is_dir():
+                if match is None or match(entry.name):
+                    entries.append((name, True))
+                if not entry.is_symlink():  # don't follow links into loops
+                    subdirs.append((entry.path, name))
+            elif entry.is_file() and (match is None or match(entry.name)):
+                entries.append((name, False))
+    return entries, subdirs
+
+
+def walk_directory(root, depth=0, pattern=""):
+    """
+    Entries under `root` down to `depth` levels of subdirectories, as sorted
+    (relative path, is_dir) pairs, plus the number of subdirectories that
+    could not be read. Subdirectories are scanned in parallel on LIST_POOL.
+    `pattern` is a glob matched against entry names; every directory is still
+    descended into.
+    """
+    match = re.compile(fnmatch.translate(pattern)).match if pattern else None
+    entries, subdirs = _scan_dir(root, "", match)  # errors on the root go to the caller
+    unreadable = 0
+    pending = {}
+
+    def descend(dirs, level):
+        if level <= depth:
+            for path, rel in dirs:
+                pending[LIST_POOL.submit(_scan_dir, path, rel, match)] = level
+
+    descend(subdirs, 1)
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            level = pending.pop(future)
+            try:
+                found, subdirs = future.result()
+            except OSError:
+                unreadable += 1
+                continue
+            entries.extend(found)
+            descend(subdirs, level + 1)
+
+    entries.sort()
+    return entries, unreadable
+
+
+class ListingCache:
+    """
+    Finished walks, kept LIST_CACHE_TTL seconds so the following pages are a
+    bisect instead of another walk. Keys include the root's inode and mtime,
+    so a changed top-level directory is walked again right away.
+    """
+
+    def __init__(self, ttl=LIST_CACHE_TTL, max_entries=LIST_CACHE_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires, names, entries, unreadable)
+
+    def get_or_walk(self, root, depth, pattern):
+        st = os.stat(root)
+        key = (root, st.st_ino, st.st_mtime_ns, depth, pattern)
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached and cached[0] >= time.monotonic():
+                self._entries.move_to_end(key)
+                return cached[1:]
+        entries, unreadable = walk_directory(root, depth, pattern)
+        names = [name for name, _ in entries]
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, names, entries, unreadable)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return names, entries, unreadable
+
+
+LIST_POOL = ThreadPoolExecutor(max_workers=LIST_WORKERS, thread_name_prefix="list_files")
+LIST_CACHE = ListingCache()
+
 @server.tool()
-def list_files(path: str = ".") -> dict:
+def list_files(path: str = ".", pattern: str = "", depth: int = 0, cursor: str = "",
+               limit: int = LIST_PAGE_SIZE) -> dict:
     """
     Lists files and directories in the specified path.
     By default, lists contents of the current directory.
+    pattern: glob matched against names, e.g. "*.md".
+    depth: levels of subdirectories to include (0 = this directory only);
+    nested entries are given relative to path.
+    Results are sorted and paged: pass the returned next_cursor as cursor to
+    get the next `limit` entries.
     """
     try:
         # Ensure the path is within a reasonable boundary or project directory
@@ -23,20 +348,82 @@ def list_files(path: str = ".") -> dict:
         if not os.path.isdir(path):
             return {"error": f"Path is not a directory: {path}"}
 
-        contents = os.listdir(path)
-        files = [item for item in contents if os.path.isfile(os.path.join(path, item))]
-        directories = [item for item in contents if os.path.isdir(os.path.join(path, item))]
-        return {"path": path, "files": files, "directories": directories}
+        limit = max(1, min(limit, LIST_PAGE_SIZE * 10))
+        names, entries, unreadable = LIST_CACHE.get_or_walk(path, max(depth, 0), pattern)
+        start = bisect.bisect_right(names, cursor) if cursor else 0
+        page = entries[start:start + limit]
+        files = [name for name, is_dir in page if not is_dir]
+        directories = [name for name, is_dir in page if is_dir]
+        more = start + limit < len(entries)
+        result = {"path": path, "files": files, "directories": directories, "total": len(entries),
+                  "next_cursor": page[-1][0] if more else None}
+        if unreadable:
+            result["unreadable_directories"] = unreadable
+        return result
+    except Exception as e:
+        return {"error": str(e)}
+
+FILE_INDEX = FileIndex(FILE_INDEX_DB, FILE_INDEX_ROOTS)
+
+@server.tool()
+def find_files(query: str, match: str = "substring", root: str = "", limit: int = 100) -> dict:
+    """
+    Searches the file index instead of walking directories.
+    match: "substring" (case-insensitive, anywhere in the name), "name"
+    (exact file name) or "ext" (extension, e.g. "py").
+    root: only search under this indexed root (see file_index_stats).
+    The index is refreshed in the background every few minutes; call
+    file_index_refresh first if files were just created.
+    """
+    if not query:
+        return {"error": "query cannot be empty."}
+    if match not in MATCH_KINDS:
+        return {"error": f"match must be one of: {', '.join(MATCH_KINDS)}"}
+    try:
+        t0 = time.perf_counter()
+        results = FILE_INDEX.search(query, match, root or None, max(1, min(limit, FILE_INDEX_MAX_RESULTS)))
+        last = FILE_INDEX.last_refresh or {}
+        return {"results": results, "count": len(results), "ms": round((time.perf_counter() - t0) * 1000, 2),
+                "indexed_at": last.get("finished_at")}
+    except Exception as e:
+        return {"error": str(e)}
+
+@server.tool()
+def file_index_refresh(full: bool = False) -> dict:
+    """
+    Brings the file index up to date now and returns what changed. Only
+    directories whose mtime changed are re-read unless full is true.
+    """
+    try:
+        return FILE_INDEX.refresh(full=full)
+    except Exception as e:
+        return {"error": str(e)}
+
+@server.tool()
+def file_index_rebuild() -> dict:
+    """
+    Drops the file index and builds it again from scratch.
+    """
+    try:
+        return FILE_INDEX.rebuild()
     except Exception as e:
         return {"error": str(e)}
 
 @server.tool()
-def nmap_scan(target: str, options: str = "-F") -> dict:
+def file_index_stats() -> dict:
+    """
+    Returns the indexed roots, entry counts, index size on disk and the last refresh.
+    """
+    return FILE_INDEX.stats()
+
+@server.tool()
+async def nmap_scan(target: str, options: str = "-F", ctx: Context = None) -> dict:
     """
     Performs an Nmap scan on the specified target with given options.
     WARNING: Running Nmap can have security implications. Use responsibly.
     Requires Nmap to be installed on the system.
     Default options: -F (fast scan)
+    Progress is reported while the scan runs; cancelling the call stops nmap.
     """
     try:
         # Basic validation to prevent command injection, but not exhaustive.
@@ -45,32 +432,46 @@ def nmap_scan(target: str, options: str = "-F") -> dict:
             return {"error": "Nmap target cannot be empty."}
 
         # Construct the Nmap command
-        command = ["nmap"] + options.split() + [target]
+        args = options.split()
+        command = ["nmap"] + args + [target]
+        if "--stats-every" not in args:
+            command[1:1] = ["--stats-every", NMAP_STATS_EVERY]
 
-        # Execute the command
-        process = subprocess.run(command, capture_output=True, text=True, check=True)
+        async def progress(done, message):
+            await ctx.report_progress(done, 100, message)
 
-        return {
-            "command": " ".join(command),
-            "stdout": process.stdout,
-            "stderr": process.stderr,
-            "returncode": process.returncode
-        }
-    except subprocess.CalledProcessError as e:
-        return {
-            "error": "Nmap command failed",
-            "command": " ".join(e.cmd),
-            "stdout": e.stdout,
-            "stderr": e.stderr,
-            "returncode": e.returncode
-        }
+        # Execute the command (or reuse a recent / in-flight identical scan)
+        return await NMAP_CACHE.get_or_compute((target, tuple(args)), lambda report: run_nmap(command, report),
+                                               progress if ctx is not None else None)
+    except NmapFailed as e:
+        return e.result
     except FileNotFoundError:
         return {"error": "Nmap command not found. Please ensure Nmap is installed and in your PATH."}
     except Exception as e:
         return {"error": str(e)}
 
+@server.tool()
+async def nmap_cache_stats() -> dict:
+    """
+    Returns hit/miss statistics for the nmap result cache.
+    """
+    return NMAP_CACHE.stats()
+
+@server.tool()
+async def nmap_cache_clear(target: str = "") -> dict:
+    """
+    Drops cached nmap results, for one target or (by default) all of them.
+    """
+    return {"removed": NMAP_CACHE.invalidate(target or None)}
+
+def start_background():
+    """Background work of a running server; also called by mcp_host.py after importing this module."""
+    FILE_INDEX.start(FILE_INDEX_INTERVAL)
+
 if __name__ == "__main__":
-    print("Starting FastMCP server with 'list_files' and 'nmap_scan' tools...")
+    print("Starting FastMCP server with 'list_files', 'find_files' and 'nmap_scan' tools...")
+    print(f"Indexing {', '.join(FILE_INDEX.roots)} into {FILE_INDEX_DB} every {FILE_INDEX_INTERVAL} s")
+    start_background()
     print("Access the server at http://127.0.0.1:8000 (default FastMCP port)")
     print("WARNING: The 'nmap_scan' tool can have significant security implications. Use with caution.")
     server.run()
@@ -0,0 +1,1291 @@
+"""
+Benchmarks for nmapmcpserver.py, sc.py, fastmcp_tools_server/server.py, mcp_client.py
+and mcp_host.py.
+
+Each benchmark is a subcommand; all of them run offline and print a short
+table of results.
+
+USAGE
+   python mcp_bench.py session [--messages 100000] [--max-tokens 16384] [--sessions 1000,20000]
+   python mcp_bench.py workers [--workers 4] [--requests 400]
+   python mcp_bench.py llm [--tokens 200] [--token-latency 0.005]
+   python mcp_bench.py prompt [--turns 20000] [--max-tokens 16384]
+   python mcp_bench.py allowlist [--ranges 10000] [--lookups 200000]
+   python mcp_bench.py metrics [--requests 200000]
+   python mcp_bench.py ls [--entries 200000]
+   python mcp_bench.py files [--files 1000000] [--tree /tmp/files-tree]
+   python mcp_bench.py index [--files 1000000] [--tree /tmp/files-tree]
+   python mcp_bench.py client [--pool 4] [--calls 2000]
+   python mcp_bench.py host [--runs 3]
+   python mcp_bench.py tls [--workers 4] [--connections 2000]
+   python mcp_bench.py slowloris [--slow 600]
+   python mcp_bench.py load [--target http,ws,gemini] [--concurrency 32] [--requests 2000]
+                            [--save baseline.json] [--compare baseline.json]
+
+The load test starts each server in a scratch directory with nmap replayed
+from fixtures/nmap (NMAP_REPLAY_DIR) and the placeholder model, so results
+measure the servers themselves. It needs the websockets package and openssl.
+"""
+
+import argparse
+import asyncio
+import gc
+import itertools
+import http.client
+import ipaddress
+import json
+import os
+import platform
+import random
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List
+
+
+def _timeit(fn, *args) -> float:
+    t0 = time.perf_counter()
+    fn(*args)
+    return time.perf_counter() - t0
+
+
+def _report(rows: List[Dict[str, Any]]):
+    keys = list(rows[0].keys())
+    widths = [max(len(k), *(len(str(r[k])) for r in rows)) for k in keys]
+    print("  ".join(k.ljust(w) for k, w in zip(keys, widths)))
+    for r in rows:
+        print("  ".join(str(r[k]).ljust(w) for k, w in zip(keys, widths)))
+
+
+# ---------------- session ----------------
+class LegacySession:
+    """The list-based Session.append used before the deque rewrite."""
+
+    def __init__(self, session_id: str, max_tokens: int):
+        from nmapmcpserver import count_tokens
+        self.count_tokens = count_tokens
+        self.session_id = session_id
+        self.history: List[Dict[str, Any]] = []
+        self.max_tokens = max_tokens
+        self.token_count = 0
+
+    def append(self, role: str, content: str):
+        self.history.append({"role": role, "content": content})
+        self.token_count += self.count_tokens(content)
+        while self.token_count > self.max_tokens and self.history:
+            removed = self.history.pop(0)
+            self.token_count -= self.count_tokens(removed.get("content", ""))
+
+
+def _mixed_messages(n: int, seed: int = 1) -> List[str]:
+    # A small pool of messages of very different sizes (short chat turns up to
+    # large tool outputs), cycled to build the workload without huge memory.
+    rnd = random.Random(seed)
+    pool = []
+    for _ in range(256):
+        words = rnd.choice([3, 12, 40, 150, 600, 2500])
+        pool.append(" ".join("w%d" % rnd.randrange(1000) for _ in range(words)))
+    return [pool[rnd.randrange(len(pool))] for _ in range(n)]
+
+
+def bench_session(args):
+    from nmapmcpserver import Session
+
+    messages = _mixed_messages(args.messages)
+    roles = ("user", "tool", "assistant")
+
+    def drive(session):
+        for i, m in enumerate(messages):
+            session.append(roles[i % 3], m)
+
+    rows = []
+    for name, cls in (("list (legacy)", LegacySession), ("deque", Session)):
+        s = cls("bench", max_tokens=args.max_tokens)
+        elapsed = _timeit(drive, s)
+        rows.append({
+            "impl": name,
+            "messages": args.messages,
+            "seconds": f"{elapsed:.3f}",
+            "us/append": f"{elapsed / args.messages * 1e6:.2f}",
+            "kept": len(s.history),
+        })
+    _report(rows)
+
+    # SessionStore: creating n sessions, then looking them up (all resident)
+    from nmapmcpserver import SessionStore
+
+    rows = []
+    for n in (int(x) for x in args.sessions.split(",")):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SessionStore(memory_budget=1 << 40, spill_path=os.path.join(tmp, "spill.db"))
+            ids = [f"s{i}" for i in range(n)]
+            create = _timeit(lambda: [store.get_or_create(sid) for sid in ids])
+            lookup = _timeit(lambda: [store.get(sid) for sid in ids])
+        rows.append({"sessions": n, "create_s": f"{create:.3f}", "us/get": f"{lookup / n * 1e6:.2f}"})
+    _report(rows)
+
+    # a session larger than the whole budget keeps every turn appended while in use()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SessionStore(memory_budget=1000, spill_path=os.path.join(tmp, "spill.db"))
+        with store.use("big") as s:
+            s.append("tool", "x" * 2000)
+        with store.use("big") as s:
+            s.append("user", "after")
+        with store.use("other") as pinned, store.use("new") as s:
+            pinned.append("tool", "y" * 2000)
+            s.append("user", "while full")
+        kept = [store.get(sid).history[-1].content for sid in ("big", "new")]
+    print(f"oversized sessions keep their turns: {'yes' if kept == ['after', 'while full'] else 'NO ' + repr([k[:20] for k in kept])}")
+
+
+# ---------------- prompt ----------------
+def _legacy_prompt(session, instruction: str) -> str:
+    # prompt assembly as llm_generate did it before PromptBuffer
+    parts = ["You are MCP assistant. Keep replies short."]
+    for h in session.history:
+        parts.append(f"{h.role}: {h.content}")
+    parts.append(f"user: {instruction}")
+    return "\n".join(parts)
+
+
+def bench_prompt(args):
+    """
+    Per-turn prompt cost as one session's history grows (no trimming), then
+    in the steady state at the default token budget, where nearly every turn
+    trims the oldest messages.
+    """
+    import nmapmcpserver
+    from nmapmcpserver import FakeModel, Session, llm_generate
+
+    nmapmcpserver.MODEL = FakeModel(first_token_latency=0)
+    messages = _mixed_messages(args.turns)
+    checkpoints = {int(args.turns * f) for f in (0.05, 0.1, 0.25, 0.5, 1.0)}
+
+    window = 50  # turns averaged before each checkpoint
+
+    async def run():
+        legacy = Session("legacy", max_tokens=10**12)
+        incremental = Session("incremental", max_tokens=10**12)
+        rows = []
+        t_legacy = deque(maxlen=window)
+        t_incr = deque(maxlen=window)
+        for turn, m in enumerate(messages, 1):
+            legacy.append("user", m)
+            t0 = time.perf_counter()
+            _legacy_prompt(legacy, m)
+            t_legacy.append(time.perf_counter() - t0)
+
+            incremental.append("user", m)
+            t0 = time.perf_counter()
+            await llm_generate(incremental, "ok", 16)
+            t_incr.append(time.perf_counter() - t0)
+            if turn in checkpoints:
+                rows.append({
+                    "history": len(incremental.history),
+                    "legacy_us/turn": f"{sum(t_legacy) / len(t_legacy) * 1e6:.1f}",
+                    "incremental_us/turn": f"{sum(t_incr) / len(t_incr) * 1e6:.1f}",
+                })
+            legacy.append("assistant", "ok")
+            incremental.append("assistant", "ok")
+        return rows
+
+    async def steady():
+        # prompt work alone (legacy join vs the model's prefix lookup through
+        # PromptBuffer), and the whole llm_generate call for reference
+        model = FakeModel(first_token_latency=0)
+        session = Session("steady", max_tokens=args.max_tokens)
+        t_legacy = t_buffer = t_generate = 0.0
+        trims = 0
+        for m in messages:
+            first = session.first_seq()
+            session.append("user", m)
+            trims += session.first_seq() != first
+            t0 = time.perf_counter()
+            _legacy_prompt(session, m)
+            t_legacy += time.perf_counter() - t0
+            t0 = time.perf_counter()
+            model._prefill(session.session_id, session.prompt)
+            t_buffer += time.perf_counter() - t0
+            t0 = time.perf_counter()
+            await llm_generate(session, "ok", 16)
+            t_generate += time.perf_counter() - t0
+            session.append("assistant", "ok")
+        n = len(messages)
+        return [{"max_tokens": args.max_tokens, "history": len(session.history),
+                 "turns_trimmed": f"{trims / n:.0%}",
+                 "legacy_join_us": f"{t_legacy / n * 1e6:.1f}",
+                 "prompt_buffer_us": f"{t_buffer / n * 1e6:.1f}",
+                 "llm_generate_us": f"{t_generate / n * 1e6:.1f}"}]
+
+    gc.disable()  # keep collector pauses over the growing heap out of the per-turn numbers
+    try:
+        rows = asyncio.run(run())
+        hits, prefilled = nmapmcpserver.MODEL.prefix_hits, nmapmcpserver.MODEL.prefill_tokens
+        steady_rows = asyncio.run(steady())
+    finally:
+        gc.enable()
+    _report(rows)
+    print(f"prefix hits: {hits}, prefilled tokens: {prefilled}\n")
+    _report(steady_rows)
+
+
+# ---------------- allowlist ----------------
+def _random_ranges(n: int, seed: int = 1) -> List[str]:
+    # inventory-like mix: mostly IPv4 /16../30 plus some IPv6 /48../64
+    rnd = random.Random(seed)
+    out = []
+    for _ in range(n):
+        if rnd.random() < 0.8:
+            prefix = rnd.randint(16, 30)
+            addr = rnd.getrandbits(32) >> (32 - prefix) << (32 - prefix)
+            out.append(f"{ipaddress.IPv4Address(addr)}/{prefix}")
+        else:
+            prefix = rnd.randint(48, 64)
+            addr = (0x2001 << 112 | rnd.getrandbits(112)) >> (128 - prefix) << (128 - prefix)
+            out.append(f"{ipaddress.IPv6Address(addr)}/{prefix}")
+    return out
+
+
+def bench_allowlist(args):
+    """Linear ALLOWED_NETWORKS walk vs the NetworkIndex bisect at --ranges CIDRs."""
+    from mcp_common import Allowlist
+
+    ranges = _random_ranges(args.ranges)
+    rnd = random.Random(2)
+    nets = [ipaddress.ip_network(r) for r in ranges]
+    # half the lookups hit an allowed range, half are random (mostly misses)
+    targets = []
+    for i in range(args.lookups):
+        if i % 2:
+            net = rnd.choice(nets)
+            targets.append(str(net.network_address + rnd.randrange(net.num_addresses)))
+        else:
+            targets.append(str(ipaddress.IPv4Address(rnd.getrandbits(32))))
+
+    def linear(target: str) -> bool:
+        # is_target_allowed before the index
+        try:
+            ip = ipaddress.ip_address(target)
+        except Exception:
+            return False
+        for net in nets:
+            if ip in net:
+                return True
+        return False
+
+    t0 = time.perf_counter()
+    allowlist = Allowlist(ranges)
+    build = time.perf_counter() - t0
+
+    linear_n = min(args.lookups, 2000)  # the linear walk is far too slow for all of them
+    t_linear = _timeit(lambda: [linear(t) for t in targets[:linear_n]])
+    t0 = time.perf_counter()
+    hits = sum(allowlist.allows(t) for t in targets)
+    t_index = time.perf_counter() - t0
+    assert [linear(t) for t in targets[:linear_n]] == [allowlist.allows(t) for t in targets[:linear_n]]
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+        f.write("\n".join(ranges))
+    try:
+        file_allowlist = Allowlist([], f.name)
+        t_reload = _timeit(file_allowlist.reload)
+    finally:
+        os.unlink(f.name)
+
+    _report([
+        {"impl": "linear", "ranges": args.ranges, "lookups": linear_n,
+         "us/lookup": f"{t_linear / linear_n * 1e6:.2f}", "build_ms": "-"},
+        {"impl": "index", "ranges": args.ranges, "lookups": args.lookups,
+         "us/lookup": f"{t_index / args.lookups * 1e6:.2f}", "build_ms": f"{build * 1000:.1f}"},
+    ])
+    print(f"hits: {hits}/{args.lookups}, intervals after merge: {allowlist.index.intervals()}, "
+          f"file reload: {t_reload * 1000:.1f} ms")
+
+
+# ---------------- metrics ----------------
+def bench_metrics(args):
+    """
+    Per-request cost of the /metrics instrumentation: a bare ASGI app against
+    the same app behind MetricsMiddleware, driven in-process so that only the
+    middleware differs, plus the raw Histogram.observe cost and one render.
+    """
+    from mcp_common import Metrics
+    from nmapmcpserver import METRICS, MetricsMiddleware
+
+    class Route:
+        path = "/ping"
+
+    async def bare(scope, receive, send):
+        scope["route"] = Route
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b'{"ok":true}'})
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        pass
+
+    async def drive(app, n: int) -> float:
+        t0 = time.perf_counter()
+        for _ in range(n):
+            await app({"type": "http", "method": "GET", "path": "/ping"}, receive, send)
+        return time.perf_counter() - t0
+
+    async def run():
+        n = args.requests
+        await drive(bare, 1000)  # warm up
+        t_bare = await drive(bare, n)
+        t_mw = await drive(MetricsMiddleware(bare), n)
+        return t_bare, t_mw
+
+    t_bare, t_mw = asyncio.run(run())
+    h = Metrics().histogram("bench_seconds", "bench", ("route",))
+    t_obs = _timeit(lambda: [h.observe(0.003, "/ping") for _ in range(args.requests)])
+    t_render = _timeit(METRICS.render)
+    n = args.requests
+    _report([
+        {"path": "bare ASGI app", "us/request": f"{t_bare / n * 1e6:.2f}"},
+        {"path": "with MetricsMiddleware", "us/request": f"{t_mw / n * 1e6:.2f}"},
+        {"path": "middleware overhead", "us/request": f"{(t_mw - t_bare) / n * 1e6:.2f}"},
+        {"path": "Histogram.observe alone", "us/request": f"{t_obs / n * 1e6:.2f}"},
+    ])
+    print(f"/metrics render: {t_render * 1000:.2f} ms")
+
+
+# ---------------- ls ----------------
+def _legacy_list_directory(path: str) -> str:
+    # list_directory before DirectoryLister: everything inline, on the caller's thread
+    items = []
+    with os.scandir(path) as it:
+        for e in it:
+            typ = 'DIR' if e.is_dir() else 'FILE'
+            size = e.stat().st_size if e.is_file() else ''
+            items.append(f"{typ:4} {e.name} {size}")
+    return "\n".join(items) + "\n"
+
+
+async def _max_loop_lag(coro, interval: float = 0.001):
+    """Run coro while a ticker measures the longest event-loop stall. Returns (result, seconds, max lag)."""
+    lag = 0.0
+    done = False
+
+    async def ticker():
+        nonlocal lag
+        while not done:
+            t = time.perf_counter()
+            await asyncio.sleep(interval)
+            lag = max(lag, time.perf_counter() - t - interval)
+
+    tick = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0)
+    t0 = time.perf_counter()
+    try:
+        result = await coro
+    finally:
+        elapsed = time.perf_counter() - t0
+        done = True
+        await tick
+    return result, elapsed, lag
+
+
+def bench_ls(args):
+    """
+    List a generated directory of --entries files: the old inline scandir
+    against DirectoryLister (cold scan, cached first page, all pages), with
+    the longest event-loop stall each one causes.
+    """
+    from mcp_common import DirectoryLister
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for i in range(args.entries):
+            os.close(os.open(os.path.join(tmp, f"f{i:07d}"), os.O_CREAT | os.O_WRONLY, 0o600))
+        past = time.time() - 60  # out of the racy window so the listing can be cached
+        os.utime(tmp, (past, past))
+
+        async def legacy():
+            return _legacy_list_directory(tmp)
+
+        async def all_pages(lister):
+            cursor, n = None, 0
+            while True:
+                page = await lister.page(tmp, cursor, args.page)
+                n += len(page["entries"])
+                cursor = page["next"]
+                if cursor is None:
+                    return n
+
+        async def run():
+            lister = DirectoryLister()
+            rows = []
+            for name, coro in (("legacy inline", legacy()),
+                               ("lister cold page", lister.page(tmp, None, args.page)),
+                               ("lister cached page", lister.page(tmp, None, args.page)),
+                               ("lister all pages", all_pages(lister))):
+                _, elapsed, lag = await _max_loop_lag(coro)
+                rows.append({"listing": name, "ms": f"{elapsed * 1000:.1f}", "max_loop_stall_ms": f"{lag * 1000:.1f}"})
+            lister.pool.shutdown()
+            return rows
+
+        rows = asyncio.run(run())
+    print(f"{args.entries} entries, pages of {args.page}")
+    _report(rows)
+
+
+# ---------------- files ----------------
+def _legacy_list_files(path: str) -> Dict[str, Any]:
+    # fastmcp_tools_server list_files before scandir: listdir plus isfile and isdir per entry
+    contents = os.listdir(path)
+    files = [item for item in contents if os.path.isfile(os.path.join(path, item))]
+    directories = [item for item in contents if os.path.isdir(os.path.join(path, item))]
+    return {"path": path, "files": files, "directories": directories}
+
+
+def _legacy_walk(path: str) -> int:
+    # a whole subtree the old way: one list_files per directory
+    n, pending = 0, [path]
+    while pending:
+        res = _legacy_list_files(pending.pop())
+        n += len(res["files"]) + len(res["directories"])
+        pending.extend(os.path.join(res["path"], d) for d in res["directories"])
+    return n
+
+
+def _make_tree(root: str, files: int, fanout: int = 32, per_dir: int = 1000):
+    """files spread over root/dNN/dNN/ leaf directories of per_dir files each."""
+    made = 0
+    for i in itertools.count():
+        leaf = os.path.join(root, f"d{i // fanout:02d}", f"d{i % fanout:02d}")
+        os.makedirs(leaf, exist_ok=True)
+        for j in range(min(per_dir, files - made)):
+            os.close(os.open(os.path.join(leaf, f"f{j:04d}.{'md' if j % 10 == 0 else 'txt'}"),
+                             os.O_CREAT | os.O_WRONLY, 0o600))
+        made += per_dir
+        if made >= files:
+            return
+
+
+def bench_files(args):
+    """
+    fastmcp_tools_server list_files on a generated tree of --files files:
+    one directory and the whole tree, old listdir+isfile/isdir against the
+    scandir walk (1 thread vs LIST_WORKERS), first and next page, glob filter.
+    Runs on a warm page cache.
+    """
+    sys.path.insert(0, os.path.join(HERE, "fastmcp_tools_server"))
+    import server as tools
+
+    def run(tree: str):
+        if not os.path.isdir(tree) or not os.listdir(tree):
+            t0 = time.perf_counter()
+            _make_tree(tree, args.files)
+            print(f"generated {args.files} files in {time.perf_counter() - t0:.0f} s")
+        _legacy_walk(tree)  # warm the dentry/inode caches for both sides
+        leaf = os.path.join(tree, "d00", "d00")
+        rows = []
+
+        def measure(name: str, fn):
+            t0 = time.perf_counter()
+            n = fn()
+            rows.append({"listing": name, "entries": n, "ms": f"{(time.perf_counter() - t0) * 1000:.1f}"})
+
+        def page(**kw):
+            res = tools.list_files(tree, **kw)
+            return len(res["files"]) + len(res["directories"])
+
+        def uncached(**kw):
+            tools.LIST_CACHE = tools.ListingCache()
+            return page(**kw)
+
+        measure("legacy one dir", lambda: len(_legacy_list_files(leaf)["files"]))
+        measure("scandir one dir", lambda: len(tools.list_files(leaf, limit=10**9)["files"]))
+        measure("legacy whole tree", lambda: _legacy_walk(tree))
+        default_pool = tools.LIST_POOL
+        tools.LIST_POOL = ThreadPoolExecutor(1)
+        measure("scandir walk, 1 thread, first page", lambda: uncached(depth=99))
+        tools.LIST_POOL.shutdown()
+        tools.LIST_POOL = default_pool
+        measure(f"scandir walk, {tools.LIST_WORKERS} threads, first page", lambda: uncached(depth=99))
+        cursor = tools.list_files(tree, depth=99)["next_cursor"]
+        measure("next page (cached walk)", lambda: page(depth=99, cursor=cursor))
+        measure("walk with pattern=*.md, first page", lambda: uncached(depth=99, pattern="*.md"))
+        return rows
+
+    if args.tree:
+        os.makedirs(args.tree, exist_ok=True)
+        rows = run(args.tree)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            rows = run(tmp)
+    _report(rows)
+
+
+# ---------------- index ----------------
+def bench_index(args):
+    """
+    fastmcp_tools_server FileIndex on a generated tree of --files files:
+    first build, no-op and incremental refresh, and name / substring /
+    extension queries against finding the same files with list_files.
+    """
+    import resource
+
+    sys.path.insert(0, os.path.join(HERE, "fastmcp_tools_server"))
+    import server as tools
+    from file_index import FileIndex
+
+    def run(tree: str, db_path: str):
+        if not os.path.isdir(tree) or not os.listdir(tree):
+            _make_tree(tree, args.files)
+        index = FileIndex(db_path, [tree])
+        rows = []
+
+        def measure(name: str, fn, repeat: int = 1):
+            t0 = time.perf_counter()
+            for _ in range(repeat):
+                res = fn()
+            ms = (time.perf_counter() - t0) * 1000 / repeat
+            if isinstance(res, list):
+                res = f"{len(res)} found"
+            elif isinstance(res, dict):
+                res = f"{res['dirs_read']}/{res['dirs_visited']} dirs read, +{res['added']}"
+            rows.append({"operation": name, "result": res, "ms": f"{ms:.2f}"})
+
+        rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        measure("build index", index.refresh)
+        rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        measure("refresh, nothing changed", index.refresh)
+        # up to 10 leaf directories spread over whatever tree was built (or given)
+        leaves = sorted(d for d, subdirs, _ in os.walk(tree) if not subdirs)
+        changed = leaves[::max(1, len(leaves) // 10)][:10]
+        for i, leaf in enumerate(changed):
+            open(os.path.join(leaf, f"new{i}.log"), "w").close()
+        measure(f"refresh, {len(changed)} dirs changed (entries added)", index.refresh)
+        measure("name query (f0120.md, first 100)", lambda: index.search("f0120.md", "name", limit=100), repeat=20)
+        measure("substring query (ew0, matches 1)", lambda: index.search("ew0", limit=100), repeat=20)
+        measure("substring query (f012, first 100)", lambda: index.search("f012", limit=100), repeat=20)
+        measure("ext query (log)", lambda: index.search("log", "ext", limit=100), repeat=20)
+        tools.LIST_CACHE = tools.ListingCache()
+        measure("list_files walk for *.log", lambda: f"{tools.list_files(tree, pattern='*.log', depth=99)['total']} found")
+        for i, leaf in enumerate(changed):
+            os.remove(os.path.join(leaf, f"new{i}.log"))
+        index.refresh()
+        db_mb = sum(os.path.getsize(p) for p in (db_path, db_path + "-wal") if os.path.exists(p)) / 1e6
+        print(f"index: {db_mb:.0f} MB on disk, peak RSS grew {(rss1 - rss0) / 1024:.0f} MB while building")
+        return rows
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.tree:
+            os.makedirs(args.tree, exist_ok=True)
+            rows = run(args.tree, os.path.join(tmp, "index.db"))
+        else:
+            rows = run(os.path.join(tmp, "tree"), os.path.join(tmp, "index.db"))
+    _report(rows)
+
+
+# ---------------- load ----------------
+HERE = os.path.dirname(os.path.abspath(__file__))
+LOAD_TARGETS = ("http", "ws", "gemini")
+
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    # nearest rank
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[k]
+
+
+def _self_signed_cert(directory: str):
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                    "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+
+def _stub_env(**extra) -> Dict[str, str]:
+    """Server environment with nmap replayed from fixtures and no WebSocket rate limit."""
+    return dict(os.environ, PYTHONPATH=HERE, NMAP_REPLAY_DIR=os.path.join(HERE, "fixtures", "nmap"),
+                MCP_FAKE_TOKEN_LATENCY="0", MCP_WS_RATE="1e9", **extra)
+
+
+def _wait_for_port(port: int, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+async def _http_post(reader, writer, path: str, body: bytes) -> int:
+    """One keep-alive HTTP/1.1 POST; returns the status code."""
+    writer.write(b"POST %s HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                 b"Content-Length: %d\r\n\r\n%s" % (path.encode(), len(body), body))
+    head = await reader.readuntil(b"\r\n\r\n")
+    status = int(head.split(b" ", 2)[1])
+    length = 0
+    for line in head.split(b"\r\n"):
+        if line.lower().startswith(b"content-length:"):
+            length = int(line.split(b":", 1)[1])
+    await reader.readexactly(length)
+    return status
+
+
+async def _drive(concurrency: int, requests: int, warmup: int, open_vu, request) -> Dict[str, Any]:
+    """
+    Run `requests` requests over `concurrency` virtual users. open_vu(i) sets
+    up a user's state (e.g. a connection); request(state) does one request
+    and returns True on success. The first `warmup` requests of every user are
+    not measured.
+    """
+    latencies: List[float] = []
+    errors = 0
+    counter = itertools.count()
+
+    async def vu(i: int):
+        nonlocal errors
+        state = await open_vu(i)
+        try:
+            for _ in range(warmup):
+                await request(state)
+            while next(counter) < requests:
+                t0 = time.perf_counter()
+                try:
+                    ok = await request(state)
+                except Exception:
+                    ok = False
+                latencies.append(time.perf_counter() - t0)
+                errors += not ok
+        finally:
+            close = getattr(state, "close", None)
+            if close is not None:
+                res = close()
+                if asyncio.iscoroutine(res):
+                    await res
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(vu(i) for i in range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    latencies.sort()
+    return {
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "req_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        "p999_ms": round(_percentile(latencies, 99.9) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+    }
+
+
+class _Conn:
+    def __init__(self, session_id: str, reader, writer):
+        self.session_id, self.reader, self.writer = session_id, reader, writer
+
+    def close(self):
+        self.writer.close()
+
+
+def _load_mcp(args, port: int, target: str) -> Dict[str, Any]:
+    instruction = args.instruction
+    tools = [t for t in args.tools.split(",") if t]
+
+    async def open_http(i):
+        return _Conn(f"load-http-{i}", *await asyncio.open_connection("127.0.0.1", port))
+
+    async def http_request(conn):
+        body = json.dumps({"session_id": conn.session_id, "instruction": instruction, "tools": tools}).encode()
+        return await _http_post(conn.reader, conn.writer, "/mcp", body) == 200
+
+    async def open_ws(i):
+        import websockets
+        ws = await websockets.connect(f"ws://127.0.0.1:{port}/mcp/ws", max_size=None)
+        await ws.send(json.dumps({"session_id": f"load-ws-{i}"}))
+        return ws
+
+    async def ws_request(ws):
+        await ws.send(json.dumps({"instruction": instruction, "tools": tools}))
+        while True:
+            frame = json.loads(await ws.recv())
+            if frame.get("type") == "reply":
+                return True
+            if "error" in frame:  # rate limited, or the handler failed
+                return False
+
+    open_vu, request = (open_http, http_request) if target == "http" else (open_ws, ws_request)
+    return asyncio.run(_drive(args.concurrency, args.requests, args.warmup, open_vu, request))
+
+
+def _load_gemini(args, port: int) -> Dict[str, Any]:
+    # Gemini has no keep-alive: every request is a new TLS connection
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    url = args.gemini_url.encode() + b"\r\n"
+
+    async def open_vu(i):
+        return None
+
+    async def request(_):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port, ssl=ctx)
+        try:
+            writer.write(url)
+            data = await reader.read()
+        finally:
+            writer.close()
+        return data.startswith(b"20 ")
+
+    return asyncio.run(_drive(args.concurrency, args.requests, args.warmup, open_vu, request))
+
+
+def _compare(results: Dict[str, Dict[str, Any]], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    rows = []
+    for target, res in results.items():
+        base = baseline.get(target)
+        if base is None:
+            continue
+        row = {"target": target}
+        for key in ("req_per_s", "p50_ms", "p99_ms", "p999_ms"):
+            change = (res[key] - base[key]) / base[key] * 100 if base[key] else 0.0
+            row[key] = f"{base[key]} -> {res[key]} ({change:+.1f}%)"
+        rows.append(row)
+    if rows:
+        print(f"\nagainst {baseline_path}:")
+        _report(rows)
+
+
+def bench_load(args):
+    """Throughput and tail latency of /mcp, /mcp/ws and sc.py's Gemini endpoint."""
+    targets = [t for t in args.target.split(",") if t]
+    for t in targets:
+        if t not in LOAD_TARGETS:
+            sys.exit(f"unknown target {t!r}; choose from {', '.join(LOAD_TARGETS)}")
+    results: Dict[str, Dict[str, Any]] = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        if {"http", "ws"} & set(targets):
+            port = _free_port()
+            server = subprocess.Popen(
+                [sys.executable, "-m", "uvicorn", "nmapmcpserver:app", "--port", str(port),
+                 "--log-level", "warning", "--no-access-log"],
+                env=_stub_env(), cwd=tmp)
+            try:
+                _wait_for(f"http://127.0.0.1:{port}/ping")
+                for t in ("http", "ws"):
+                    if t in targets:
+                        results[t] = _load_mcp(args, port, t)
+            finally:
+                server.terminate()
+                server.wait()
+        if "gemini" in targets:
+            cert, key = _self_signed_cert(tmp)
+            port = _free_port()
+            server = subprocess.Popen(
+                [sys.executable, os.path.join(HERE, "sc.py"), "--cert", cert, "--key", key, "--port", str(port)],
+                env=_stub_env(), cwd=tmp, stdout=subprocess.DEVNULL)
+            try:
+                _wait_for_port(port)
+                results["gemini"] = _load_gemini(args, port)
+            finally:
+                server.terminate()
+                server.wait()
+
+    _report([{"target": t, **r} for t, r in results.items()])
+    if args.compare:
+        _compare(results, args.compare)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "params": {k: getattr(args, k) for k in ("concurrency", "requests", "warmup", "tools",
+                                                          "instruction", "gemini_url")},
+                "results": results,
+            }, f, indent=2)
+        print(f"saved baseline to {args.save}")
+
+
+# ---------------- client ----------------
+def bench_client(args):
+    """
+    Tool calls per second against mcp_server.py and mcp_server2.py: a new
+    stdio server per call (mcp_client.py's original pattern) against
+    ClientPool, one call at a time and with --concurrency calls in flight.
+    """
+    from fastmcp.client import Client
+    from fastmcp.client.transports import PythonStdioTransport
+    from mcp_client import SERVER_ENV, ClientPool
+
+    async def cold(script: str, tool: str, calls: int):
+        for i in range(calls):
+            transport = PythonStdioTransport(os.path.join(HERE, script), env=SERVER_ENV, keep_alive=False)
+            async with Client(transport) as client:
+                await client.call_tool(tool, {"name": str(i)})
+
+    async def pooled(script: str, tool: str, calls: int, concurrency: int):
+        async with ClientPool(os.path.join(HERE, script), size=args.pool) as pool:
+            counter = itertools.count()
+
+            async def worker():
+                while next(counter) < calls:
+                    await pool.call_tool(tool, {"name": "bench"})
+
+            t0 = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+            return time.perf_counter() - t0
+
+    rows = []
+    for script, tool in (("mcp_server.py", "hello"), ("mcp_server2.py", "howdy")):
+        t0 = time.perf_counter()
+        asyncio.run(cold(script, tool, args.cold_calls))
+        elapsed = time.perf_counter() - t0
+        rows.append({"server": script, "mode": "cold spawn per call", "calls": args.cold_calls,
+                     "calls/s": f"{args.cold_calls / elapsed:.1f}"})
+        for concurrency in (1, args.concurrency):
+            elapsed = asyncio.run(pooled(script, tool, args.calls, concurrency))
+            rows.append({"server": script, "mode": f"pool of {args.pool}, {concurrency} in flight",
+                         "calls": args.calls, "calls/s": f"{args.calls / elapsed:.1f}"})
+    _report(rows)
+
+
+# ---------------- host ----------------
+def bench_host(args):
+    """
+    Spawn-to-ready time (first list_tools answered over stdio) of the three
+    single-purpose servers against mcp_host.py serving all of their tools,
+    lazily and with MCP_HOST_EAGER=1, plus the host's per-tool cold calls.
+    """
+    from fastmcp.client import Client
+    from fastmcp.client.transports import PythonStdioTransport
+
+    async def ready(script: str, env: Dict[str, str], calls=()):
+        t0 = time.perf_counter()
+        transport = PythonStdioTransport(os.path.join(HERE, script), env=env, keep_alive=False,
+                                         cwd=os.path.dirname(os.path.join(HERE, script)))
+        async with Client(transport) as client:
+            tools = await client.list_tools()
+            elapsed = time.perf_counter() - t0
+            for name, arguments in calls:
+                await client.call_tool(name, arguments)
+            stats = (await client.call_tool("host_stats", {})).data if calls else None
+        return elapsed, len(tools), stats
+
+    def best(script: str, env: Dict[str, str]):
+        runs = [asyncio.run(ready(script, env)) for _ in range(args.runs)]
+        return min(r[0] for r in runs), runs[0][1]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = {**os.environ, "FILE_INDEX_ROOTS": tmp, "FILE_INDEX_DB": os.path.join(tmp, "index.db")}
+        rows, separate = [], 0.0
+        for script in ("mcp_server.py", "mcp_server2.py", os.path.join("fastmcp_tools_server", "server.py")):
+            elapsed, tools = best(script, env)
+            separate += elapsed
+            rows.append({"server": script, "tools": tools, "ready_ms": f"{elapsed * 1000:.0f}"})
+        rows.append({"server": "three servers, total", "tools": "", "ready_ms": f"{separate * 1000:.0f}"})
+        for label, extra in (("mcp_host.py (lazy)", {}), ("mcp_host.py (MCP_HOST_EAGER=1)", {"MCP_HOST_EAGER": "1"})):
+            elapsed, tools = best("mcp_host.py", {**env, **extra})
+            rows.append({"server": label, "tools": tools, "ready_ms": f"{elapsed * 1000:.0f}"})
+        _report(rows)
+
+        calls = [("hello", {"name": "a"}), ("howdy", {"name": "b"}), ("list_files", {"path": tmp}),
+                 ("hello", {"name": "c"}), ("list_files", {"path": tmp})]
+        _, _, stats = asyncio.run(ready("mcp_host.py", env, calls))
+    print(f"\nmcp_host startup {stats['startup_ms']} ms (budget {stats['startup_budget_ms']:.0f} ms)")
+    _report([{"module": name, "import_ms": m["import_ms"]} for name, m in stats["modules"].items()])
+    _report([{"tool": name, **{k: v for k, v in t.items() if k != "module"}}
+             for name, t in stats["tools"].items() if t["calls"]])
+
+
+# ---------------- tls ----------------
+def _gemini_handshakes(port: int, connections: int, concurrency: int, resume: bool) -> Dict[str, Any]:
+    """
+    Open `connections` TLS connections to sc.py, each sending one /info request.
+    With resume, every client thread offers the session from its previous
+    connection, as a client keeping its TLS session would.
+    """
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    per_thread = connections // concurrency
+
+    def client(_):
+        session = None
+        reused = 0
+        handshakes = []
+        for _ in range(per_thread):
+            with socket.create_connection(("127.0.0.1", port)) as raw:
+                t0 = time.perf_counter()
+                with ctx.wrap_socket(raw, server_hostname="localhost", session=session) as tls:
+                    handshakes.append(time.perf_counter() - t0)
+                    reused += tls.session_reused
+                    tls.sendall(b"gemini://localhost/info\r\n")
+                    while tls.recv(65536):
+                        pass
+                    if resume:
+                        session = tls.session  # TLS 1.3 tickets arrive after the handshake
+        return reused, handshakes
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(client, range(concurrency)))
+    elapsed = time.perf_counter() - t0
+    handshakes = sorted(h for _, hs in results for h in hs)
+    total = len(handshakes)
+    return {
+        "connections": total,
+        "conn/s": f"{total / elapsed:.0f}",
+        "handshake_p50_ms": f"{_percentile(handshakes, 50) * 1000:.2f}",
+        "handshake_p99_ms": f"{_percentile(handshakes, 99) * 1000:.2f}",
+        "resumed": f"{sum(r for r, _ in results) / total * 100:.0f}%",
+    }
+
+
+def bench_tls(args):
+    """
+    Connections per second against sc.py with a local self-signed cert:
+    one process vs --workers N (SO_REUSEPORT), each with full handshakes and
+    with clients resuming their TLS session.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = _self_signed_cert(tmp)
+        for workers in sorted({1, args.workers}):
+            port = _free_port()
+            server = subprocess.Popen(
+                [sys.executable, os.path.join(HERE, "sc.py"), "--cert", cert, "--key", key,
+                 "--port", str(port), "--workers", str(workers)],
+                env=_stub_env(), cwd=tmp, stdout=subprocess.DEVNULL)
+            try:
+                _wait_for_port(port)
+                time.sleep(0.5)  # let every worker bind
+                for resume in (False, True):
+                    res = _gemini_handshakes(port, args.connections, args.concurrency, resume)
+                    rows.append({"workers": workers, "mode": "resumed" if resume else "full", **res})
+            finally:
+                server.terminate()
+                server.wait()
+    _report(rows)
+
+
+# ---------------- slowloris ----------------
+async def _slowloris(port: int, ctx: ssl.SSLContext, stop: asyncio.Event, held: List[float]):
+    """Handshake, then trickle one byte of the request line a second until cut off."""
+    try:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port, ssl=ctx)
+    except OSError:
+        return
+    t0 = time.perf_counter()
+    try:
+        for byte in itertools.cycle(b"gemini://localhost/info"):
+            writer.write(bytes([byte]))
+            await writer.drain()
+            try:
+                await asyncio.wait_for(reader.read(1024), 1.0)
+                break  # closed by the server, or answered 44
+            except asyncio.TimeoutError:
+                pass
+            if stop.is_set():
+                return
+        held.append(time.perf_counter() - t0)
+    except OSError:
+        held.append(time.perf_counter() - t0)
+    finally:
+        writer.close()
+
+
+async def _gemini_phase(port: int, ctx: ssl.SSLContext, seconds: float, concurrency: int,
+                        slow: int) -> Dict[str, Any]:
+    """Legitimate /info clients for `seconds` while `slow` slowloris clients keep reconnecting."""
+    stop = asyncio.Event()
+    held: List[float] = []
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+
+    async def attacker():
+        while not stop.is_set():
+            await _slowloris(port, ctx, stop, held)
+            await asyncio.sleep(1.0)  # reconnect at a slowloris pace, not in a tight loop
+
+    async def client():
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            try:
+                reader, writer = await asyncio.open_connection("127.0.0.1", port, ssl=ctx)
+                writer.write(b"gemini://localhost/info\r\n")
+                data = await reader.read()
+                writer.close()
+                status = data[:2].decode() or "closed"
+            except OSError:
+                status = "error"
+            latencies.append(time.perf_counter() - t0)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    attackers = [asyncio.create_task(attacker()) for _ in range(slow)]
+    await asyncio.sleep(1.0 if slow else 0)  # let the attackers connect first
+    clients = [asyncio.create_task(client()) for _ in range(concurrency)]
+    await asyncio.sleep(seconds)
+    stop.set()
+    await asyncio.gather(*clients, *attackers, return_exceptions=True)
+    latencies.sort()
+    return {
+        "slowloris": slow,
+        "req/s": f"{statuses.get('20', 0) / seconds:.0f}",
+        "p50_ms": f"{_percentile(latencies, 50) * 1000:.1f}",
+        "p99_ms": f"{_percentile(latencies, 99) * 1000:.1f}",
+        "statuses": " ".join(f"{k}:{v}" for k, v in sorted(statuses.items())),
+        "slow_cut_after_s": f"{sum(held) / len(held):.1f}" if held else "-",
+    }
+
+
+def bench_slowloris(args):
+    """
+    /info throughput of sc.py with and without slowloris clients that hold
+    connections open by trickling their request line. With REQUEST_TIMEOUT
+    and request slots granted only to complete request lines, the legitimate
+    rate should barely move until the attackers exceed MAX_CONNECTIONS.
+    """
+    ctx = ssl.create_default_context()
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = _self_signed_cert(tmp)
+        port = _free_port()
+        server = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "sc.py"), "--cert", cert, "--key", key, "--port", str(port)],
+            env=_stub_env(), cwd=tmp, stdout=subprocess.DEVNULL)
+        try:
+            _wait_for_port(port)
+            for slow in (0, *args.slow):
+                rows.append(asyncio.run(_gemini_phase(port, ctx, args.seconds, args.concurrency, slow)))
+        finally:
+            server.terminate()
+            server.wait()
+    _report(rows)
+
+
+# ---------------- workers ----------------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_for(url: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"server at {url} did not come up")
+
+
+def _post_json(url: str, body: Dict[str, Any]) -> Dict[str, Any]:
+    req = urllib.request.Request(url, data=json.dumps(body).encode(),
+                                 headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        return json.loads(resp.read())
+
+
+def bench_workers(args):
+    """
+    Start `uvicorn nmapmcpserver:app --workers N` on the shared SQLite session
+    backend, hit one session concurrently from many threads and check every
+    worker saw the same, consistently trimmed history.
+    """
+    port = _free_port()
+    base = f"http://127.0.0.1:{port}"
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, MCP_SESSION_BACKEND="sqlite",
+                   MCP_SESSION_DB=os.path.join(tmp, "sessions.db"))
+        server = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "nmapmcpserver:app", "--port", str(port),
+             "--workers", str(args.workers), "--log-level", "warning"],
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        try:
+            _wait_for(base + "/ping")
+            # budget fits about half of the appended messages, so trimming runs
+            # concurrently with appends from other workers
+            budget = args.requests
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                list(pool.map(lambda i: _post_json(base + "/mcp", {
+                    "session_id": "shared", "instruction": f"msg-{i}", "max_tokens": budget,
+                }), range(args.requests)))
+            elapsed = time.perf_counter() - t0
+            final = json.loads(urllib.request.urlopen(base + "/session/shared").read())
+        finally:
+            server.terminate()
+            server.wait()
+
+    history = final["history"]
+    counted = sum(max(1, len(m["content"].split())) for m in history)
+    ok = counted == final["token_count"] and final["token_count"] <= budget
+    _report([{
+        "workers": args.workers,
+        "requests": args.requests,
+        "req/s": f"{args.requests / elapsed:.0f}",
+        "kept": len(history),
+        "token_count": final["token_count"],
+        "consistent": ok,
+    }])
+    if not ok:
+        sys.exit(1)
+
+
+# ---------------- llm ----------------
+def _time_to_first_byte(port: int, body: Dict[str, Any]):
+    """POST /mcp and return (seconds to first body byte, seconds to last byte)."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=120)
+    t0 = time.perf_counter()
+    conn.request("POST", "/mcp", json.dumps(body), {"Content-Type": "application/json"})
+    resp = conn.getresponse()
+    resp.read1(1)
+    first = time.perf_counter() - t0
+    resp.read()
+    total = time.perf_counter() - t0
+    conn.close()
+    return first, total
+
+
+def bench_llm(args):
+    """
+    Compare time-to-first-byte of the buffered /mcp response with the SSE
+    mode, against the placeholder model slowed down to a fixed per-token latency.
+    """
+    port = _free_port()
+    env = dict(os.environ, MCP_FAKE_TOKEN_LATENCY=str(args.token_latency))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "nmapmcpserver:app", "--port", str(port), "--log-level", "warning"],
+        env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+    rows = []
+    try:
+        _wait_for(f"http://127.0.0.1:{port}/ping")
+        instruction = " ".join(f"tok{i}" for i in range(args.tokens))
+        for mode, stream in (("buffered", False), ("sse", True)):
+            firsts, totals = [], []
+            for i in range(args.runs):
+                first, total = _time_to_first_byte(port, {
+                    "session_id": f"llm-{mode}-{i}", "instruction": instruction, "stream": stream})
+                firsts.append(first)
+                totals.append(total)
+            rows.append({
+                "mode": mode,
+                "tokens": args.tokens,
+                "ttfb_ms": f"{sorted(firsts)[len(firsts) // 2] * 1000:.1f}",
+                "total_ms": f"{sorted(totals)[len(totals) // 2] * 1000:.1f}",
+            })
+    finally:
+        server.terminate()
+        server.wait()
+    _report(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MCP server benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("session", help="Session.append throughput with trimming")
+    p.add_argument("--messages", type=int, default=100_000)
+    p.add_argument("--max-tokens", type=int, default=16384)
+    p.add_argument("--sessions", default="1000,20000", help="resident session counts for the store lookups")
+    p.set_defaults(func=bench_session)
+
+    p = sub.add_parser("prompt", help="per-turn prompt assembly cost as history grows")
+    p.add_argument("--turns", type=int, default=20000)
+    p.add_argument("--max-tokens", type=int, default=16384, help="token budget of the steady-state run")
+    p.set_defaults(func=bench_prompt)
+
+    p = sub.add_parser("allowlist", help="allowlist lookups: linear scan vs interval index")
+    p.add_argument("--ranges", type=int, default=10_000)
+    p.add_argument("--lookups", type=int, default=200_000)
+    p.set_defaults(func=bench_allowlist)
+
+    p = sub.add_parser("metrics", help="per-request overhead of the /metrics instrumentation")
+    p.add_argument("--requests", type=int, default=200_000)
+    p.set_defaults(func=bench_metrics)
+
+    p = sub.add_parser("ls", help="directory listing: inline scandir vs DirectoryLister")
+    p.add_argument("--entries", type=int, default=200_000)
+    p.add_argument("--page", type=int, default=1000)
+    p.set_defaults(func=bench_ls)
+
+    p = sub.add_parser("files", help="fastmcp list_files: listdir+stat vs parallel scandir walk with paging")
+    p.add_argument("--files", type=int, default=1_000_000)
+    p.add_argument("--tree", help="keep the generated tree here and reuse it on later runs")
+    p.set_defaults(func=bench_files)
+
+    p = sub.add_parser("index", help="fastmcp find_files: SQLite file index build, refresh and query times")
+    p.add_argument("--files", type=int, default=1_000_000)
+    p.add_argument("--tree", help="keep the generated tree here and reuse it on later runs")
+    p.set_defaults(func=bench_index)
+
+    p = sub.add_parser("client", help="mcp_client.py: cold stdio spawn per call vs ClientPool")
+    p.add_argument("--pool", type=int, default=4)
+    p.add_argument("--calls", type=int, default=2000)
+    p.add_argument("--cold-calls", type=int, default=10)
+    p.add_argument("--concurrency", type=int, default=32)
+    p.set_defaults(func=bench_client)
+
+    p = sub.add_parser("host", help="mcp_host.py startup vs separate servers, per-tool cold calls")
+    p.add_argument("--runs", type=int, default=3, help="best of this many spawns per server")
+    p.set_defaults(func=bench_host)
+
+    p = sub.add_parser("tls", help="sc.py connections/s: full vs resumed TLS handshakes, 1 vs N workers")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--connections", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=16)
+    p.set_defaults(func=bench_tls)
+
+    p = sub.add_parser("slowloris", help="sc.py throughput while slowloris clients hold connections")
+    p.add_argument("--slow", type=int, nargs="+", default=[600, 1500],
+                   help="slowloris client counts to try (sc.py MAX_CONNECTIONS is 1024)")
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.add_argument("--concurrency", type=int, default=8)
+    p.set_defaults(func=bench_slowloris)
+
+    p = sub.add_parser("load", help="throughput and p50/p99/p999 latency of /mcp, /mcp/ws and Gemini")
+    p.add_argument("--target", default="http,ws,gemini", help="comma-separated: http, ws, gemini")
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--requests", type=int, default=2000, help="measured requests per target")
+    p.add_argument("--warmup", type=int, default=5, help="unmeasured requests per virtual user")
+    p.add_argument("--tools", default="nmap:127.0.0.1", help="tool specs sent with each /mcp instruction")
+    p.add_argument("--instruction", default="summarize the scan")
+    p.add_argument("--gemini-url", default="gemini://localhost/nmap?target=127.0.0.1")
+    p.add_argument("--save", help="write results as a JSON baseline")
+    p.add_argument("--compare", help="baseline JSON to compare against")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("workers", help="multi-worker uvicorn on the shared SQLite session backend")
+    p.add_argument("--workers", type=int, default=4)
+    p.add_argument("--requests", type=int, default=400)
+    p.add_argument("--concurrency", type=int, default=32)
+    p.set_defaults(func=bench_workers)
+
+    p = sub.add_parser("llm", help="time-to-first-byte of buffered vs SSE /mcp replies")
+    p.add_argument("--tokens", type=int, default=200)
+    p.add_argument("--token-latency", type=float, default=0.005)
+    p.add_argument("--runs", type=int, default=5)
+    p.set_defaults(func=bench_llm)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,226 @@
-
 import asyncio
+import time
 from fastmcp.client import Client
 from fastmcp.client.transports import PythonStdioTransport
+from fastmcp.exceptions import ToolError
+
+SERVER_ENV = {"PYTHONPATH": "/usr/lib/python3/dist-packages"}
+
+
+class _Member:
+    """
+    One warm server process. The Client is entered and exited inside its own
+    task (anyio requires both in the same task); calls from any task share its
+    session, each with its own request id, so they are pipelined over stdio.
+    """
+
+    def __init__(self, script, env, max_inflight):
+        self.script = script
+        self.env = env
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.calls = 0
+        self.failures = 0
+        self.restarts = -1  # the first start isn't a restart
+        self.healthy = False
+        self.client = None
+        self._task = None
+        self._stop = None
+
+    async def start(self, timeout):
+        self.restarts += 1
+        self._stop = asyncio.Event()
+        ready = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._run(ready))
+        try:
+            await asyncio.wait_for(asyncio.shield(ready), timeout)
+        except BaseException:
+            await self.stop()
+            raise
+        self.healthy = True
+
+    async def _run(self, ready):
+        try:
+            transport = PythonStdioTransport(self.script, env=self.env, keep_alive=False)
+            async with Client(transport) as client:
+                self.client = client
+                ready.set_result(None)
+                await self._stop.wait()
+        except BaseException as e:
+            if not ready.done():
+                ready.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            self.healthy = False
+            self.client = None
+
+    async def stop(self):
+        self.healthy = False
+        if self._task is not None:
+            self._stop.set()
+            try:
+                await asyncio.wait_for(self._task, 5)
+            except BaseException:
+                self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return {"healthy": self.healthy, "inflight": self.inflight, "calls": self.calls,
+                "failures": self.failures, "restarts": self.restarts}
+
+
+class ClientPool:
+    """
+    Keeps `size` copies of an MCP server script running over stdio and spreads
+    call_tool requests over them, so callers don't pay interpreter and FastMCP
+    startup per call. Each process takes up to `max_inflight` concurrent calls;
+    a call goes to the healthy member with the fewest in flight.
+
+    A member whose transport fails (not a tool error) or that stops answering
+    the periodic health check (a list_tools call) is restarted in the background.
+    """
+
+    def __init__(self, script, size=4, env=None, max_inflight=16, call_timeout=30.0,
+                 health_interval=10.0, start_timeout=30.0):
+        self.script = script
+        self.call_timeout = call_timeout
+        self.health_interval = health_interval
+        self.start_timeout = start_timeout
+        self.members = [_Member(script, SERVER_ENV if env is None else env, max_inflight) for _ in range(size)]
+        self._available = asyncio.Condition()
+        self._restarting = set()
+        self._health_task = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        await asyncio.gather(*(m.start(self.start_timeout) for m in self.members))
+        self._health_task = asyncio.create_task(self._health_loop())
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        for task in list(self._restarting):
+            task.cancel()
+        await asyncio.gather(*(m.stop() for m in self.members))
+
+    async def _pick(self):
+        async with self._available:
+            while True:
+                ready = [m for m in self.members if m.healthy and m.inflight < m.max_inflight]
+                if ready:
+                    member = min(ready, key=lambda m: m.inflight)
+                    member.inflight += 1
+                    return member
+                await self._available.wait()
+
+    async def _release(self, member):
+        async with self._available:
+            member.inflight -= 1
+            self._available.notify_all()
+
+    async def call_tool(self, name, arguments=None, retries=0):
+        """
+        Run a tool on one of the warm servers. Transport failures restart the
+        member; with retries > 0 the call is repeated on another member (only
+        safe for tools without side effects). ToolError is raised as is.
+        """
+        while True:
+            member = await self._pick()
+            client = member.client
+            if client is None:
+                # stopped since it was picked: make sure it restarts, fail over to another member
+                self._restart(member)
+                await self._release(member)
+                continue
+            try:
+                result = await client.call_tool(name, arguments or {}, timeout=self.call_timeout)
+                member.calls += 1
+                return result
+            except ToolError:
+                raise
+            except Exception:
+                member.failures += 1
+                self._restart(member)
+                if retries <= 0:
+                    raise
+                retries -= 1
+            finally:
+                await self._release(member)
+
+    def _restart(self, member):
+        if not member.healthy:
+            return  # already being restarted
+        member.healthy = False
+
+        async def restart():
+            while True:
+                try:
+                    await member.stop()
+                    await member.start(self.start_timeout)
+                    break
+                except Exception:
+                    await asyncio.sleep(1)  # e.g. the script is broken; keep trying
+            async with self._available:
+                self._available.notify_all()
+
+        task = asyncio.create_task(restart())
+        self._restarting.add(task)
+        task.add_done_callback(self._restarting.discard)
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await self.check_health()
+
+    async def check_health(self):
+        """Probe every member with list_tools, restart the ones that don't answer, and report their state."""
+        async def probe(member):
+            client = member.client
+            if not member.healthy or client is None:
+                return False
+            try:
+                # list_tools rather than ping: not every server answers ping
+                await asyncio.wait_for(client.list_tools(), self.call_timeout)
+                return True
+            except Exception:
+                return False
+
+        results = await asyncio.gather(*(probe(m) for m in self.members))
+        for member, ok in zip(self.members, results):
+            if not ok and member.healthy:
+                member.failures += 1
+                self._restart(member)
+        return self.stats()
+
+    def stats(self):
+        return [m.stats() for m in self.members]
+
 
 async def main():
     # Connect to the server using the default STDIO transport
     transport = PythonStdioTransport(
         "mcp_server.py",
-        env={"PYTHONPATH": "/usr/lib/python3/dist-packages"}
+        env=SERVER_ENV
     )
     async with Client(transport) as client:
         # Call the 'hello' tool with the name 'World'
         result = await client.call_tool("hello", {"name": "World"})
         print(result)
 
+    # The same through a pool of warm servers: only the first call waits for startup
+    async with ClientPool("mcp_server.py", size=2) as pool:
+        t0 = time.perf_counter()
+        results = await asyncio.gather(*(pool.call_tool("hello", {"name": f"World {i}"}) for i in range(100)))
+        print(f"{len(results)} pooled calls in {(time.perf_counter() - t0) * 1000:.0f} ms:", results[-1].data)
+        print(await pool.check_health())
+
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,1063 @@
+"""
+Helpers shared by nmapmcpserver.py (HTTP/WebSocket MCP) and sc.py (Gemini).
+
+- ResultCache: TTL result cache with single-flight request coalescing
+- nmap XML: exec_nmap_xml runs a scan with -oX and parse_nmap_xml turns it into
+  compact Host/Port records
+- ScanStore: indexed SQLite store of every parsed scan with a query API and
+  diffs between successive scans of a target
+- NMAP_REPLAY_DIR: offline mode answering scans from recorded nmap XML files
+- nmap_slot / NMAP_PROCESS_CAP: cap on concurrently running nmap processes
+- JobScheduler: async job queue with priority lanes and per-session fair share
+- NetworkIndex / Allowlist: O(log n) target allowlist checks, hot-reloaded from a file
+- TokenBucket: per-client rate limiting
+- AdmissionGate: connection limit with a short bounded queue and early rejection
+- Metrics: counters, gauges and latency histograms in Prometheus text format
+- json_dumps: compact JSON through orjson when it is installed
+- DirectoryLister: paginated directory listings off the event loop, cached by directory mtime
+"""
+
+import asyncio
+import bisect
+import glob
+import heapq
+import io
+import json
+import os
+import sqlite3
+import stat
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from ipaddress import ip_address, ip_network
+from typing import (Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Hashable, Iterable, List,
+                    Optional, Sequence, Tuple)
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process slots
+    fcntl = None
+
+try:
+    import orjson
+except ImportError:  # optional: pip install orjson
+    orjson = None
+
+
+def json_dumps(obj: Any) -> str:
+    """Compact JSON text. orjson is several times faster on large session payloads."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+class ResultCache:
+    """
+    TTL cache with single-flight coalescing.
+
+    Concurrent misses for the same key share one computation; later callers
+    within the TTL get the stored value. The computation is cancelled once
+    every caller waiting on it has been cancelled. Exceptions are never
+    cached. Entries are evicted LRU-first once max_entries or max_bytes is
+    exceeded.
+    """
+
+    def __init__(self, ttl: float = 60.0, max_entries: int = 256, max_bytes: int = 8 * 1024 * 1024,
+                 sizeof: Optional[Callable[[Any], int]] = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof  # defaults to len() of str/bytes values
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any, int]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self._waiters: Dict[asyncio.Task, int] = {}  # callers awaiting each in-flight task
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def peek(self, key: Hashable) -> Optional[Any]:
+        """Return a live cached value without computing anything (counts as a hit)."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        self.hits += 1
+        return entry[1]
+
+    async def get_or_compute(self, key: Hashable, compute: Callable[[], Awaitable[Any]]) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] >= time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return entry[1]
+            self._drop(key)
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            # run in its own task so a cancelled caller doesn't abort the
+            # computation other callers are waiting on
+            task = asyncio.ensure_future(compute())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            left = self._waiters.pop(task) - 1
+            if left:
+                self._waiters[task] = left
+            elif not task.done():
+                # the last caller is gone: stop the work (e.g. kill nmap) and
+                # let the next caller start afresh rather than join a dying task
+                del self._inflight[key]
+                task.cancel()
+
+    def _finish(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+        self._store(key, task.result())
+
+    def put(self, key: Hashable, value: Any):
+        """Store a value computed outside get_or_compute (e.g. by a streaming scan)."""
+        self._store(key, value)
+
+    def _store(self, key: Hashable, value: Any):
+        if self.sizeof is not None:
+            size = self.sizeof(value)
+        else:
+            size = len(value) if isinstance(value, (str, bytes)) else 0
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._drop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _drop(self, key: Hashable):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def invalidate(self, predicate: Optional[Callable[[Hashable], bool]] = None) -> int:
+        """Drop every entry (or only those whose key matches predicate). Returns the count."""
+        keys = [k for k in self._entries if predicate is None or predicate(k)]
+        for k in keys:
+            self._drop(k)
+        return len(keys)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "ttl": self.ttl,
+        }
+
+
+# ---------------- directory listing ----------------
+# (name, is_dir, size); size is None for anything that is not a regular file
+DirEntry = Tuple[str, bool, Optional[int]]
+
+
+def scan_directory(path: str) -> List[DirEntry]:
+    """Blocking: one scandir pass plus a stat per file, sorted by name."""
+    entries = []
+    with os.scandir(path) as it:
+        for e in it:
+            try:
+                is_dir = e.is_dir()
+                size = e.stat().st_size if not is_dir and e.is_file() else None
+            except OSError:  # removed while we were listing
+                continue
+            entries.append((e.name, is_dir, size))
+    # One list.sort() of a huge directory holds the GIL (and so stalls the
+    # event loop) for its whole run; sorted chunks merged in Python don't.
+    chunks = [sorted(entries[i:i + 8192]) for i in range(0, len(entries), 8192)]
+    return list(heapq.merge(*chunks)) if len(chunks) > 1 else (chunks[0] if chunks else [])
+
+
+class DirectoryLister:
+    """
+    Paginated directory listings. Scans run in a small thread pool, never on
+    the event loop, and are cached by (real path, directory mtime): adding,
+    removing or renaming an entry changes the directory's mtime and so the
+    key, while repeated listings of an unchanged directory are served from
+    memory. File sizes are as of the scan. A directory modified within the
+    last RACY_SECONDS is always rescanned, since a change in the same mtime
+    tick would otherwise go unnoticed.
+
+    Pages are cursor based: the cursor is the last name of the previous page,
+    so paging stays consistent when entries come and go in between.
+    """
+
+    RACY_SECONDS = 2.0
+
+    def __init__(self, workers: int = 4, max_dirs: int = 64, max_bytes: int = 64 * 1024 * 1024, ttl: float = 3600):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ls")
+        # value: (names, entries); ~100 bytes per entry in memory
+        self.cache = ResultCache(ttl=ttl, max_entries=max_dirs, max_bytes=max_bytes,
+                                 sizeof=lambda v: 100 * len(v[1]))
+        self.rescans = 0
+
+    def _scan(self, path: str) -> Tuple[List[str], List[DirEntry]]:
+        entries = scan_directory(path)
+        return [e[0] for e in entries], entries
+
+    async def page(self, path: str, cursor: Optional[str] = None, limit: int = 1000) -> Dict[str, Any]:
+        """
+        {"path", "entries": [(name, is_dir, size), ...], "total", "next"}; "next"
+        is the cursor of the following page or None. Raises OSError
+        (FileNotFoundError, NotADirectoryError, PermissionError).
+        """
+        loop = asyncio.get_running_loop()
+        real = os.path.realpath(path)
+        st = await loop.run_in_executor(self.pool, os.stat, real)
+        if not stat.S_ISDIR(st.st_mode):
+            raise NotADirectoryError(path)
+        if time.time() - st.st_mtime < self.RACY_SECONDS:
+            self.rescans += 1
+            names, entries = await loop.run_in_executor(self.pool, self._scan, real)
+        else:
+            names, entries = await self.cache.get_or_compute(
+                (real, st.st_ino, st.st_mtime_ns), lambda: loop.run_in_executor(self.pool, self._scan, real))
+        start = bisect.bisect_right(names, cursor) if cursor else 0
+        page = entries[start:start + limit]
+        more = start + limit < len(entries)
+        return {"path": path, "entries": page, "total": len(entries),
+                "next": page[-1][0] if more and page else None}
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self.cache.stats(), "rescans": self.rescans}
+
+
+# ---------------- nmap XML ----------------
+class NmapError(Exception):
+    """nmap could not produce a result; the message is returned to the client."""
+
+
+class Port:
+    __slots__ = ("port", "proto", "state", "reason", "service", "product", "version")
+
+    def __init__(self, port: int, proto: str, state: str, reason: str = "",
+                 service: str = "", product: str = "", version: str = ""):
+        self.port = port
+        self.proto = proto
+        self.state = state
+        self.reason = reason
+        self.service = service
+        self.product = product
+        self.version = version
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = {"port": self.port, "proto": self.proto, "state": self.state}
+        for k in ("service", "product", "version"):
+            v = getattr(self, k)
+            if v:
+                d[k] = v
+        return d
+
+
+class Host:
+    __slots__ = ("addr", "state", "hostname", "ports")
+
+    def __init__(self, addr: str, state: str, hostname: str = "", ports: Optional[List[Port]] = None):
+        self.addr = addr
+        self.state = state
+        self.hostname = hostname
+        self.ports = ports or []
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = {"addr": self.addr, "state": self.state, "ports": [p.to_dict() for p in self.ports]}
+        if self.hostname:
+            d["hostname"] = self.hostname
+        return d
+
+
+def parse_nmap_xml(data: bytes) -> List[Host]:
+    """Parse `nmap -oX` output into Host records, clearing each <host> element once read."""
+    hosts = []
+    try:
+        for _, elem in ET.iterparse(io.BytesIO(data), events=("end",)):
+            if elem.tag != "host":
+                continue
+            status = elem.find("status")
+            addr = elem.find("address")
+            name = elem.find("hostnames/hostname")
+            host = Host(addr.get("addr", "") if addr is not None else "",
+                        status.get("state", "") if status is not None else "",
+                        name.get("name", "") if name is not None else "")
+            for p in elem.iterfind("ports/port"):
+                st = p.find("state")
+                svc = p.find("service")
+                host.ports.append(Port(
+                    int(p.get("portid", 0)), p.get("protocol", ""),
+                    st.get("state", "") if st is not None else "",
+                    st.get("reason", "") if st is not None else "",
+                    svc.get("name", "") if svc is not None else "",
+                    svc.get("product", "") if svc is not None else "",
+                    svc.get("version", "") if svc is not None else ""))
+            hosts.append(host)
+            elem.clear()
+    except ET.ParseError as e:
+        raise NmapError(f"could not parse nmap XML: {e}\n")
+    return hosts
+
+
+def format_hosts(hosts: Sequence[Host]) -> str:
+    """Compact human-readable summary, one line per host and per port."""
+    if not hosts:
+        return "no hosts found\n"
+    lines = []
+    for h in hosts:
+        lines.append(f"{h.addr} {h.hostname} ({h.state})".replace("  ", " "))
+        for p in h.ports:
+            svc = " ".join(x for x in (p.service, p.product, p.version) if x)
+            lines.append(f"  {p.port}/{p.proto} {p.state} {svc}".rstrip())
+    return "\n".join(lines) + "\n"
+
+
+# Offline mode: when set, scans are answered from recorded `nmap -oX` files named
+# <target>-<n>.xml (":" and "/" in the target replaced by "_"). Successive scans of
+# a target replay n = 1, 2, ... in order and then keep repeating the last one.
+NMAP_REPLAY_DIR = os.environ.get("NMAP_REPLAY_DIR")
+_replay_counts: Dict[str, int] = {}
+
+
+def replay_nmap_xml(target: str) -> bytes:
+    stem = target.replace(":", "_").replace("/", "_")
+    pattern = os.path.join(NMAP_REPLAY_DIR, glob.escape(stem) + "-*.xml")
+
+    def seq(path: str) -> int:
+        n = path[:-len(".xml")].rsplit("-", 1)[1]
+        return int(n) if n.isdigit() else 0
+
+    files = sorted(glob.glob(pattern), key=seq)
+    if not files:
+        raise NmapError(f"no recorded scan for {target} in {NMAP_REPLAY_DIR}\n")
+    n = _replay_counts.get(stem, 0)
+    _replay_counts[stem] = n + 1
+    with open(files[min(n, len(files) - 1)], "rb") as f:
+        return f.read()
+
+
+# ---------------- nmap process cap ----------------
+# At most NMAP_PROCESS_CAP nmap processes run at once in this process. With
+# NMAP_SLOT_DIR set, the cap is shared by every server using that directory
+# (nmapmcpserver.py and sc.py alike) through flock'd slot files.
+NMAP_PROCESS_CAP = int(os.environ.get("NMAP_PROCESS_CAP", "4"))
+NMAP_SLOT_DIR = os.environ.get("NMAP_SLOT_DIR")
+_nmap_slots = asyncio.Semaphore(NMAP_PROCESS_CAP)
+_nmap_running = 0
+
+
+def _try_lock_slot() -> Optional[int]:
+    for i in range(NMAP_PROCESS_CAP):
+        fd = os.open(os.path.join(NMAP_SLOT_DIR, f"nmap-slot-{i}.lock"), os.O_CREAT | os.O_RDWR, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return fd
+        except OSError:
+            os.close(fd)
+    return None
+
+
+@asynccontextmanager
+async def nmap_slot() -> AsyncIterator[None]:
+    """Hold one of the NMAP_PROCESS_CAP slots while an nmap process runs."""
+    global _nmap_running
+    async with _nmap_slots:
+        fd = None
+        if NMAP_SLOT_DIR and fcntl is not None:
+            fd = _try_lock_slot()
+            while fd is None:
+                await asyncio.sleep(0.05)
+                fd = _try_lock_slot()
+        _nmap_running += 1
+        try:
+            yield
+        finally:
+            _nmap_running -= 1
+            if fd is not None:
+                os.close(fd)  # releases the flock
+
+
+def nmap_running() -> int:
+    return _nmap_running
+
+
+async def exec_nmap_xml(target: str, args: Sequence[str], timeout: float, limit: int) -> List[Host]:
+    """Run `nmap <args> -oX - <target>` and parse the result. Raises NmapError."""
+    if NMAP_REPLAY_DIR:
+        return parse_nmap_xml(replay_nmap_xml(target))
+    async with nmap_slot():
+        stdout, stderr, returncode = await _run_nmap_process(["nmap", *args, "-oX", "-", target], timeout)
+    if len(stdout) > limit:
+        raise NmapError(f"nmap output exceeded {limit} bytes\n")
+    if returncode != 0 and not stdout:
+        raise NmapError("nmap failed: " + stderr.decode("utf-8", errors="replace")[:2000])
+    return parse_nmap_xml(stdout)
+
+
+async def _run_nmap_process(cmd: List[str], timeout: float) -> Tuple[bytes, bytes, int]:
+    try:
+        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE,
+                                                    stderr=asyncio.subprocess.PIPE)
+    except FileNotFoundError:
+        raise NmapError("nmap not installed on server\n")
+    except Exception as e:
+        raise NmapError(f"nmap failed: {e}\n")
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise NmapError(f"nmap timed out after {timeout}s\n")
+    except asyncio.CancelledError:
+        proc.kill()  # cancelled job or client: don't leave nmap running
+        await proc.wait()
+        raise
+    return stdout, stderr, proc.returncode
+
+
+# ---------------- target allowlist ----------------
+class NetworkIndex:
+    """
+    IPv4/IPv6 networks compiled into sorted, merged [start, end] integer
+    intervals per address family. Checking an address (or a whole network)
+    is one bisect, O(log n), however many CIDRs the allowlist has.
+    """
+
+    __slots__ = ("networks", "_starts", "_ends")
+
+    def __init__(self, networks: Iterable[Any]):
+        spans: Dict[int, List[Tuple[int, int]]] = {4: [], 6: []}
+        self.networks = 0
+        for net in networks:
+            if isinstance(net, str):
+                net = ip_network(net.strip(), strict=False)
+            spans[net.version].append((int(net.network_address), int(net.broadcast_address)))
+            self.networks += 1
+        self._starts: Dict[int, List[int]] = {}
+        self._ends: Dict[int, List[int]] = {}
+        for version, intervals in spans.items():
+            intervals.sort()
+            starts: List[int] = []
+            ends: List[int] = []
+            for lo, hi in intervals:
+                if ends and lo <= ends[-1] + 1:  # overlapping or adjacent: merge
+                    ends[-1] = max(ends[-1], hi)
+                else:
+                    starts.append(lo)
+                    ends.append(hi)
+            self._starts[version] = starts
+            self._ends[version] = ends
+
+    def covers(self, version: int, lo: int, hi: int) -> bool:
+        i = bisect.bisect_right(self._starts[version], lo) - 1
+        return i >= 0 and hi <= self._ends[version][i]
+
+    def __contains__(self, item) -> bool:
+        # an ip_address, or an ip_network that must lie entirely inside the allowlist
+        if hasattr(item, "network_address"):
+            return self.covers(item.version, int(item.network_address), int(item.broadcast_address))
+        return self.covers(item.version, int(item), int(item))
+
+    def intervals(self) -> int:
+        return len(self._starts[4]) + len(self._starts[6])
+
+
+class Allowlist:
+    """
+    Target allowlist: the static CIDRs plus, when `path` is set, one CIDR per
+    line of that file ("#" starts a comment). The file's mtime is checked at
+    most every `check_interval` seconds on lookup; when it changed, a new
+    NetworkIndex is built and swapped in. A file that fails to parse keeps
+    the previous index in place.
+    """
+
+    def __init__(self, networks: Sequence[str], path: Optional[str] = None, check_interval: float = 2.0):
+        self.static = list(networks)
+        self.path = path
+        self.check_interval = check_interval
+        self.index = NetworkIndex(self.static)
+        self.mtime: Optional[float] = None
+        self.loaded_at = time.time()
+        self.error: Optional[str] = None
+        self._next_check = 0.0
+        if path:
+            self.reload()
+
+    def _read(self) -> List[str]:
+        with open(self.path, "r", encoding="utf-8") as f:
+            lines = (line.split("#", 1)[0].strip() for line in f)
+            return [line for line in lines if line]
+
+    def reload(self) -> bool:
+        """Rebuild the index from the static CIDRs and the file. Returns False on error."""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            index = NetworkIndex(self.static + self._read())
+        except (OSError, ValueError) as e:
+            self.error = str(e)
+            return False
+        self.index, self.mtime, self.loaded_at, self.error = index, mtime, time.time(), None
+        return True
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if not self.path or now < self._next_check:
+            return
+        self._next_check = now + self.check_interval
+        try:
+            changed = os.stat(self.path).st_mtime != self.mtime
+        except OSError:
+            return
+        if changed:
+            self.reload()
+
+    def allows(self, target: str) -> bool:
+        """True if target is a single IP inside the allowlist."""
+        self._maybe_reload()
+        try:
+            ip = ip_address(target)
+        except ValueError:
+            return False
+        return ip in self.index
+
+    def allows_network(self, net) -> bool:
+        """True if every address of the ip_network net is inside the allowlist."""
+        self._maybe_reload()
+        return net in self.index
+
+    def stats(self) -> Dict[str, Any]:
+        return {"networks": self.index.networks, "intervals": self.index.intervals(),
+                "file": self.path, "loaded_at": self.loaded_at, "error": self.error}
+
+
+# ---------------- scan store ----------------
+class ScanStore:
+    """
+    SQLite store of every parsed scan, keyed by target and time and indexed
+    by port/state and service, so queries like "hosts with 443 open" or
+    "services matching ssh" don't need to re-read any nmap output. Queries
+    look at the latest scan per target; diff() compares successive scans.
+    Partial scans (a sweep with failed shards) are kept for history() but
+    skipped by both, since the hosts they miss aren't known to be down.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._pid = None
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None or self._pid != os.getpid():
+            # check_same_thread=False: callers serialize access (event loop or worker thread)
+            db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript("""
+                CREATE TABLE IF NOT EXISTS scans (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT, args TEXT, scanned_at REAL,
+                    partial INTEGER NOT NULL DEFAULT 0);
+                CREATE INDEX IF NOT EXISTS scans_target ON scans (target, id);
+                CREATE TABLE IF NOT EXISTS hosts (
+                    scan_id INTEGER, addr TEXT, state TEXT, hostname TEXT);
+                CREATE INDEX IF NOT EXISTS hosts_scan ON hosts (scan_id);
+                CREATE TABLE IF NOT EXISTS ports (
+                    scan_id INTEGER, addr TEXT, port INTEGER, proto TEXT, state TEXT,
+                    service TEXT, product TEXT, version TEXT);
+                CREATE INDEX IF NOT EXISTS ports_port ON ports (port, state);
+                CREATE INDEX IF NOT EXISTS ports_service ON ports (service);
+                CREATE INDEX IF NOT EXISTS ports_scan ON ports (scan_id);
+            """)
+            if "partial" not in {row[1] for row in db.execute("PRAGMA table_info(scans)")}:
+                db.execute("ALTER TABLE scans ADD COLUMN partial INTEGER NOT NULL DEFAULT 0")  # older files
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    def record(self, target: str, args: Iterable[str], hosts: Sequence[Host], partial: bool = False) -> int:
+        with self._conn() as db:
+            scan_id = db.execute("INSERT INTO scans (target, args, scanned_at, partial) VALUES (?, ?, ?, ?)",
+                                 (target, " ".join(args), time.time(), int(partial))).lastrowid
+            db.executemany("INSERT INTO hosts VALUES (?, ?, ?, ?)",
+                           [(scan_id, h.addr, h.state, h.hostname) for h in hosts])
+            db.executemany("INSERT INTO ports VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                           [(scan_id, h.addr, p.port, p.proto, p.state, p.service, p.product, p.version)
+                            for h in hosts for p in h.ports])
+        return scan_id
+
+    def query(self, port: Optional[int] = None, state: Optional[str] = "open",
+              service: Optional[str] = None, target: Optional[str] = None,
+              limit: int = 1000) -> List[Dict[str, Any]]:
+        """
+        Ports from the latest scan of each target. `service` matches the
+        service name or product as a case-insensitive substring.
+        """
+        sql = ["SELECT s.target, p.addr, p.port, p.proto, p.state, p.service, p.product, p.version,"
+               " s.scanned_at FROM ports p JOIN scans s ON s.id = p.scan_id"
+               " WHERE p.scan_id IN (SELECT MAX(id) FROM scans WHERE NOT partial GROUP BY target)"]
+        params: List[Any] = []
+        if port is not None:
+            sql.append("AND p.port = ?")
+            params.append(port)
+        if state:
+            sql.append("AND p.state = ?")
+            params.append(state)
+        if service:
+            sql.append("AND (p.service LIKE ? OR p.product LIKE ?)")
+            params += [f"%{service}%", f"%{service}%"]
+        if target:
+            sql.append("AND s.target = ?")
+            params.append(target)
+        sql.append("ORDER BY p.addr, p.port LIMIT ?")
+        params.append(limit)
+        keys = ("target", "addr", "port", "proto", "state", "service", "product", "version", "scanned_at")
+        return [dict(zip(keys, row)) for row in self._conn().execute(" ".join(sql), params)]
+
+    def history(self, target: str, limit: int = 50) -> List[Dict[str, Any]]:
+        rows = self._conn().execute(
+            "SELECT s.id, s.scanned_at,"
+            " (SELECT COUNT(*) FROM hosts h WHERE h.scan_id = s.id AND h.state = 'up'),"
+            " (SELECT COUNT(*) FROM ports p WHERE p.scan_id = s.id AND p.state = 'open'), s.partial"
+            " FROM scans s WHERE s.target = ? ORDER BY s.id DESC LIMIT ?", (target, limit))
+        return [{"scan_id": r[0], "scanned_at": r[1], "hosts_up": r[2], "open_ports": r[3], "partial": bool(r[4])}
+                for r in rows]
+
+    def _open_ports(self, scan_id: int) -> Dict[Tuple[str, int, str], Tuple[str, str, str]]:
+        rows = self._conn().execute(
+            "SELECT addr, port, proto, service, product, version FROM ports"
+            " WHERE scan_id = ? AND state = 'open'", (scan_id,))
+        return {(r[0], r[1], r[2]): (r[3], r[4], r[5]) for r in rows}
+
+    def _hosts_up(self, scan_id: int) -> set:
+        rows = self._conn().execute("SELECT addr FROM hosts WHERE scan_id = ? AND state = 'up'", (scan_id,))
+        return {r[0] for r in rows}
+
+    def diff(self, target: str, since: Optional[int] = None) -> Dict[str, Any]:
+        """
+        What changed between the latest complete scan of target and the
+        complete scan before it (or the scan with id `since`): opened/closed
+        ports, service version changes and hosts that came up or went down.
+        """
+        db = self._conn()
+        latest = db.execute("SELECT id, scanned_at FROM scans WHERE target = ? AND NOT partial"
+                            " ORDER BY id DESC LIMIT 1", (target,)).fetchone()
+        if latest is None:
+            return {"target": target, "error": "no complete scans recorded"}
+        if since is None:
+            base = db.execute("SELECT id, scanned_at FROM scans WHERE target = ? AND id < ? AND NOT partial"
+                              " ORDER BY id DESC LIMIT 1", (target, latest[0])).fetchone()
+        else:
+            base = db.execute("SELECT id, scanned_at, partial FROM scans WHERE target = ? AND id = ?",
+                              (target, since)).fetchone()
+            if base is None:
+                return {"target": target, "error": f"scan {since} not found for target"}
+            if base[2]:
+                return {"target": target, "error": f"scan {since} is partial (failed shards)"}
+
+        before = self._open_ports(base[0]) if base else {}
+        after = self._open_ports(latest[0])
+        up_before = self._hosts_up(base[0]) if base else set()
+        up_after = self._hosts_up(latest[0])
+
+        def port(key, svc):
+            d = {"addr": key[0], "port": key[1], "proto": key[2]}
+            d.update({k: v for k, v in zip(("service", "product", "version"), svc) if v})
+            return d
+
+        return {
+            "target": target,
+            "from_scan": base[0] if base else None,
+            "from_time": base[1] if base else None,
+            "to_scan": latest[0],
+            "to_time": latest[1],
+            "hosts_up": sorted(up_after - up_before),
+            "hosts_down": sorted(up_before - up_after),
+            "opened": [port(k, after[k]) for k in sorted(after) if k not in before],
+            "closed": [port(k, before[k]) for k in sorted(before) if k not in after],
+            "changed": [
+                {"addr": k[0], "port": k[1], "proto": k[2],
+                 "before": dict(zip(("service", "product", "version"), before[k])),
+                 "after": dict(zip(("service", "product", "version"), after[k]))}
+                for k in sorted(after) if k in before and before[k] != after[k]
+            ],
+        }
+
+
+# ---------------- rate limiting ----------------
+class TokenBucket:
+    """`rate` tokens per second, at most `burst` of them saved up."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def take(self, n: float = 1.0) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def retry_after(self, n: float = 1.0) -> float:
+        """Seconds until `n` tokens are available."""
+        return max(0.0, (n - self.tokens) / self.rate) if self.rate > 0 else float("inf")
+
+
+class AdmissionGate:
+    """
+    At most `limit` connections served at once and at most `queue` waiting
+    behind them. acquire() fails straight away when the queue is full and
+    after `timeout` seconds otherwise, so an overloaded server answers
+    "busy" quickly instead of piling up sockets.
+    """
+
+    def __init__(self, limit: int, queue: int):
+        self.limit = limit
+        self.queue = queue
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._sem = asyncio.Semaphore(limit)
+
+    async def acquire(self, timeout: float) -> bool:
+        if self._sem.locked():
+            if self.waiting >= self.queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._sem.acquire(), timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return False
+            finally:
+                self.waiting -= 1
+        else:
+            await self._sem.acquire()
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+        self._sem.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"limit": self.limit, "queue": self.queue, "active": self.active,
+                "waiting": self.waiting, "rejected": self.rejected}
+
+
+# ---------------- metrics ----------------
+# Seconds; covers a sub-millisecond ls up to a slow nmap -sV sweep.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    __slots__ = ("name", "help", "label_names", "values", "fn")
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), fn: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = {} if labels else {(): 0}
+        self.fn = fn  # read the value from elsewhere at render time instead
+
+    def inc(self, *labels: str, n: float = 1):
+        self.values[labels] = self.values.get(labels, 0) + n
+
+    def samples(self) -> Iterable[Tuple[str, float]]:
+        if self.fn is not None:
+            yield self.name, self.fn()
+            return
+        for labels, v in self.values.items():
+            yield self.name + _labels(self.label_names, labels), v
+
+
+class Gauge(Counter):
+    __slots__ = ()
+    kind = "gauge"
+
+    def set(self, value: float, *labels: str):
+        self.values[labels] = value
+
+    def dec(self, *labels: str, n: float = 1):
+        self.inc(*labels, n=-n)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. observe() is one bisect and two additions;
+    buckets are made cumulative only when rendered.
+    """
+
+    __slots__ = ("name", "help", "label_names", "buckets", "_counts", "_sums")
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, *labels: str):
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    def samples(self) -> Iterable[Tuple[str, float]]:
+        for labels, counts in self._counts.items():
+            total = 0
+            for le, n in zip(self.buckets + ("+Inf",), counts):
+                total += n
+                yield self.name + "_bucket" + _labels(self.label_names, labels, f'le="{le}"'), total
+            yield self.name + "_sum" + _labels(self.label_names, labels), self._sums[labels]
+            yield self.name + "_count" + _labels(self.label_names, labels), total
+
+
+class Metrics:
+    """Registry rendered by a /metrics endpoint in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = (), fn: Optional[Callable[[], float]] = None) -> Counter:
+        return self._add(Counter(name, help, labels, fn))
+
+    def gauge(self, name: str, help: str, labels: Sequence[str] = (), fn: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._add(Gauge(name, help, labels, fn))
+
+    def histogram(self, name: str, help: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for m in self._metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, value in m.samples():
+                lines.append(f"{name} {value!r}" if isinstance(value, float) else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# ---------------- job scheduler ----------------
+JOB_LANES = ("high", "normal", "low")
+JOB_FINAL_STATES = ("done", "failed", "cancelled")
+
+
+class Job:
+    __slots__ = ("id", "session_id", "target", "lane", "state", "submitted_at", "started_at",
+                 "finished_at", "result", "error", "task", "_changed")
+
+    def __init__(self, session_id: str, target: str, lane: str):
+        self.id = uuid.uuid4().hex[:16]
+        self.session_id = session_id
+        self.target = target
+        self.lane = lane
+        self.state = "queued"
+        self.submitted_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def _set_state(self, state: str):
+        self.state = state
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait_changed(self, timeout: Optional[float] = None) -> bool:
+        """Wait for the next state change; False on timeout."""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        d = {"id": self.id, "session_id": self.session_id, "target": self.target,
+             "priority": self.lane, "state": self.state, "submitted_at": self.submitted_at,
+             "started_at": self.started_at, "finished_at": self.finished_at}
+        if self.result is not None:
+            d["result"] = self.result
+        if self.error is not None:
+            d["error"] = self.error
+        return d
+
+
+class JobScheduler:
+    """
+    Runs submitted jobs on a fixed pool of `workers` tasks.
+
+    Lanes are served in strict priority order (high, normal, low). Within a
+    lane, sessions take turns (round robin), so one session submitting a
+    burst can't starve the others. Finished jobs are kept for polling until
+    `keep_finished` newer ones have completed.
+    """
+
+    def __init__(self, runner: Callable[[Job], Awaitable[Any]], workers: int = 4,
+                 max_queued: int = 1000, keep_finished: int = 1000):
+        self.runner = runner
+        self.workers = workers
+        self.max_queued = max_queued
+        self.keep_finished = keep_finished
+        self.jobs: Dict[str, Job] = {}
+        self._finished: Deque[str] = deque()
+        # lane -> session_id -> queued jobs; dict order is the round-robin order
+        self._lanes: Dict[str, "OrderedDict[str, Deque[Job]]"] = {lane: OrderedDict() for lane in JOB_LANES}
+        self._queued = 0
+        self._wakeup = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self._waits: Deque[float] = deque(maxlen=1000)  # recent queue wait times
+
+    def _ensure_workers(self):
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def submit(self, session_id: str, target: str, priority: str = "normal") -> Job:
+        if priority not in JOB_LANES:
+            raise ValueError(f"priority must be one of {', '.join(JOB_LANES)}")
+        if self._queued >= self.max_queued:
+            raise OverflowError("job queue is full")
+        self._ensure_workers()
+        job = Job(session_id, target, priority)
+        self.jobs[job.id] = job
+        self._lanes[priority].setdefault(session_id, deque()).append(job)
+        self._queued += 1
+        self._wakeup.set()
+        return job
+
+    def _next(self) -> Optional[Job]:
+        for lane in JOB_LANES:
+            sessions = self._lanes[lane]
+            if not sessions:
+                continue
+            session_id, queue = next(iter(sessions.items()))
+            job = queue.popleft()
+            del sessions[session_id]
+            if queue:
+                sessions[session_id] = queue  # back of the line
+            self._queued -= 1
+            return job
+        return None
+
+    async def _worker(self):
+        while True:
+            job = self._next()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            job.started_at = time.time()
+            self._waits.append(job.started_at - job.submitted_at)
+            job._set_state("running")
+            self._running += 1
+            job.task = asyncio.ensure_future(self.runner(job))
+            try:
+                job.result = await job.task
+                job._set_state("done")
+                self.completed += 1
+            except asyncio.CancelledError:
+                if not job.task.cancelled():
+                    raise  # the worker itself is being shut down
+                job._set_state("cancelled")
+                self.cancelled += 1
+            except Exception as e:
+                job.error = str(e)
+                job._set_state("failed")
+                self.failed += 1
+            finally:
+                self._running -= 1
+                job.finished_at = time.time()
+                job.task = None
+                self._retire(job)
+
+    def _retire(self, job: Job):
+        self._finished.append(job.id)
+        while len(self._finished) > self.keep_finished:
+            self.jobs.pop(self._finished.popleft(), None)
+
+    def cancel(self, job_id: str) -> Optional[Job]:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if job.state == "queued":
+            queue = self._lanes[job.lane].get(job.session_id)
+            queue.remove(job)
+            if not queue:
+                del self._lanes[job.lane][job.session_id]
+            self._queued -= 1
+            job.finished_at = time.time()
+            job._set_state("cancelled")
+            self.cancelled += 1
+            self._retire(job)
+        elif job.state == "running" and job.task is not None:
+            job.task.cancel()
+        return job
+
+    def metrics(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return {
+            "workers": self.workers,
+            "running": self._running,
+            "queued": self._queued,
+            "queued_by_lane": {lane: sum(len(q) for q in self._lanes[lane].values()) for lane in JOB_LANES},
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "wait_avg_s": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p50_s": waits[len(waits) // 2] if waits else 0.0,
+            "wait_max_s": waits[-1] if waits else 0.0,
+            "nmap_running": nmap_running(),
+            "nmap_process_cap": NMAP_PROCESS_CAP,
+        }
@@ -0,0 +1,201 @@
+"""
+One FastMCP process serving the tools of several tool modules.
+
+Each module in TOOL_MODULES is read with `ast` at startup and every function
+decorated with `@server.tool()` gets a stub with the same name, parameters,
+defaults and docstring, so clients see the full tool list immediately. The
+module itself is imported only when one of its tools is first called, so
+startup cost doesn't grow with the number of modules.
+
+host_stats reports startup time against STARTUP_BUDGET, the import time of
+every loaded module, and per-tool cold-call and warm-call timings.
+
+USAGE
+   python mcp_host.py                          (stdio, like the single-tool servers)
+   MCP_HOST_MODULES=extra_tools.py python mcp_host.py
+   MCP_HOST_EAGER=1 python mcp_host.py         (import everything at startup)
+"""
+
+import time
+
+_T0 = time.perf_counter()
+
+import ast
+import asyncio
+import importlib.util
+import inspect
+import os
+import sys
+from fastmcp import Context, FastMCP
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (path, function to call once after import, or None)
+TOOL_MODULES = {
+    "mcp_server": ("mcp_server.py", None),
+    "mcp_server2": ("mcp_server2.py", None),
+    "fastmcp_tools": ("fastmcp_tools_server/server.py", "start_background"),
+}
+# Extra module paths, os.pathsep-separated
+EXTRA_MODULES = [p for p in os.environ.get("MCP_HOST_MODULES", "").split(os.pathsep) if p]
+EAGER = os.environ.get("MCP_HOST_EAGER") == "1"
+# Seconds from the first line of this file to a registered server (interpreter
+# startup excluded); going over is reported on stderr and in host_stats.
+# Importing fastmcp and building FastMCP() alone take ~1.4 s on a slow core,
+# which every single-tool server pays as well.
+STARTUP_BUDGET = 2.0
+
+server = FastMCP()
+
+
+class ToolModule:
+    """A tool module that is imported on first use."""
+
+    def __init__(self, name, path, on_load=None):
+        self.name = name
+        self.path = path if os.path.isabs(path) else os.path.join(HERE, path)
+        self.on_load = on_load
+        self.module = None
+        self.import_seconds = None
+        self._lock = asyncio.Lock()
+
+    def _import(self):
+        t0 = time.perf_counter()
+        # the module's own imports (e.g. file_index next to it) resolve from its directory
+        directory = os.path.dirname(self.path)
+        if directory not in sys.path:
+            sys.path.insert(0, directory)
+        spec = importlib.util.spec_from_file_location(f"mcp_host_tools.{self.name}", self.path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        if self.on_load:
+            getattr(module, self.on_load)()
+        self.import_seconds = time.perf_counter() - t0
+        return module
+
+    async def load(self):
+        if self.module is None:
+            async with self._lock:
+                if self.module is None:
+                    # in a thread, so a slow import doesn't stall calls to loaded tools
+                    self.module = await asyncio.to_thread(self._import)
+        return self.module
+
+
+class ToolStats:
+    __slots__ = ("module", "calls", "cold_call_seconds", "total_seconds")
+
+    def __init__(self, module):
+        self.module = module
+        self.calls = 0
+        self.cold_call_seconds = None  # first call, including the module import if it triggered it
+        self.total_seconds = 0.0
+
+    def to_dict(self):
+        warm = self.calls - 1
+        return {
+            "module": self.module,
+            "calls": self.calls,
+            "cold_call_ms": None if self.cold_call_seconds is None else round(self.cold_call_seconds * 1000, 2),
+            "warm_call_mean_ms": round((self.total_seconds - self.cold_call_seconds) / warm * 1000, 3) if warm > 0 else None,
+        }
+
+
+MODULES = {}
+TOOLS = {}
+
+
+async def _call(module_name, tool, kwargs):
+    t0 = time.perf_counter()
+    module = await MODULES[module_name].load()
+    fn = getattr(module, tool)
+    if inspect.iscoroutinefunction(fn):
+        result = await fn(**kwargs)
+    else:
+        # sync tools run in a worker thread, as FastMCP runs them
+        result = await asyncio.to_thread(fn, **kwargs)
+    elapsed = time.perf_counter() - t0
+    stats = TOOLS[tool]
+    if stats.cold_call_seconds is None:
+        stats.cold_call_seconds = elapsed
+    stats.calls += 1
+    stats.total_seconds += elapsed
+    return result
+
+
+def _is_tool_decorator(node):
+    # @server.tool() or @server.tool
+    target = node.func if isinstance(node, ast.Call) else node
+    return isinstance(target, ast.Attribute) and target.attr == "tool"
+
+
+def _stubs(module_name, path):
+    """Yield (name, stub) for every tool in the module's source, without importing it."""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    # literal module constants, for defaults such as `limit: int = LIST_PAGE_SIZE`
+    namespace = {"Context": Context, "_call": _call}
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            try:
+                namespace[node.targets[0].id] = ast.literal_eval(node.value)
+            except ValueError:
+                pass
+    for node in tree.body:
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            continue
+        if not any(_is_tool_decorator(d) for d in node.decorator_list):
+            continue
+        returns = f" -> {ast.unparse(node.returns)}" if node.returns else ""
+        source = (f"async def {node.name}({ast.unparse(node.args)}){returns}:\n"
+                  f"    return await _call({module_name!r}, {node.name!r}, locals())\n")
+        try:
+            exec(source, namespace)
+        except Exception as e:  # an annotation or default we can't evaluate without importing
+            print(f"mcp_host: skipping {module_name}.{node.name}: {e}", file=sys.stderr)
+            continue
+        stub = namespace.pop(node.name)
+        stub.__doc__ = ast.get_docstring(node)
+        yield node.name, stub
+
+
+def register(module_name, path, on_load=None):
+    module = MODULES[module_name] = ToolModule(module_name, path, on_load)
+    for name, stub in _stubs(module_name, module.path):
+        if name in TOOLS:
+            print(f"mcp_host: {module_name}.{name} hidden by {TOOLS[name].module}.{name}", file=sys.stderr)
+            continue
+        TOOLS[name] = ToolStats(module_name)
+        server.tool()(stub)
+
+
+@server.tool()
+def host_stats() -> dict:
+    """
+    Startup time of this host, import time of each tool module (null until
+    first used) and cold/warm call timings of each tool.
+    """
+    return {
+        "startup_ms": round(STARTUP_SECONDS * 1000, 1),
+        "startup_budget_ms": STARTUP_BUDGET * 1000,
+        "modules": {name: {"path": m.path, "imported": m.module is not None,
+                           "import_ms": None if m.import_seconds is None else round(m.import_seconds * 1000, 1)}
+                    for name, m in MODULES.items()},
+        "tools": {name: stats.to_dict() for name, stats in TOOLS.items()},
+    }
+
+
+for _name, (_path, _on_load) in TOOL_MODULES.items():
+    register(_name, _path, _on_load)
+for _path in EXTRA_MODULES:
+    register(os.path.splitext(os.path.basename(_path))[0], _path)
+if EAGER:
+    for _module in MODULES.values():
+        _module.module = _module._import()
+
+STARTUP_SECONDS = time.perf_counter() - _T0
+if STARTUP_SECONDS > STARTUP_BUDGET:
+    print(f"mcp_host: startup took {STARTUP_SECONDS:.2f} s, over the {STARTUP_BUDGET} s budget", file=sys.stderr)
+
+if __name__ == "__main__":
+    server.run()
@@ -4,10 +4,27 @@ MCP (Model Context Protocol) Server - Python
 Features:
 - HTTP JSON MCP endpoint (/mcp) for request/response model interactions
 - WebSocket MCP endpoint (/mcp/ws) for streaming/multiplexed sessions
-- In-memory session store with configurable max context tokens per session
-- Tool integrations: directory listing and nmap (whitelisted targets/paths)
-- Simple "LLM" adapter placeholder (echo / system injection) — replace with real model call
-- Safety: strict ALLOWED_TARGETS and ALLOWED_PATHS; timeouts and output limits
+- In-memory session store with configurable max context tokens per session,
+  LRU/idle-TTL eviction under a memory budget and spill of cold sessions to SQLite
+- Tool integrations: directory listing (paginated at GET /ls, off the event loop,
+  cached by directory mtime) and nmap (whitelisted targets/paths), run
+  concurrently per request under per-tool-type limits (TOOL_CONCURRENCY)
+- Simple "LLM" adapter placeholder (echo / system injection) — replace with real model call;
+  the adapter streams chunks (SSE on /mcp, chunk frames on /mcp/ws)
+- nmap result cache with TTL and single-flight dedupe of identical concurrent scans
+- nmap runs with XML output; results are parsed into compact host/port records,
+  stored in SQLite and queryable at /scans/query (e.g. ?port=443 or ?service=ssh);
+  /scans/diff?target=... returns only what changed since the previous scan
+- Offline mode: NMAP_REPLAY_DIR=fixtures/nmap replays recorded nmap XML instead of scanning
+- Scan jobs: POST /jobs, GET /jobs/{id} (poll or ?stream=true), DELETE /jobs/{id},
+  GET /jobs/metrics; priority lanes, per-session fair share and a worker cap.
+  NMAP_PROCESS_CAP bounds running nmap processes (shared with sc.py via NMAP_SLOT_DIR)
+- Sweeps: POST /sweep or the "sweep:<cidr>" tool scan an allowlisted CIDR range as
+  shards run in parallel, stream per-shard progress and merge them into one report
+- GET /metrics (Prometheus text): latency histograms for HTTP routes, WebSocket
+  instructions, tools, nmap processes and the model, plus session/truncation counters
+- Safety: strict ALLOWED_TARGETS and ALLOWED_PATHS; timeouts and output limits.
+  NMAP_ALLOWLIST_FILE adds CIDRs from a file, reloaded when it changes (GET /allowlist)
 
 WARNING: This server can run system commands (nmap). Only run in safe/test environments and
 configure ALLOWED_TARGETS carefully. Do NOT expose to untrusted networks without auth and rate-limiting.
@@ -17,7 +34,10 @@ Dependencies:
     (nmap binary must be installed for nmap tool)
 
 Run:
-    uvicorn mcp_server:app --host 0.0.0.0 --port 8080
+    uvicorn nmapmcpserver:app --host 0.0.0.0 --port 8080
+
+    Several workers must share sessions through the SQLite backend:
+    MCP_SESSION_BACKEND=sqlite uvicorn nmapmcpserver:app --workers 4 --port 8080
 
 API examples:
 POST /mcp
@@ -28,83 +48,701 @@ POST /mcp
   "max_tokens": 1024
 }
 
+Every payload's "session" carries a "cursor". Send it back as "cursor" (or
+GET /session/{id}?since=<cursor>) to get only the messages added after it:
+{"since": ..., "messages": [...], "first_seq": ..., "cursor": ...}
+
+GET /sessions?limit=100[&after=<session id>] lists sessions as NDJSON; the
+X-Next-After response header is the `after` of the next page.
+
+POST /mcp with "stream": true answers as Server-Sent Events:
+event: tool / event: token {"delta": ...} / event: done {<MCPResponse>}
+
 WebSocket /mcp/ws
 Send/receive JSON messages for low-latency streaming.
+{"session_id": "sess1"}                                    first message
+{"instruction": "scan", "tools": ["nmap:127.0.0.1"], "stream": true}
+    -> {"type": "tool_chunk", "index": 0, "tool": "nmap:127.0.0.1", "data": "..."} ...
+    -> {"type": "chunk", "delta": "..."} ...                  reply tokens as generated
+    -> {"type": "reply", ...}
+{"type": "cancel"}                                          aborts the running instruction
+Frames go through a bounded per-connection queue (WS_SEND_QUEUE, WS_OVERFLOW_POLICY);
+instructions over WS_RATE/WS_BURST are answered with {"type": "error", "error": "rate limited"}.
 """
 
 import asyncio
+import hashlib
+import heapq
+import itertools
 import json
 import shlex
 import os
-from typing import Dict, Any, List, Optional
+import sqlite3
+import tempfile
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, AsyncGenerator, Awaitable, Callable, Deque, Dict, Iterable, Iterator, List, Optional
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from ipaddress import ip_address, ip_network
 import subprocess
 
+import mcp_common
+from mcp_common import (JOB_FINAL_STATES, PROMETHEUS_CONTENT_TYPE, Allowlist, DirectoryLister, Host, Job, JobScheduler,
+                        Metrics, NmapError, ResultCache, ScanStore, TokenBucket, exec_nmap_xml, format_hosts,
+                        json_dumps, nmap_slot, parse_nmap_xml)
+
 # ---------------- Configuration ----------------
 ALLOWED_TARGETS = ["127.0.0.1/32", "::1/128"]  # CIDR ranges for nmap
+ALLOWLIST_FILE = os.environ.get("NMAP_ALLOWLIST_FILE")  # more CIDRs, one per line, reloaded on change
 ALLOWED_PATHS = ["/tmp", "/var/www", "."]    # directories allowed for listing
 MAX_CONTEXT_TOKENS = 16384
+SYSTEM_PROMPT = "You are MCP assistant. Keep replies short."
 NMAP_OUTPUT_LIMIT = 200_000
+NMAP_XML_LIMIT = 5_000_000  # raw XML accepted from one scan before parsing
+SCAN_DB_PATH = "mcp_scans.db"  # parsed scan results, queried via /scans/query
 SUBPROCESS_TIMEOUT = 25
+NMAP_CACHE_TTL = 60                       # seconds a scan result is reused
+NMAP_CACHE_ENTRIES = 256
+NMAP_CACHE_BYTES = 32 * 1024 * 1024
+TOOL_CONCURRENCY = {"nmap": 4, "ls": 8, "sweep": 2}  # max concurrent runs per tool type, server-wide
+LS_PAGE_SIZE = 1000       # entries per directory listing page
+LS_CACHE_DIRS = 64        # directory listings kept, validated by directory mtime
+SWEEP_MAX_ADDRESSES = 4096  # largest CIDR range accepted for a sweep
+SWEEP_SHARD_SIZE = 16       # addresses per nmap process in a sweep (power of two)
+SWEEP_PARALLEL = 3          # shards of one sweep in flight; leaves NMAP_PROCESS_CAP room for others
+SWEEP_SHARD_TIMEOUT = 120
+JOB_WORKERS = 4          # scan jobs run concurrently (nmap itself is capped by NMAP_PROCESS_CAP)
+JOB_MAX_QUEUED = 1000
+WS_SEND_QUEUE = 256              # outbound frames buffered per WebSocket
+WS_OVERFLOW_POLICY = "coalesce"  # full queue: "drop" | "coalesce" stream frames, or "disconnect"
+WS_FLUSH_TIMEOUT = 2.0           # seconds spent flushing queued frames on close
+WS_RATE = float(os.environ.get("MCP_WS_RATE", "5"))  # instructions per second per WebSocket (token bucket)
+WS_BURST = 10
+WS_MAX_PENDING = 8               # instructions queued behind the running one
+# per-token delay of the placeholder model (seconds), for offline streaming benchmarks
+LLM_FAKE_TOKEN_LATENCY = float(os.environ.get("MCP_FAKE_TOKEN_LATENCY", "0"))
+SESSION_MEMORY_BUDGET = 64 * 1024 * 1024  # approx bytes of history kept in RAM
+SESSION_IDLE_TTL = 1800                   # seconds before an idle session is spilled
+SESSION_SPILL_PATH = "mcp_sessions.db"    # SQLite file holding cold sessions
+# "memory" keeps sessions in this process; "sqlite" shares them between
+# uvicorn workers through SESSION_DB_PATH (set via environment for --workers N)
+SESSION_BACKEND = os.environ.get("MCP_SESSION_BACKEND", "memory")
+SESSION_DB_PATH = os.environ.get("MCP_SESSION_DB", "mcp_shared_sessions.db")
+SESSION_PAGE_SIZE = 100  # default page of the /sessions NDJSON listing
 
 # Simple token counting heuristic (not exact tokens)
 def count_tokens(text: str) -> int:
     return max(1, len(text.split()))
 
-# Pre-parse allowed networks
-ALLOWED_NETWORKS = [ip_network(x) for x in ALLOWED_TARGETS]
+# Allowed networks compiled into an O(log n) index
+ALLOWLIST = Allowlist(ALLOWED_TARGETS, ALLOWLIST_FILE)
+
+# Identical scans within NMAP_CACHE_TTL share one nmap process
+NMAP_CACHE = ResultCache(ttl=NMAP_CACHE_TTL, max_entries=NMAP_CACHE_ENTRIES, max_bytes=NMAP_CACHE_BYTES,
+                         sizeof=lambda r: 2 * len(r["summary"]))
+
+SCAN_STORE = ScanStore(SCAN_DB_PATH)
+
+# Directory listings run in their own thread pool and are cached by mtime
+LISTER = DirectoryLister(workers=TOOL_CONCURRENCY["ls"], max_dirs=LS_CACHE_DIRS)
+
+# Instrumentation, exported at /metrics. Durations use the monotonic perf_counter.
+METRICS = Metrics()
+HTTP_SECONDS = METRICS.histogram("mcp_http_request_seconds", "HTTP request latency (streams: until the last byte)",
+                                 ("route", "method", "status"))
+WS_SECONDS = METRICS.histogram("mcp_ws_instruction_seconds", "WebSocket instruction latency", ("outcome",))
+TOOL_SECONDS = METRICS.histogram("mcp_tool_seconds", "Tool run latency, cache hits included", ("tool",))
+NMAP_SECONDS = METRICS.histogram("mcp_nmap_process_seconds", "Wall time of nmap processes actually started")
+LLM_SECONDS = METRICS.histogram("mcp_llm_seconds", "Time to generate one reply")
+SESSIONS_CREATED = METRICS.counter("mcp_sessions_created_total", "Sessions created")
+SESSION_EVICTIONS = METRICS.counter("mcp_session_evictions_total", "Sessions spilled out of memory")
+HISTORY_TRUNCATIONS = METRICS.counter("mcp_history_truncations_total", "Messages dropped to fit the token budget")
+OUTPUT_TRUNCATIONS = METRICS.counter("mcp_nmap_output_truncations_total", "Streamed nmap outputs cut at NMAP_OUTPUT_LIMIT")
+METRICS.counter("mcp_nmap_cache_hits_total", "nmap results served from NMAP_CACHE", fn=lambda: NMAP_CACHE.hits)
+METRICS.counter("mcp_nmap_cache_coalesced_total", "Scans that joined an identical in-flight scan",
+                fn=lambda: NMAP_CACHE.coalesced)
+METRICS.gauge("mcp_nmap_running", "nmap processes running in this process", fn=mcp_common.nmap_running)
 
 # ---------------- Session Store ----------------
+class Message:
+    """
+    One history entry. The token count is computed once, on creation. `seq`
+    increases with every message of a session and serves as the cursor for
+    delta responses (to_dict(since=...)).
+    """
+    __slots__ = ("role", "content", "tokens", "seq")
+
+    def __init__(self, role: str, content: str, tokens: Optional[int] = None, seq: int = 0):
+        self.role = role
+        self.content = content
+        self.tokens = count_tokens(content) if tokens is None else tokens
+        self.seq = seq
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"role": self.role, "content": self.content}
+
+MESSAGE_OVERHEAD = 120  # rough per-message bytes beyond the content itself
+
+class PromptBuffer:
+    """
+    Incrementally maintained prompt state for one session.
+
+    Every append extends a chained digest of the session's messages in
+    O(len(message)) and keeps it next to the message, so a model backend can
+    remember the fingerprint it last processed and ask only for the messages
+    added since (suffix_since), e.g. to reuse its KV/prefix cache. A
+    fingerprint names the window (the digest before its first message) and
+    its end; trimming the oldest message just moves the window start in
+    O(1). Fingerprints taken before a trim no longer match, as that prefix
+    is gone.
+    """
+
+    def __init__(self, history: Deque[Message], system_prompt: str = SYSTEM_PROMPT):
+        self.history = history
+        self.system_prompt = system_prompt
+        self._base = hashlib.blake2b(system_prompt.encode(), digest_size=16).digest()  # before the window
+        self._digests: Deque[bytes] = deque()  # chained digest after each message, aligned with history
+        self._positions: Dict[bytes, int] = {self._base: 0}  # digest -> messages pushed so far
+        self._count = 0
+
+    def push(self, msg: Message):
+        h = hashlib.blake2b(self._digests[-1] if self._digests else self._base, digest_size=16)
+        h.update(msg.role.encode())
+        h.update(b"\0")
+        h.update(msg.content.encode())
+        digest = h.digest()
+        self._digests.append(digest)
+        self._count += 1
+        self._positions[digest] = self._count
+
+    def drop_oldest(self):
+        """The oldest message left the history."""
+        del self._positions[self._base]
+        self._base = self._digests.popleft()
+
+    @property
+    def fingerprint(self) -> str:
+        return self._base.hex() + (self._digests[-1] if self._digests else self._base).hex()
+
+    def suffix_since(self, fingerprint: Optional[str]) -> Optional[List[Message]]:
+        """Messages appended after `fingerprint`, or None if that prefix is gone."""
+        if fingerprint is None or fingerprint[:32] != self._base.hex():
+            return None
+        pos = self._positions.get(bytes.fromhex(fingerprint[32:]))
+        if pos is None:
+            return None
+        new = list(itertools.islice(reversed(self.history), self._count - pos))
+        new.reverse()
+        return new
+
+    def render(self) -> str:
+        """Full prompt text, for backends without prefix caching."""
+        parts = [self.system_prompt]
+        parts.extend(f"{m.role}: {m.content}" for m in self.history)
+        return "\n".join(parts)
+
 class Session:
     def __init__(self, session_id: str, max_tokens: int = MAX_CONTEXT_TOKENS):
         self.session_id = session_id
-        self.history: List[Dict[str, Any]] = []  # list of {role, content}
+        self.history: Deque[Message] = deque()  # oldest first
         self.max_tokens = max_tokens
         self.token_count = 0
+        self.seq = 0             # seq of the last message appended
+        self.nbytes = 0          # approximate memory held by history
+        self.last_access = time.monotonic()
+        self.pins = 0            # handlers currently using this session
+        self._store: Optional["SessionStore"] = None
+        self.prompt = PromptBuffer(self.history)
 
     def append(self, role: str, content: str):
-        t = count_tokens(content)
-        self.history.append({"role": role, "content": content})
-        self.token_count += t
-        # truncate if over budget (simple drop oldest)
+        self.seq += 1
+        msg = Message(role, content, seq=self.seq)
+        self.history.append(msg)
+        self.prompt.push(msg)
+        self.token_count += msg.tokens
+        delta = len(content) + MESSAGE_OVERHEAD
+        # truncate if over budget (drop oldest, O(1) per eviction)
         while self.token_count > self.max_tokens and self.history:
-            removed = self.history.pop(0)
-            self.token_count -= count_tokens(removed.get("content", ""))
+            removed = self.history.popleft()
+            self.token_count -= removed.tokens
+            delta -= len(removed.content) + MESSAGE_OVERHEAD
+            self.prompt.drop_oldest()
+            HISTORY_TRUNCATIONS.inc()
+        self.nbytes += delta
+        if self._store is not None:
+            self._store._resized(delta)
+
+    def messages_since(self, since: int) -> List[Message]:
+        new = list(itertools.takewhile(lambda m: m.seq > since, reversed(self.history)))
+        new.reverse()
+        return new
+
+    def first_seq(self) -> int:
+        return self.history[0].seq if self.history else self.seq + 1
+
+    def to_dict(self, since: Optional[int] = None) -> Dict[str, Any]:
+        """
+        The whole session, or with `since` (the "cursor" of an earlier payload)
+        only the messages added after it. Clients drop cached messages older
+        than "first_seq": those were trimmed off the history.
+        """
+        if since is None:
+            return {
+                "session_id": self.session_id,
+                "history": [m.to_dict() for m in self.history],
+                "token_count": self.token_count,
+                "cursor": self.seq,
+            }
+        return {
+            "session_id": self.session_id,
+            "since": since,
+            "messages": [m.to_dict() for m in self.messages_since(since)],
+            "first_seq": self.first_seq(),
+            "token_count": self.token_count,
+            "cursor": self.seq,
+        }
+
+    def dump_history(self) -> str:
+        return json_dumps([[m.role, m.content, m.tokens, m.seq] for m in self.history])
+
+    def load_history(self, data: str):
+        for i, entry in enumerate(json.loads(data), 1):
+            role, content, tokens = entry[:3]
+            seq = entry[3] if len(entry) > 3 else i  # spilled before messages had a seq
+            msg = Message(role, content, tokens, seq)
+            self.history.append(msg)
+            self.prompt.push(msg)
+            self.token_count += tokens
+            self.nbytes += len(content) + MESSAGE_OVERHEAD
+            self.seq = seq
+
+class SessionBackend:
+    """
+    Interface for session storage. Handlers only go through use(), get(),
+    session_ids(), iter_dicts() and stats(), so backends may return Session
+    subclasses.
+    """
 
-    def to_dict(self):
-        return {"session_id": self.session_id, "history": self.history, "token_count": self.token_count}
+    def get(self, session_id: str) -> Optional[Session]:
+        raise NotImplementedError
 
-SESSIONS: Dict[str, Session] = {}
+    def use(self, session_id: str, max_tokens: int = MAX_CONTEXT_TOKENS):
+        raise NotImplementedError
+
+    def session_ids(self, after: Optional[str] = None, limit: int = SESSION_PAGE_SIZE) -> List[str]:
+        """Up to `limit` session ids greater than `after`, sorted."""
+        raise NotImplementedError
+
+    def iter_dicts(self, session_ids: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """to_dict() of the given sessions, skipping unknown ids."""
+        raise NotImplementedError
+
+    def stats(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+class SessionStore(SessionBackend):
+    """
+    In-process LRU session store with a memory budget and an idle TTL.
+
+    Sessions that go idle or fall out of the budget are spilled to SQLite and
+    loaded back lazily the next time they are looked up. Sessions pinned by a
+    running handler (see use()) are never evicted.
+    """
+
+    def __init__(self, memory_budget: int = SESSION_MEMORY_BUDGET,
+                 idle_ttl: float = SESSION_IDLE_TTL, spill_path: str = SESSION_SPILL_PATH):
+        self.memory_budget = memory_budget
+        self.idle_ttl = idle_ttl
+        self.spill_path = spill_path
+        self._resident: "OrderedDict[str, Session]" = OrderedDict()
+        self._bytes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.loads = 0
+
+    # -- spill file --
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self.spill_path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY, max_tokens INTEGER, history TEXT)")
+        return self._db
+
+    def _spill(self, session: Session):
+        with self._conn() as db:
+            db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                       (session.session_id, session.max_tokens, session.dump_history()))
+
+    def _load(self, session_id: str) -> Optional[Session]:
+        if self._db is None and not os.path.exists(self.spill_path):
+            return None
+        with self._conn() as db:
+            row = db.execute("SELECT max_tokens, history FROM sessions WHERE session_id = ?",
+                             (session_id,)).fetchone()
+            if row is None:
+                return None
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        session = Session(session_id, max_tokens=row[0])
+        session.load_history(row[1])
+        return session
+
+    # -- residency --
+    def _resized(self, delta: int):
+        self._bytes += delta
+
+    def _admit(self, session: Session):
+        session._store = self
+        self._resident[session.session_id] = session
+        self._bytes += session.nbytes
+
+    def _evict(self, session: Session):
+        del self._resident[session.session_id]
+        self._bytes -= session.nbytes
+        session._store = None
+        self._spill(session)
+        self.evictions += 1
+        SESSION_EVICTIONS.inc()
+
+    def _enforce(self):
+        if not self._resident:
+            return
+        cutoff = time.monotonic() - self.idle_ttl
+        # O(1) on the common path: nothing to do unless over budget or the
+        # least recently used session has gone idle
+        if self._bytes <= self.memory_budget and next(iter(self._resident.values())).last_access >= cutoff:
+            return
+        # walk from the LRU end, only as far as needed, then evict (the dict
+        # can't change while it is iterated)
+        victims = []
+        remaining = self._bytes
+        for session in self._resident.values():
+            if remaining <= self.memory_budget and session.last_access >= cutoff:
+                break
+            if session.pins == 0:
+                victims.append(session)
+                remaining -= session.nbytes
+        for session in victims:
+            self._evict(session)
+
+    # -- public API --
+    def get(self, session_id: str, pin: bool = False) -> Optional[Session]:
+        """Look a session up; pin=True pins it before the budget is enforced, so it can't be spilled."""
+        session = self._resident.get(session_id)
+        if session is not None:
+            self.hits += 1
+            self._resident.move_to_end(session_id)
+        else:
+            self.misses += 1
+            session = self._load(session_id)
+            if session is None:
+                return None
+            self.loads += 1
+            self._admit(session)
+        session.last_access = time.monotonic()
+        if pin:
+            session.pins += 1
+        self._enforce()
+        return session
+
+    def get_or_create(self, session_id: str, max_tokens: int = MAX_CONTEXT_TOKENS, pin: bool = False) -> Session:
+        session = self.get(session_id, pin)
+        if session is None:
+            session = Session(session_id, max_tokens=max_tokens)
+            SESSIONS_CREATED.inc()
+            if pin:
+                session.pins += 1
+            self._admit(session)
+            self._enforce()
+        return session
+
+    @contextmanager
+    def use(self, session_id: str, max_tokens: int = MAX_CONTEXT_TOKENS) -> Iterator[Session]:
+        """Get or create a session and pin it in memory for the duration of the block."""
+        # pinned before the budget is enforced: a session larger than the
+        # budget must not be spilled and handed out detached from the store
+        session = self.get_or_create(session_id, max_tokens, pin=True)
+        try:
+            yield session
+        finally:
+            session.pins -= 1
+            session.last_access = time.monotonic()
+            self._enforce()
+
+    def _has_spill(self) -> bool:
+        return self._db is not None or os.path.exists(self.spill_path)
+
+    def session_ids(self, after: Optional[str] = None, limit: int = SESSION_PAGE_SIZE) -> List[str]:
+        after = after or ""
+        resident = heapq.nsmallest(limit, (sid for sid in self._resident if sid > after))
+        spilled = []
+        if self._has_spill():
+            spilled = [sid for (sid,) in self._conn().execute(
+                "SELECT session_id FROM sessions WHERE session_id > ? ORDER BY session_id LIMIT ?",
+                (after, limit))]
+        return list(heapq.merge(resident, spilled))[:limit]
+
+    def iter_dicts(self, session_ids: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        """Resident sessions as they are; spilled ones straight from SQLite, without loading them."""
+        for sid in session_ids:
+            session = self._resident.get(sid)
+            if session is not None:
+                yield session.to_dict()
+                continue
+            if not self._has_spill():
+                continue
+            row = self._conn().execute("SELECT history FROM sessions WHERE session_id = ?", (sid,)).fetchone()
+            if row is None:
+                continue
+            msgs = json.loads(row[0])
+            yield {
+                "session_id": sid,
+                "history": [{"role": m[0], "content": m[1]} for m in msgs],
+                "token_count": sum(m[2] for m in msgs),
+                "cursor": msgs[-1][3] if msgs and len(msgs[-1]) > 3 else len(msgs),
+            }
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": "memory",
+            "resident": len(self._resident),
+            "resident_bytes": self._bytes,
+            "memory_budget": self.memory_budget,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "loads": self.loads,
+        }
+
+class SharedSession(Session):
+    """
+    Session whose history lives in SQLite. append() inserts and trims inside
+    one IMMEDIATE transaction, so concurrent workers never interleave a trim.
+    """
+
+    def __init__(self, backend: "SQLiteSessionBackend", session_id: str, max_tokens: int):
+        # no super().__init__: history and token_count are read from the database
+        self._backend = backend
+        self.session_id = session_id
+        self.max_tokens = max_tokens
+
+    # message ids are global but increase within a session, so they serve as seq
+    @property
+    def history(self) -> Deque[Message]:
+        rows = self._backend._conn().execute(
+            "SELECT role, content, tokens, id FROM messages WHERE session_id = ? ORDER BY id",
+            (self.session_id,))
+        return deque(Message(r, c, t, i) for r, c, t, i in rows)
+
+    @property
+    def seq(self) -> int:
+        return self._backend._conn().execute(
+            "SELECT COALESCE(MAX(id), 0) FROM messages WHERE session_id = ?", (self.session_id,)).fetchone()[0]
+
+    def messages_since(self, since: int) -> List[Message]:
+        rows = self._backend._conn().execute(
+            "SELECT role, content, tokens, id FROM messages WHERE session_id = ? AND id > ? ORDER BY id",
+            (self.session_id, since))
+        return [Message(r, c, t, i) for r, c, t, i in rows]
+
+    def first_seq(self) -> int:
+        row = self._backend._conn().execute(
+            "SELECT MIN(id) FROM messages WHERE session_id = ?", (self.session_id,)).fetchone()
+        return row[0] if row[0] is not None else self.seq + 1
+
+    @property
+    def prompt(self) -> PromptBuffer:
+        # history lives in another process's reach, so build it fresh each turn
+        history = self.history
+        prompt = PromptBuffer(history)
+        for msg in history:
+            prompt.push(msg)
+        return prompt
+
+    def to_dict(self, since: Optional[int] = None) -> Dict[str, Any]:
+        # history, token_count and cursor from one snapshot, not interleaved with other workers' appends
+        with self._backend._snapshot():
+            return super().to_dict(since)
+
+    @property
+    def token_count(self) -> int:
+        row = self._backend._conn().execute(
+            "SELECT token_count FROM sessions WHERE session_id = ?", (self.session_id,)).fetchone()
+        return row[0] if row else 0
+
+    def append(self, role: str, content: str):
+        msg = Message(role, content)
+        with self._backend._transaction() as db:
+            db.execute("INSERT INTO messages (session_id, role, content, tokens) VALUES (?, ?, ?, ?)",
+                       (self.session_id, role, content, msg.tokens))
+            db.execute("UPDATE sessions SET token_count = token_count + ? WHERE session_id = ?",
+                       (msg.tokens, self.session_id))
+            total, limit = db.execute("SELECT token_count, max_tokens FROM sessions WHERE session_id = ?",
+                                      (self.session_id,)).fetchone()
+            if total <= limit:
+                return
+            # drop oldest messages until back under budget
+            cutoff = None
+            for mid, tokens in db.execute(
+                    "SELECT id, tokens FROM messages WHERE session_id = ? ORDER BY id",
+                    (self.session_id,)).fetchall():
+                if total <= limit:
+                    break
+                total -= tokens
+                cutoff = mid
+            dropped = db.execute("DELETE FROM messages WHERE session_id = ? AND id <= ?",
+                                 (self.session_id, cutoff)).rowcount
+            db.execute("UPDATE sessions SET token_count = ? WHERE session_id = ?", (total, self.session_id))
+        HISTORY_TRUNCATIONS.inc(n=dropped)
+
+class SQLiteSessionBackend(SessionBackend):
+    """
+    Session backend shared by every process that opens the same SQLite file
+    (WAL mode), e.g. all workers of `uvicorn nmapmcpserver:app --workers N`.
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._pid = None
+
+    def _conn(self) -> sqlite3.Connection:
+        # one connection per process; never reuse a handle inherited over fork
+        if self._db is None or self._pid != os.getpid():
+            db = sqlite3.connect(self.path, isolation_level=None, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY, max_tokens INTEGER, token_count INTEGER DEFAULT 0)")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT,"
+                " role TEXT, content TEXT, tokens INTEGER)")
+            db.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+            self._db, self._pid = db, os.getpid()
+        return self._db
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    @contextmanager
+    def _snapshot(self) -> Iterator[sqlite3.Connection]:
+        """Read transaction: every query inside sees the same WAL snapshot."""
+        db = self._conn()
+        db.execute("BEGIN")
+        try:
+            yield db
+        finally:
+            db.execute("COMMIT")
+
+    def get(self, session_id: str) -> Optional[Session]:
+        row = self._conn().execute(
+            "SELECT max_tokens FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        return SharedSession(self, session_id, row[0]) if row else None
+
+    @contextmanager
+    def use(self, session_id: str, max_tokens: int = MAX_CONTEXT_TOKENS) -> Iterator[Session]:
+        with self._transaction() as db:
+            db.execute("INSERT OR IGNORE INTO sessions (session_id, max_tokens) VALUES (?, ?)",
+                       (session_id, max_tokens))
+            max_tokens = db.execute("SELECT max_tokens FROM sessions WHERE session_id = ?",
+                                    (session_id,)).fetchone()[0]
+        yield SharedSession(self, session_id, max_tokens)
+
+    def session_ids(self, after: Optional[str] = None, limit: int = SESSION_PAGE_SIZE) -> List[str]:
+        return [sid for (sid,) in self._conn().execute(
+            "SELECT session_id FROM sessions WHERE session_id > ? ORDER BY session_id LIMIT ?",
+            (after or "", limit))]
+
+    def iter_dicts(self, session_ids: Iterable[str]) -> Iterator[Dict[str, Any]]:
+        for sid in session_ids:
+            session = self.get(sid)
+            if session is not None:
+                yield session.to_dict()
+
+    def stats(self) -> Dict[str, Any]:
+        db = self._conn()
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "sessions": db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0],
+            "messages": db.execute("SELECT COUNT(*) FROM messages").fetchone()[0],
+        }
+
+def make_session_backend(kind: str = SESSION_BACKEND) -> SessionBackend:
+    if kind == "memory":
+        return SessionStore()
+    if kind == "sqlite":
+        return SQLiteSessionBackend()
+    raise ValueError(f"unknown session backend: {kind}")
+
+SESSIONS = make_session_backend()
+if isinstance(SESSIONS, SessionStore):
+    METRICS.gauge("mcp_sessions_resident", "Sessions held in memory", fn=lambda: len(SESSIONS._resident))
 
 # ---------------- FastAPI app ----------------
 app = FastAPI(title="MCP Server")
 
+class MetricsMiddleware:
+    """Times every HTTP request. Plain ASGI: BaseHTTPMiddleware would add a task per request."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        t0 = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            route = scope.get("route")  # set by the router; keeps /session/{session_id} one series
+            HTTP_SECONDS.observe(time.perf_counter() - t0, route.path if route is not None else "unmatched",
+                                 scope["method"], str(status))
+
+app.add_middleware(MetricsMiddleware)
+
 # ---------------- Pydantic models ----------------
 class MCPRequest(BaseModel):
     session_id: Optional[str]
     instruction: str
     tools: Optional[List[str]] = []
     max_tokens: Optional[int] = MAX_CONTEXT_TOKENS
+    stream: Optional[bool] = False  # answer as Server-Sent Events
+    cursor: Optional[int] = None    # "session" holds only messages after this cursor
 
 class MCPResponse(BaseModel):
     session_id: str
     reply: str
     used_tools: Optional[List[str]] = []
+    tool_results: Optional[List[Dict[str, Any]]] = []
     session: Optional[Dict[str, Any]] = None
 
 # ---------------- Utility functions ----------------
 def is_target_allowed(target: str) -> bool:
-    try:
-        ip = ip_address(target)
-    except Exception:
-        return False
-    for net in ALLOWED_NETWORKS:
-        if ip in net:
-            return True
-    return False
+    return ALLOWLIST.allows(target)
 
 def is_path_allowed(path: str) -> bool:
     # Resolve and check that path is inside one of allowed roots
@@ -117,187 +755,862 @@ def is_path_allowed(path: str) -> bool:
             return True
     return False
 
-async def run_nmap(target: str) -> str:
-    if not is_target_allowed(target):
-        return f"Target not allowed: {target}\n"
-    cmd = ["nmap", "-sV", "--reason", target]
+NMAP_ARGS = ("-sV", "--reason")
+NMAP_STDERR_LIMIT = 8192  # stderr kept while streaming
+
+def _scan_result(target: str, hosts: List[Host], partial: bool = False) -> Dict[str, Any]:
+    """Persist a parsed scan and build the compact payload returned by tools."""
+    scan_id = SCAN_STORE.record(target, NMAP_ARGS, hosts, partial)
+    return {"target": target, "scan_id": scan_id,
+            "hosts": [h.to_dict() for h in hosts], "summary": format_hosts(hosts)}
+
+async def _exec_nmap(target: str) -> Dict[str, Any]:
+    t0 = time.perf_counter()
     try:
-        proc = await asyncio.create_subprocess_exec(*cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        hosts = await exec_nmap_xml(target, NMAP_ARGS, SUBPROCESS_TIMEOUT, NMAP_XML_LIMIT)
+    finally:
+        NMAP_SECONDS.observe(time.perf_counter() - t0)
+    return _scan_result(target, hosts)
+
+async def stream_nmap(target: str, result: Optional[Dict[str, Any]] = None) -> AsyncGenerator[str, None]:
+    """
+    Yield nmap's human-readable stdout line by line as it is produced, while
+    nmap writes XML to a temp file that is parsed into `result` at the end.
+    Memory stays bounded: nothing is accumulated here, output stops at
+    NMAP_OUTPUT_LIMIT bytes and the process is killed if the consumer stops
+    iterating (e.g. on cancel). Errors are yielded as a final line rather than raised;
+    output cut off at NMAP_OUTPUT_LIMIT also sets result["truncated"].
+    """
+    if result is None:
+        result = {}
+    if not is_target_allowed(target):
+        yield f"Target not allowed: {target}\n"
+        return
+    cached = NMAP_CACHE.peek((target, NMAP_ARGS))
+    if cached is not None:
+        result.update(cached)
+        yield cached["summary"]
+        return
+    if mcp_common.NMAP_REPLAY_DIR:
+        # offline mode: no live output to stream, answer with the recorded scan
         try:
-            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=SUBPROCESS_TIMEOUT)
-        except asyncio.TimeoutError:
-            proc.kill()
-            return f"nmap timed out after {SUBPROCESS_TIMEOUT}s\n"
-        out = stdout[:NMAP_OUTPUT_LIMIT].decode("utf-8", errors="replace")
-        if len(stdout) > NMAP_OUTPUT_LIMIT:
-            out += "\n---output truncated---\n"
-        if stderr:
-            out += "\n[nmap stderr]\n" + stderr.decode("utf-8", errors="replace")
-        return out
+            result.update(await _exec_nmap(target))
+            yield result["summary"]
+        except NmapError as e:
+            yield str(e)
+        return
+    chunks = _stream_nmap_process(target, result)
+    try:
+        async with nmap_slot():
+            async for chunk in chunks:
+                yield chunk
+    finally:
+        await chunks.aclose()
+
+async def _stream_nmap_process(target: str, result: Dict[str, Any]) -> AsyncGenerator[str, None]:
+    fd, xml_path = tempfile.mkstemp(suffix=".xml", prefix="nmap-")
+    os.close(fd)
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "nmap", *NMAP_ARGS, "-oX", xml_path, target,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
     except FileNotFoundError:
-        return "nmap not installed on server\n"
+        os.unlink(xml_path)
+        yield "nmap not installed on server\n"
+        return
     except Exception as e:
-        return f"nmap failed: {e}\n"
+        os.unlink(xml_path)
+        yield f"nmap failed: {e}\n"
+        return
+
+    async def drain_stderr() -> bytes:
+        kept = b""
+        while True:
+            chunk = await proc.stderr.read(4096)
+            if not chunk:
+                return kept
+            kept = (kept + chunk)[:NMAP_STDERR_LIMIT]
+
+    stderr_task = asyncio.ensure_future(drain_stderr())
+    t0 = time.perf_counter()
+    deadline = time.monotonic() + SUBPROCESS_TIMEOUT
+    sent = 0
+    try:
+        while True:
+            try:
+                line = await asyncio.wait_for(proc.stdout.readline(), timeout=deadline - time.monotonic())
+            except (asyncio.TimeoutError, ValueError):
+                yield f"nmap timed out after {SUBPROCESS_TIMEOUT}s\n"
+                return
+            if not line:
+                break
+            if sent + len(line) > NMAP_OUTPUT_LIMIT:
+                OUTPUT_TRUNCATIONS.inc()
+                result["truncated"] = True
+                yield "\n---output truncated---\n"
+                return
+            sent += len(line)
+            yield line.decode("utf-8", errors="replace")
+        stderr = await stderr_task
+        await proc.wait()
+        if stderr:
+            yield "\n[nmap stderr]\n" + stderr.decode("utf-8", errors="replace")
+        with open(xml_path, "rb") as f:
+            xml = f.read(NMAP_XML_LIMIT + 1)
+        try:
+            if len(xml) > NMAP_XML_LIMIT:
+                raise NmapError(f"nmap output exceeded {NMAP_XML_LIMIT} bytes\n")
+            result.update(_scan_result(target, parse_nmap_xml(xml)))
+            NMAP_CACHE.put((target, NMAP_ARGS), dict(result))
+        except NmapError as e:
+            yield str(e)
+    finally:
+        stderr_task.cancel()
+        if proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        NMAP_SECONDS.observe(time.perf_counter() - t0)
+        os.unlink(xml_path)
+
+async def run_nmap(target: str) -> Dict[str, Any]:
+    """
+    Scan target and return {"target", "scan_id", "hosts", "summary"} or {"target", "error"}.
+    Callers scanning the same target share one nmap process, which is killed
+    once all of them are cancelled (e.g. by a WebSocket {"type": "cancel"}).
+    """
+    if not is_target_allowed(target):
+        return {"target": target, "error": f"Target not allowed: {target}\n"}
+    try:
+        return await NMAP_CACHE.get_or_compute((target, NMAP_ARGS), lambda: _exec_nmap(target))
+    except NmapError as e:
+        return {"target": target, "error": str(e)}
+
+# ---------------- Sweeps ----------------
+def sweep_network(target: str):
+    """Parse a sweep target. Raises ValueError unless it lies entirely inside the allowlist."""
+    try:
+        net = ip_network(target, strict=False)
+    except ValueError:
+        raise ValueError(f"not a CIDR range: {target}")
+    if net.num_addresses > SWEEP_MAX_ADDRESSES:
+        raise ValueError(f"range too large: {net.num_addresses} addresses (max {SWEEP_MAX_ADDRESSES})")
+    if not ALLOWLIST.allows_network(net):
+        raise ValueError(f"Target not allowed: {target}")
+    return net
+
+def shard_network(net) -> List[str]:
+    prefix = max(net.prefixlen, net.max_prefixlen - (SWEEP_SHARD_SIZE.bit_length() - 1))
+    return [str(s) for s in net.subnets(new_prefix=prefix)]
+
+def _addr_key(addr: str):
+    try:
+        return (0, int(ip_address(addr)))
+    except ValueError:
+        return (1, addr)
+
+async def sweep_nmap(target: str) -> AsyncGenerator[Dict[str, Any], None]:
+    """
+    Scan a CIDR range shard by shard. Up to SWEEP_PARALLEL shards run at once,
+    each as one nmap process holding an nmap_slot. Yields a {"type": "shard"}
+    event as each shard finishes (completion order), then one {"type": "report"}
+    with all hosts merged, sorted by address and recorded as a single scan of
+    target (marked partial, so /scans/diff skips it, if any shard failed).
+    A bad target yields a single {"type": "error"}. Closing the
+    generator early cancels the remaining shards and kills their nmap processes.
+    """
+    try:
+        net = sweep_network(target)
+    except ValueError as e:
+        yield {"type": "error", "target": target, "error": str(e)}
+        return
+    shards = shard_network(net)
+    limit = asyncio.Semaphore(SWEEP_PARALLEL)
+
+    async def scan(index: int, shard: str) -> Dict[str, Any]:
+        async with limit:
+            t0 = time.perf_counter()
+            event: Dict[str, Any] = {"type": "shard", "index": index, "shard": shard}
+            try:
+                hosts = await exec_nmap_xml(shard, NMAP_ARGS, SWEEP_SHARD_TIMEOUT, NMAP_XML_LIMIT)
+            except NmapError as e:
+                hosts = []
+                event["error"] = str(e).strip()
+            event["hosts"] = hosts
+            event["elapsed_ms"] = round((time.perf_counter() - t0) * 1000, 3)
+            return event
+
+    tasks = [asyncio.ensure_future(scan(i, shard)) for i, shard in enumerate(shards)]
+    merged: List[Host] = []
+    failed = []
+    try:
+        for done, fut in enumerate(asyncio.as_completed(tasks), 1):
+            event = await fut
+            hosts = event["hosts"]
+            merged.extend(hosts)
+            if "error" in event:
+                failed.append({"shard": event["shard"], "error": event["error"]})
+            event.update(done=done, total=len(shards), hosts=[h.to_dict() for h in hosts])
+            yield event
+    finally:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    merged.sort(key=lambda h: _addr_key(h.addr))
+    report = _scan_result(str(net), merged, partial=bool(failed))
+    report.update(type="report", shards=len(shards), failed=failed, partial=bool(failed))
+    yield report
 
-def list_directory(path: str) -> str:
+async def list_directory_page(path: str, cursor: Optional[str] = None, limit: int = LS_PAGE_SIZE) -> Dict[str, Any]:
+    """One page of a listing (see DirectoryLister.page). Raises PermissionError / OSError."""
+    if not is_path_allowed(path):
+        raise PermissionError(f"Path not allowed: {path}")
+    return await LISTER.page(path, cursor, limit)
+
+def format_listing(page: Dict[str, Any]) -> str:
+    items = [f"{'DIR' if is_dir else 'FILE':4} {name} {'' if size is None else size}"
+             for name, is_dir, size in page["entries"]]
+    if page["next"] is not None:
+        items.append(f"... {page['total']} entries, next page: GET /ls?path={page['path']}&cursor={page['next']}")
+    return "\n".join(items) + "\n"
+
+async def list_directory(path: str) -> str:
+    """First page of a directory as text (the "ls:<path>" tool)."""
     if not is_path_allowed(path):
         return f"Path not allowed: {path}\n"
-    if not os.path.exists(path):
+    try:
+        return format_listing(await LISTER.page(path, limit=LS_PAGE_SIZE))
+    except FileNotFoundError:
         return f"Not found: {path}\n"
-    if not os.path.isdir(path):
+    except NotADirectoryError:
         return f"Not a directory: {path}\n"
-    try:
-        items = []
-        with os.scandir(path) as it:
-            for e in it:
-                typ = 'DIR' if e.is_dir() else 'FILE'
-                size = e.stat().st_size if e.is_file() else ''
-                items.append(f"{typ:4} {e.name} {size}")
-        return "\n".join(items) + "\n"
-    except Exception as e:
+    except OSError as e:
         return f"ls failed: {e}\n"
 
+# ---------------- Tool execution ----------------
+TOOL_LIMITS = {name: asyncio.Semaphore(n) for name, n in TOOL_CONCURRENCY.items()}
+
+ChunkCallback = Callable[[str], Awaitable[None]]
+
+async def _stream_tool(chunks: AsyncGenerator[str, None], on_chunk: ChunkCallback) -> str:
+    """Forward chunks to on_chunk, keeping only the head needed for session history."""
+    head = ""
+    try:
+        async for chunk in chunks:
+            if len(head) < 1000:
+                head += chunk[:1000 - len(head)]
+            await on_chunk(chunk)
+    finally:
+        await chunks.aclose()  # kills nmap right away if we were cancelled
+    return head
+
+async def run_tool(spec: str, on_chunk: Optional[ChunkCallback] = None) -> Dict[str, Any]:
+    """
+    Run one "nmap:<ip>" / "sweep:<cidr>" / "ls:<path>" tool spec and time it.
+    With on_chunk, nmap output (for sweeps: one progress line per finished
+    shard) is streamed through the callback as it is produced and only its
+    head is kept in the result.
+    """
+    t0 = time.perf_counter()
+    if spec.startswith("nmap:"):
+        target = spec.split(":", 1)[1]
+        async with TOOL_LIMITS["nmap"]:
+            if on_chunk is None:
+                res = await run_nmap(target)
+            else:
+                res = {"target": target}
+                head = await _stream_tool(stream_nmap(target, res), on_chunk)
+                if res.pop("truncated", False):
+                    # no XML from a cut-off scan; the head is nmap's normal output, not an error
+                    res["error"] = f"output truncated at NMAP_OUTPUT_LIMIT ({NMAP_OUTPUT_LIMIT} bytes)\n"
+                    res["partial_output"] = head
+                elif "hosts" not in res:
+                    res["error"] = head
+        result = {"tool": "nmap", "target": target, "output": res}
+    elif spec.startswith("sweep:"):
+        target = spec.split(":", 1)[1]
+        res = {"target": target}
+        async with TOOL_LIMITS["sweep"]:
+            events = sweep_nmap(target)
+            try:
+                async for event in events:
+                    if event["type"] == "shard" and on_chunk is not None:
+                        status = event.get("error") or f"{sum(h['state'] == 'up' for h in event['hosts'])} hosts up"
+                        await on_chunk(f"[{event['done']}/{event['total']}] {event['shard']}: {status}\n")
+                    elif event["type"] == "error":
+                        res["error"] = event["error"] + "\n"
+                    elif event["type"] == "report":
+                        res = event
+            finally:
+                await events.aclose()
+        result = {"tool": "sweep", "target": target, "output": res}
+    elif spec.startswith("ls:"):
+        path = spec.split(":", 1)[1]
+        async with TOOL_LIMITS["ls"]:
+            res = await list_directory(path)
+        result = {"tool": "ls", "path": path, "output": res}
+        if on_chunk is not None:
+            await on_chunk(res)
+    else:
+        result = {"tool": "unknown", "spec": spec, "output": "unsupported"}
+    elapsed = time.perf_counter() - t0
+    TOOL_SECONDS.observe(elapsed, result["tool"])
+    result["elapsed_ms"] = round(elapsed * 1000, 3)
+    return result
+
+async def run_tools(session: Session, tools: List[str],
+                    on_chunk: Optional[Callable[[int, str], Awaitable[None]]] = None):
+    """
+    Run all tools of one request concurrently (bounded by TOOL_LIMITS) and
+    record their output in the session in request order. on_chunk, if given,
+    receives (tool index, chunk) as output is produced.
+    Returns (used_tools, tool_results).
+    """
+    def forward(i: int) -> Optional[ChunkCallback]:
+        if on_chunk is None:
+            return None
+        return lambda chunk: on_chunk(i, chunk)
+
+    tool_results = await asyncio.gather(*(run_tool(t, forward(i)) for i, t in enumerate(tools)))
+    used_tools = []
+    for r in tool_results:
+        if r["tool"] in ("nmap", "sweep"):
+            text = r["output"].get("summary") or r["output"].get("error", "")
+            session.append("tool", f"{r['tool']} {r['target']} -> {text[:1000]}")
+        elif r["tool"] == "ls":
+            session.append("tool", f"ls {r['path']} -> {r['output'][:1000]}")
+        else:
+            continue
+        used_tools.append(r["tool"])
+    return used_tools, list(tool_results)
+
 # ---------------- LLM Adapter (placeholder) ----------------
-# Replace with real model calls (Hugging Face, OpenAI, local LLM, etc.)
-# This simple adapter echoes the instruction and uses session history.
+# Replace FakeModel with real model calls (Hugging Face, OpenAI, local LLM, etc.).
+# A model only has to provide `stream(session_id, prompt, instruction, max_tokens)`,
+# an async generator of text chunks. `prompt` is the session's PromptBuffer: a
+# backend with prefix caching keeps the fingerprint it last processed and only
+# feeds prompt.suffix_since(fingerprint); others can use prompt.render().
+class FakeModel:
+    """
+    Local stand-in model that echoes the instruction one token at a time.
+    token_latency simulates per-token decode time so the streaming paths can
+    be benchmarked offline. It mimics a prefix cache by tracking, per session,
+    the last prompt fingerprint it "prefilled".
+    """
+
+    def __init__(self, first_token_latency: float = 0.01, token_latency: float = 0.0,
+                 max_cached_prefixes: int = 1024):
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.max_cached_prefixes = max_cached_prefixes
+        self._prefixes: "OrderedDict[str, str]" = OrderedDict()  # session_id -> fingerprint
+        self.prefix_hits = 0
+        self.prefill_tokens = 0
+
+    def _prefill(self, session_id: str, prompt: PromptBuffer):
+        new = prompt.suffix_since(self._prefixes.get(session_id))
+        if new is None:
+            new = list(prompt.history)  # cold or trimmed prefix: full prefill
+        else:
+            self.prefix_hits += 1
+        self.prefill_tokens += sum(m.tokens for m in new)
+        self._prefixes[session_id] = prompt.fingerprint
+        self._prefixes.move_to_end(session_id)
+        if len(self._prefixes) > self.max_cached_prefixes:
+            self._prefixes.popitem(last=False)
+
+    async def stream(self, session_id: str, prompt: PromptBuffer, instruction: str,
+                     max_tokens: int) -> AsyncGenerator[str, None]:
+        self._prefill(session_id, prompt)
+        await asyncio.sleep(self.first_token_latency)  # placeholder prefill latency
+        words = f"[Echo] {instruction}".split(" ")
+        for i, word in enumerate(words[:max_tokens]):
+            if i and self.token_latency:
+                await asyncio.sleep(self.token_latency)
+            yield word if i == 0 else " " + word
+
+MODEL = FakeModel(token_latency=LLM_FAKE_TOKEN_LATENCY)
+
+async def llm_stream(session: Session, instruction: str, max_tokens: int) -> AsyncGenerator[str, None]:
+    # The instruction is already the last user message in session.history, so
+    # the session's prompt buffer (system prompt + history) is the whole prompt.
+    t0 = time.perf_counter()
+    try:
+        async for chunk in MODEL.stream(session.session_id, session.prompt, instruction, max_tokens):
+            yield chunk
+    finally:
+        LLM_SECONDS.observe(time.perf_counter() - t0)
+
 async def llm_generate(session: Session, instruction: str, max_tokens: int) -> str:
-    # Example of simple system behavior injection
-    system_prompt = "You are MCP assistant. Keep replies short."
-    # Build prompt from history (naive concatenation)
-    prompt_parts = [system_prompt]
-    for h in session.history:
-        prompt_parts.append(f"{h['role']}: {h['content']}")
-    prompt_parts.append(f"user: {instruction}")
-    prompt = "\n".join(prompt_parts)
-    # Simulate generation
-    await asyncio.sleep(0.01)  # placeholder latency
-    reply = f"[Echo] {instruction}"
-    return reply
+    return "".join([chunk async for chunk in llm_stream(session, instruction, max_tokens)])
 
 # ---------------- HTTP MCP endpoint ----------------
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json_dumps(data)}\n\n"
+
+async def mcp_sse(req: MCPRequest) -> AsyncGenerator[str, None]:
+    """
+    Server-Sent Events version of /mcp: one "tool" event per tool result,
+    "token" events as the reply is generated, then a "done" event carrying
+    the same body as the JSON response.
+    """
+    sid = req.session_id or "default"
+    max_tokens = req.max_tokens or MAX_CONTEXT_TOKENS
+    with SESSIONS.use(sid, max_tokens=max_tokens) as session:
+        session.append("user", req.instruction)
+
+        used_tools, tool_results = await run_tools(session, req.tools or [])
+        for r in tool_results:
+            yield sse_event("tool", r)
+
+        parts = []
+        async for chunk in llm_stream(session, req.instruction, max_tokens):
+            parts.append(chunk)
+            yield sse_event("token", {"delta": chunk})
+        reply = "".join(parts)
+        session.append("assistant", reply)
+
+        resp = MCPResponse(session_id=sid, reply=reply, used_tools=used_tools,
+                           tool_results=tool_results, session=session.to_dict(req.cursor))
+        yield sse_event("done", resp.model_dump())
+
 @app.post("/mcp", response_model=MCPResponse)
 async def mcp_endpoint(req: MCPRequest):
+    if req.stream:
+        return StreamingResponse(mcp_sse(req), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
     sid = req.session_id or "default"
-    if sid not in SESSIONS:
-        SESSIONS[sid] = Session(sid, max_tokens=req.max_tokens or MAX_CONTEXT_TOKENS)
-    session = SESSIONS[sid]
+    with SESSIONS.use(sid, max_tokens=req.max_tokens or MAX_CONTEXT_TOKENS) as session:
+        # Append user instruction to session history
+        session.append("user", req.instruction)
 
-    # Append user instruction to session history
-    session.append("user", req.instruction)
+        # Tool handling: simple syntax: tools list contains strings like "nmap:1.2.3.4" or "ls:/path"
+        used_tools, tool_results = await run_tools(session, req.tools or [])
 
-    used_tools = []
-    # Tool handling: simple syntax: tools list contains strings like "nmap:1.2.3.4" or "ls:/path"
-    tool_results = []
-    for t in req.tools or []:
-        if t.startswith("nmap:"):
-            target = t.split(":", 1)[1]
-            res = await run_nmap(target)
-            tool_results.append({"tool": "nmap", "target": target, "output": res})
-            used_tools.append("nmap")
-            session.append("tool", f"nmap {target} -> {res[:1000]}")
-        elif t.startswith("ls:"):
-            path = t.split(":", 1)[1]
-            res = list_directory(path)
-            tool_results.append({"tool": "ls", "path": path, "output": res})
-            used_tools.append("ls")
-            session.append("tool", f"ls {path} -> {res[:1000]}")
-        else:
-            tool_results.append({"tool": "unknown", "spec": t, "output": "unsupported"})
+        # Call LLM adapter
+        reply = await llm_generate(session, req.instruction, req.max_tokens or MAX_CONTEXT_TOKENS)
+        session.append("assistant", reply)
 
-    # Call LLM adapter
-    reply = await llm_generate(session, req.instruction, req.max_tokens or MAX_CONTEXT_TOKENS)
-    session.append("assistant", reply)
-
-    # Build response
-    resp = MCPResponse(session_id=sid, reply=reply, used_tools=used_tools, session=session.to_dict())
-    return resp
+        # Build response; with a cursor the session part is only what was added since
+        resp = MCPResponse(session_id=sid, reply=reply, used_tools=used_tools,
+                           tool_results=tool_results, session=session.to_dict(req.cursor))
+        return resp
 
 # ---------------- WebSocket MCP endpoint ----------------
+# Stream frames may be dropped or merged when a slow reader's queue is full
+# (value: the text field that coalescing concatenates). Every other frame
+# (replies, errors, cancel acks) is always queued.
+STREAM_FRAMES = {"chunk": "delta", "tool_chunk": "data"}
+
+class Connection:
+    """
+    One WebSocket with a bounded outbound queue drained by its own writer
+    task, so handlers never wait on a slow reader, and a token bucket for
+    incoming instructions.
+    """
+
+    def __init__(self, websocket: WebSocket, client_id: str, max_queue: int, policy: str):
+        self.websocket = websocket
+        self.client_id = client_id
+        self.max_queue = max_queue
+        self.policy = policy
+        self.queue: Deque[Dict[str, Any]] = deque()
+        self.ready = asyncio.Event()
+        self.bucket = TokenBucket(WS_RATE, WS_BURST)
+        self.closed = False
+        self.closing = False
+        self.stats = {"sent": 0, "dropped": 0, "coalesced": 0, "rate_limited": 0, "max_depth": 0}
+        self.writer = asyncio.create_task(self._write())
+
+    async def _write(self):
+        try:
+            while True:
+                while self.queue:
+                    await self.websocket.send_text(json_dumps(self.queue[0]))
+                    self.queue.popleft()
+                    self.stats["sent"] += 1
+                if self.closing:
+                    return
+                self.ready.clear()
+                await self.ready.wait()
+        except Exception:
+            self.closed = True  # socket gone; further frames are discarded
+
+    def _coalesce(self, frame: Dict[str, Any], field: str) -> bool:
+        # merge into the newest queued frame of the same stream (not the one being sent)
+        for queued in itertools.islice(reversed(self.queue), len(self.queue) - 1):
+            if queued.get("type") == frame["type"] and queued.get("index") == frame.get("index"):
+                queued[field] += frame[field]
+                return True
+        return False
+
+    async def send(self, frame: Dict[str, Any]) -> bool:
+        """Queue a frame without waiting for the client. False if it was discarded."""
+        if self.closed or self.closing:
+            return False
+        field = STREAM_FRAMES.get(frame.get("type"))
+        if field is not None and len(self.queue) >= self.max_queue:
+            if self.policy == "disconnect":
+                await self.close(code=1008, reason="send queue overflow")
+                return False
+            if self.policy == "coalesce" and self._coalesce(frame, field):
+                self.stats["coalesced"] += 1
+                return True
+            self.stats["dropped"] += 1
+            return False
+        self.queue.append(frame)
+        self.stats["max_depth"] = max(self.stats["max_depth"], len(self.queue))
+        self.ready.set()
+        return True
+
+    def allow_instruction(self) -> bool:
+        if self.bucket.take():
+            return True
+        self.stats["rate_limited"] += 1
+        return False
+
+    async def close(self, code: Optional[int] = None, reason: str = "", flush: bool = False):
+        """Stop the writer (after up to WS_FLUSH_TIMEOUT of flushing with flush=True) and optionally close the socket."""
+        self.closing = True
+        self.ready.set()
+        if flush and not self.closed:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.writer), WS_FLUSH_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        self.writer.cancel()
+        self.queue.clear()
+        self.closed = True
+        if code is not None:
+            try:
+                await self.websocket.close(code=code, reason=reason)
+            except Exception:
+                pass
+
+    def metrics(self) -> Dict[str, Any]:
+        return {"depth": len(self.queue), "closed": self.closed, **self.stats}
+
 class ConnectionManager:
-    def __init__(self):
-        self.active: Dict[str, WebSocket] = {}
+    def __init__(self, max_queue: int = WS_SEND_QUEUE, policy: str = WS_OVERFLOW_POLICY):
+        self.active: Dict[str, Connection] = {}
+        self.max_queue = max_queue
+        self.policy = policy
+
+    async def connect(self, websocket: WebSocket, client_id: str) -> Connection:
+        # the endpoint has already accepted the socket to read the init message
+        conn = self.active[client_id] = Connection(websocket, client_id, self.max_queue, self.policy)
+        return conn
 
-    async def connect(self, websocket: WebSocket, client_id: str):
-        await websocket.accept()
-        self.active[client_id] = websocket
+    async def disconnect(self, client_id: str, flush: bool = False):
+        conn = self.active.pop(client_id, None)
+        if conn is not None:
+            await conn.close(flush=flush)
 
-    def disconnect(self, client_id: str):
-        if client_id in self.active:
-            del self.active[client_id]
+    async def send_json(self, client_id: str, data: Dict[str, Any]) -> bool:
+        conn = self.active.get(client_id)
+        if conn:
+            return await conn.send(data)
+        return False
 
-    async def send_json(self, client_id: str, data: Dict[str, Any]):
-        ws = self.active.get(client_id)
-        if ws:
-            await ws.send_json(data)
+    def metrics(self) -> Dict[str, Any]:
+        return {"connections": len(self.active), "policy": self.policy, "max_queue": self.max_queue,
+                "clients": {cid: conn.metrics() for cid, conn in self.active.items()}}
 
 manager = ConnectionManager()
 
+METRICS.gauge("mcp_ws_connections", "Open WebSocket connections", fn=lambda: len(manager.active))
+
+async def ws_handle(session: Session, client_id: str, msg: Dict[str, Any]):
+    """Answer one WebSocket instruction message."""
+    instruction = msg.get("instruction", "")
+    tools = msg.get("tools", [])
+
+    session.append("user", instruction)
+
+    # {"stream": true}: push tool output as {"type": "tool_chunk"} frames while it runs
+    async def on_chunk(index: int, chunk: str):
+        await manager.send_json(client_id, {
+            "type": "tool_chunk", "index": index, "tool": tools[index], "data": chunk})
+
+    used_tools, tool_results = await run_tools(session, tools, on_chunk if msg.get("stream") else None)
+
+    # generate reply; in stream mode each chunk is pushed as a {"type": "chunk"} frame
+    parts = []
+    async for chunk in llm_stream(session, instruction, MAX_CONTEXT_TOKENS):
+        parts.append(chunk)
+        if msg.get("stream"):
+            await manager.send_json(client_id, {"type": "chunk", "delta": chunk})
+    reply = "".join(parts)
+    session.append("assistant", reply)
+
+    out = {"type": "reply", "session_id": session.session_id, "reply": reply,
+           "used_tools": used_tools, "tool_results": tool_results}
+    if msg.get("cursor") is not None:
+        out["session"] = session.to_dict(int(msg["cursor"]))
+    await manager.send_json(client_id, out)
+
 @app.websocket("/mcp/ws")
 async def mcp_ws(websocket: WebSocket):
     # Expect initial message to include session_id
     await websocket.accept()
+    client_id = None
     try:
         init = await websocket.receive_text()
         obj = json.loads(init)
         sid = obj.get("session_id", "default")
         client_id = f"ws:{sid}:{id(websocket)}"
-        await manager.connect(websocket, client_id)
-        if sid not in SESSIONS:
-            SESSIONS[sid] = Session(sid)
-        session = SESSIONS[sid]
+        conn = await manager.connect(websocket, client_id)
 
-        # A simple loop: receive JSON messages {"instruction":..., "tools": [...]} and respond
-        while True:
-            text = await websocket.receive_text()
-            msg = json.loads(text)
-            instruction = msg.get("instruction", "")
-            tools = msg.get("tools", [])
-
-            session.append("user", instruction)
-
-            used_tools = []
-            tool_results = []
-            for t in tools:
-                if t.startswith("nmap:"):
-                    target = t.split(":", 1)[1]
-                    res = await run_nmap(target)
-                    tool_results.append({"tool": "nmap", "target": target, "output": res})
-                    used_tools.append("nmap")
-                    session.append("tool", f"nmap {target} -> {res[:1000]}")
-                elif t.startswith("ls:"):
-                    path = t.split(":", 1)[1]
-                    res = list_directory(path)
-                    tool_results.append({"tool": "ls", "path": path, "output": res})
-                    used_tools.append("ls")
-                    session.append("tool", f"ls {path} -> {res[:1000]}")
-
-            # generate reply (could stream in chunks)
-            reply = await llm_generate(session, instruction, MAX_CONTEXT_TOKENS)
-            session.append("assistant", reply)
-
-            out = {"session_id": sid, "reply": reply, "used_tools": used_tools}
-            await manager.send_json(client_id, out)
+        with SESSIONS.use(sid) as session:
+            # Messages are read by a separate task so that {"type": "cancel"}
+            # can abort the instruction currently running and kill its nmap
+            # processes, streamed or not; the "cancelled" frame follows once they are gone.
+            # Instructions are rate limited per connection and at most
+            # WS_MAX_PENDING wait behind the running one.
+            inbox: asyncio.Queue = asyncio.Queue(WS_MAX_PENDING)
+            running: Dict[str, asyncio.Task] = {}
+
+            async def receive():
+                while True:
+                    msg = json.loads(await websocket.receive_text())
+                    if msg.get("type") == "cancel":
+                        task = running.get("current")
+                        if task is not None and not task.done():
+                            task.cancel()
+                        continue
+                    if not conn.allow_instruction():
+                        await conn.send({"type": "error", "error": "rate limited",
+                                         "retry_after": round(conn.bucket.retry_after(), 3)})
+                        continue
+                    try:
+                        inbox.put_nowait(msg)
+                    except asyncio.QueueFull:
+                        await conn.send({"type": "error", "error": "too many pending instructions"})
+
+            reader = asyncio.create_task(receive())
+            try:
+                # A simple loop: take JSON messages {"instruction":..., "tools": [...]} and respond
+                while True:
+                    get = asyncio.create_task(inbox.get())
+                    await asyncio.wait({get, reader}, return_when=asyncio.FIRST_COMPLETED)
+                    if not get.done():
+                        get.cancel()
+                        reader.result()  # re-raises WebSocketDisconnect / bad JSON
+                    t0 = time.perf_counter()
+                    task = running["current"] = asyncio.create_task(ws_handle(session, client_id, get.result()))
+                    await asyncio.wait({task, reader}, return_when=asyncio.FIRST_COMPLETED)
+                    if not task.done():
+                        task.cancel()
+                        WS_SECONDS.observe(time.perf_counter() - t0, "disconnected")
+                        reader.result()
+                    if task.cancelled():
+                        WS_SECONDS.observe(time.perf_counter() - t0, "cancelled")
+                        await manager.send_json(client_id, {"type": "cancelled", "session_id": sid})
+                    else:
+                        WS_SECONDS.observe(time.perf_counter() - t0, "ok" if task.exception() is None else "error")
+                        task.result()
+            finally:
+                reader.cancel()
+                task = running.get("current")
+                if task is not None:
+                    task.cancel()
 
     except WebSocketDisconnect:
-        manager.disconnect(client_id)
+        await manager.disconnect(client_id)
     except Exception as e:
+        if client_id in manager.active:
+            await manager.send_json(client_id, {"error": str(e)})
+            await manager.disconnect(client_id, flush=True)
+            return
         try:
             await websocket.send_json({"error": str(e)})
         except Exception:
             pass
-        manager.disconnect(client_id)
+
+# ---------------- Scan jobs ----------------
+class JobRequest(BaseModel):
+    target: str
+    session_id: Optional[str] = "default"
+    priority: Optional[str] = "normal"  # high | normal | low
+
+async def _run_scan_job(job: Job) -> Dict[str, Any]:
+    res = await run_nmap(job.target)
+    if "error" in res:
+        raise NmapError(res["error"].strip())
+    return res
+
+JOBS = JobScheduler(_run_scan_job, workers=JOB_WORKERS, max_queued=JOB_MAX_QUEUED)
+METRICS.gauge("mcp_jobs_queued", "Scan jobs waiting for a worker", fn=lambda: JOBS._queued)
+METRICS.gauge("mcp_jobs_running", "Scan jobs running", fn=lambda: JOBS._running)
+
+@app.post("/jobs", status_code=202)
+async def submit_job(req: JobRequest):
+    if not is_target_allowed(req.target):
+        raise HTTPException(status_code=400, detail=f"target not allowed: {req.target}")
+    try:
+        job = JOBS.submit(req.session_id or "default", req.target, req.priority or "normal")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except OverflowError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return job.to_dict()
+
+@app.get("/jobs/metrics")
+async def job_metrics():
+    return JOBS.metrics()
+
+async def job_events(job: Job) -> AsyncGenerator[str, None]:
+    while True:
+        yield sse_event("state", job.to_dict())
+        if job.state in JOB_FINAL_STATES:
+            return
+        await job.wait_changed(timeout=15)  # re-sends the state as a heartbeat
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, stream: bool = False):
+    """Poll a job, or with ?stream=true follow its state changes as Server-Sent Events."""
+    job = JOBS.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    if stream:
+        return StreamingResponse(job_events(job), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
+    return job.to_dict()
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = JOBS.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="job not found")
+    return job.to_dict()
+
+# ---------------- Sweep endpoint ----------------
+class SweepRequest(BaseModel):
+    target: str                   # CIDR range, e.g. "10.0.0.0/24"
+    stream: Optional[bool] = False  # per-shard progress as Server-Sent Events
+
+async def sweep_events(target: str) -> AsyncGenerator[str, None]:
+    events = sweep_nmap(target)
+    try:
+        async for event in events:
+            yield sse_event(event["type"], event)
+    finally:
+        await events.aclose()
+
+@app.post("/sweep")
+async def sweep(req: SweepRequest):
+    """
+    Scan a CIDR range inside ALLOWED_TARGETS. Answers with the merged report,
+    or with "stream": true a "shard" event per finished shard
+    followed by a "report" event.
+    """
+    try:
+        sweep_network(req.target)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if req.stream:
+        return StreamingResponse(sweep_events(req.target), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache"})
+    events = sweep_nmap(req.target)
+    try:
+        async for event in events:
+            if event["type"] == "report":
+                return event
+    finally:
+        await events.aclose()
 
 # ---------------- Admin endpoints ----------------
 @app.get("/session/{session_id}")
-async def get_session(session_id: str):
+async def get_session(session_id: str, since: Optional[int] = None):
+    """The whole session, or with ?since=<cursor> only the messages added after it."""
     s = SESSIONS.get(session_id)
     if not s:
         raise HTTPException(status_code=404, detail="session not found")
-    return JSONResponse(content=s.to_dict())
+    return Response(json_dumps(s.to_dict(since)), media_type="application/json")
+
+async def session_lines(session_ids: List[str]) -> AsyncGenerator[str, None]:
+    # sessions are read one at a time on the event loop (the stores are not
+    # thread-safe); yielding between them keeps other requests going
+    for d in SESSIONS.iter_dicts(session_ids):
+        yield json_dumps(d) + "\n"
+        await asyncio.sleep(0)
 
 @app.get("/sessions")
-async def list_sessions():
-    return JSONResponse(content={k: v.to_dict() for k, v in SESSIONS.items()})
+async def list_sessions(after: Optional[str] = None, limit: int = SESSION_PAGE_SIZE):
+    """
+    NDJSON, one session per line, ordered by session id. When more remain,
+    the X-Next-After header holds the `after` value for the next page.
+    """
+    limit = max(1, min(limit, 10 * SESSION_PAGE_SIZE))
+    ids = SESSIONS.session_ids(after, limit + 1)
+    headers = {"X-Next-After": ids[limit - 1]} if len(ids) > limit else {}
+    return StreamingResponse(session_lines(ids[:limit]), media_type="application/x-ndjson", headers=headers)
+
+@app.get("/sessions/stats")
+async def session_stats():
+    return SESSIONS.stats()
+
+@app.get("/scans/query")
+async def scans_query(port: Optional[int] = None, state: Optional[str] = "open",
+                      service: Optional[str] = None, target: Optional[str] = None, limit: int = 1000):
+    """e.g. /scans/query?port=443 (hosts with 443 open) or /scans/query?service=ssh"""
+    return {"results": SCAN_STORE.query(port=port, state=state or None, service=service,
+                                        target=target, limit=limit)}
+
+@app.get("/scans/history")
+async def scans_history(target: str, limit: int = 50):
+    return {"target": target, "scans": SCAN_STORE.history(target, limit)}
+
+@app.get("/scans/diff")
+async def scans_diff(target: str, since: Optional[int] = None):
+    """Only what changed since the previous scan of target (or scan id `since`)."""
+    return SCAN_STORE.diff(target, since)
+
+@app.get("/ws/metrics")
+async def ws_metrics():
+    """Per-connection outbound queue depth, drops/coalesces and rate-limit counts."""
+    return manager.metrics()
+
+@app.get("/allowlist")
+async def allowlist_stats():
+    return ALLOWLIST.stats()
+
+@app.post("/allowlist/reload")
+async def allowlist_reload():
+    if ALLOWLIST.path and not ALLOWLIST.reload():
+        raise HTTPException(status_code=400, detail=ALLOWLIST.error)
+    return ALLOWLIST.stats()
+
+@app.get("/ls")
+async def ls(path: str, cursor: Optional[str] = None, limit: int = LS_PAGE_SIZE):
+    """Paginated listing: pass the returned "next" as ?cursor= for the following page."""
+    try:
+        page = await list_directory_page(path, cursor, max(1, min(limit, 10 * LS_PAGE_SIZE)))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Not found: {path}")
+    except OSError as e:
+        raise HTTPException(status_code=400, detail=f"ls failed: {e}")
+    page["entries"] = [{"name": n, "type": "dir" if d else "file", "size": sz} for n, d, sz in page["entries"]]
+    return page
+
+@app.get("/ls/stats")
+async def ls_stats():
+    return LISTER.stats()
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return NMAP_CACHE.stats()
+
+@app.delete("/cache")
+async def cache_clear(target: Optional[str] = None):
+    removed = NMAP_CACHE.invalidate(None if target is None else (lambda k: k[0] == target))
+    return {"removed": removed}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """Prometheus text format."""
+    return PlainTextResponse(METRICS.render(), media_type=PROMETHEUS_CONTENT_TYPE)
 
 # ---------------- Simple health check ----------------
 @app.get("/ping")
@@ -17,9 +17,29 @@ USAGE
 2) Run (needs Python 3.8+ and nmap installed on the system):
    python gemini_mcp_server.py --cert cert.pem --key key.pem --host 0.0.0.0 --port 1965
 
+   --workers N forks N processes that share the port through SO_REUSEPORT.
+   Clients that keep their TLS session resume it on any worker (session tickets).
+
+   Overload: each phase of a connection has a deadline (HANDSHAKE_TIMEOUT,
+   REQUEST_TIMEOUT, WRITE_TIMEOUT) and requests wait for one of MAX_ACTIVE_REQUESTS
+   slots; when the server is saturated clients get 44 (slow down) right away.
+
 3) Examples of requests (using a gemini client):
    gemini://yourhost:1965/list?path=/home/user
+   gemini://yourhost:1965/list?path=/home/user&cursor=<last name>   (next page)
    gemini://yourhost:1965/nmap?target=127.0.0.1
+   gemini://yourhost:1965/query?port=443          (hosts with 443 open)
+   gemini://yourhost:1965/query?service=ssh
+   gemini://yourhost:1965/diff?target=127.0.0.1   (changes since previous scan)
+   gemini://yourhost:1965/cache            (nmap result cache stats)
+   gemini://yourhost:1965/cache/clear?target=127.0.0.1
+   gemini://yourhost:1965/metrics          (Prometheus text: latency histograms, counters)
+
+   Offline: NMAP_REPLAY_DIR=fixtures/nmap replays recorded nmap XML instead of scanning.
+   NMAP_PROCESS_CAP (default 4) bounds concurrent nmap processes; point NMAP_SLOT_DIR
+   of this server and nmapmcpserver.py at the same directory to share one cap.
+   NMAP_ALLOWLIST_FILE=inventory.txt adds allowed CIDRs (one per line) to
+   ALLOWED_TARGETS; the file is re-read when it changes.
 
 This script is intentionally small and synchronous for clarity. Extend with
 authorization, rate limiting and sandboxing as required for real deployments.
@@ -32,8 +52,17 @@ import urllib.parse
 import os
 import shlex
 import json
+import shutil
+import signal
+import socket
 import subprocess
-from ipaddress import ip_network, ip_address
+import tempfile
+import time
+import traceback
+from collections import OrderedDict
+
+import mcp_common
+from mcp_common import PROMETHEUS_CONTENT_TYPE, AdmissionGate, Allowlist, DirectoryLister, Metrics, NmapError, ResultCache, ScanStore, exec_nmap_xml, format_hosts
 
 # --- Configuration: edit before running ---
 ALLOWED_TARGETS = [
@@ -41,26 +70,117 @@ ALLOWED_TARGETS = [
     "::1/128",
     # Add CIDR ranges you trust, e.g. "192.168.1.0/24"
 ]
-# Maximum bytes of nmap output to return (protects server memory)
-NMAP_OUTPUT_LIMIT = 200_000  # bytes
+# Maximum bytes of nmap XML accepted from one scan (protects server memory)
+NMAP_XML_LIMIT = 5_000_000  # bytes
+# Parsed scan results, queried via /query
+SCAN_DB_PATH = 'gemini_scans.db'
+# Extra allowed CIDRs, one per line; reloaded when the file changes
+ALLOWLIST_FILE = os.environ.get('NMAP_ALLOWLIST_FILE')
 # Timeout for subprocess invocations
 SUBPROCESS_TIMEOUT = 30  # seconds
+# Open connections per process; past this, new clients get 44 (slow down) at once
+MAX_CONNECTIONS = 1024
+# Requests handled at once after their request line arrived; up to REQUEST_QUEUE
+# more wait REQUEST_QUEUE_TIMEOUT for a slot and are then answered 44
+MAX_ACTIVE_REQUESTS = 64
+REQUEST_QUEUE = 256
+REQUEST_QUEUE_TIMEOUT = 2  # seconds
+# Seconds a 44 response asks the client to wait before retrying
+SLOW_DOWN_SECONDS = 5
+# Deadlines per phase: TLS handshake, the whole request line, writing the response
+HANDSHAKE_TIMEOUT = 10  # seconds
+REQUEST_TIMEOUT = 5  # seconds
+WRITE_TIMEOUT = 30  # seconds
+# Longest request line accepted (the spec allows 1024-byte URLs)
+REQUEST_LINE_LIMIT = 8192  # bytes
+# TLS 1.3 session tickets issued per connection (0 disables resumption)
+TLS_SESSION_TICKETS = 2
+# Entries per /list page; listings are cached until the directory changes
+LIST_PAGE_SIZE = 1000
+# How long identical nmap results are reused, and cache size limits
+NMAP_CACHE_TTL = 60  # seconds
+NMAP_CACHE_ENTRIES = 256
+NMAP_CACHE_BYTES = 32 * 1024 * 1024
 # ----------------------------------------
 
-# Pre-parse allowed networks
-ALLOWED_NETWORKS = [ip_network(x) for x in ALLOWED_TARGETS]
+# Allowed networks compiled into an O(log n) index
+ALLOWLIST = Allowlist(ALLOWED_TARGETS, ALLOWLIST_FILE)
+
+NMAP_CACHE = ResultCache(ttl=NMAP_CACHE_TTL, max_entries=NMAP_CACHE_ENTRIES, max_bytes=NMAP_CACHE_BYTES)
+SCAN_STORE = ScanStore(SCAN_DB_PATH)
+LISTER = DirectoryLister()
 
 GEMINI_OK = "20"  # success
+GEMINI_SLOW_DOWN = "44"  # server saturated; meta is seconds to wait
 GEMINI_BAD_REQUEST = "59"  # temporary failure (used for errors)
 
+# Idle connections are cheap, so the connection cap is high and has no queue;
+# only requests that have fully arrived compete for the small pool of slots.
+# A slow or silent client therefore costs a socket for REQUEST_TIMEOUT at most
+# and never a request slot.
+CONNECTION_GATE = AdmissionGate(MAX_CONNECTIONS, 0)
+REQUEST_GATE = AdmissionGate(MAX_ACTIVE_REQUESTS, REQUEST_QUEUE)
+# Connections still waiting for their request line, oldest first. When the
+# cap is reached the oldest of them makes room for a new client.
+AWAITING_REQUEST = OrderedDict()
+
+# Instrumentation, served at /metrics
+ENDPOINTS = ('list', 'nmap', 'query', 'diff', 'cache', 'info', 'metrics')
+METRICS = Metrics()
+REQUEST_SECONDS = METRICS.histogram('gemini_request_seconds', 'Request latency, TLS handshake excluded',
+                                    ('endpoint', 'status'))
+NMAP_SECONDS = METRICS.histogram('gemini_nmap_process_seconds', 'Wall time of nmap processes actually started')
+CONNECTIONS = METRICS.gauge('gemini_connections', 'Open client connections')
+DROPPED = METRICS.counter('gemini_dropped_total', 'Connections turned away (44) or cut off by a deadline',
+                          ('reason',))
+METRICS.gauge('gemini_requests_active', 'Requests holding a slot', fn=lambda: REQUEST_GATE.active)
+METRICS.gauge('gemini_requests_queued', 'Requests waiting for a slot', fn=lambda: REQUEST_GATE.waiting)
+METRICS.counter('gemini_nmap_cache_hits_total', 'nmap results served from NMAP_CACHE', fn=lambda: NMAP_CACHE.hits)
+METRICS.gauge('gemini_nmap_running', 'nmap processes running in this process', fn=mcp_common.nmap_running)
+
 async def handle_gemini(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    # The TLS handshake is already done here (bounded by HANDSHAKE_TIMEOUT)
+    CONNECTIONS.inc()
     try:
-        # Read request line (single line, terminated by \r\n), max 8192 bytes
-        data = await reader.readuntil(b"\r\n")
+        if not await CONNECTION_GATE.acquire(0):
+            # handshakes already in flight when the cap was reached
+            await slow_down(writer, 'connections')
+            return
+        try:
+            await _handle_gemini(reader, writer)
+        finally:
+            CONNECTION_GATE.release()
+    except ConnectionError:
+        pass
+    finally:
+        await close_connection(writer)
+        CONNECTIONS.dec()
+
+async def _handle_gemini(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    AWAITING_REQUEST[writer] = None
+    try:
+        # Read request line (single line, terminated by \r\n), max REQUEST_LINE_LIMIT
+        # bytes; the deadline covers the whole line, so trickling bytes doesn't extend it
+        data = await asyncio.wait_for(reader.readuntil(b"\r\n"), REQUEST_TIMEOUT)
+    except asyncio.TimeoutError:
+        DROPPED.inc('request_timeout')
+        return
     except Exception:
-        writer.close()
-        await writer.wait_closed()
         return
+    finally:
+        AWAITING_REQUEST.pop(writer, None)
+
+    if not await REQUEST_GATE.acquire(REQUEST_QUEUE_TIMEOUT):
+        await slow_down(writer, 'requests')
+        return
+    try:
+        await handle_request(data, writer)
+    finally:
+        REQUEST_GATE.release()
+
+async def handle_request(data: bytes, writer: asyncio.StreamWriter):
+    t0 = time.perf_counter()
+    status = GEMINI_OK
 
     req_line = data.decode('utf-8', errors='replace').strip()
     # The gemini request line is the URL
@@ -77,9 +197,9 @@ async def handle_gemini(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
     # Simple routing
     try:
         if path.startswith('/list'):
-            # /list?path=/some/dir
+            # /list?path=/some/dir[&cursor=<last name of previous page>]
             target = query.get('path', [None])[0]
-            body = handle_list(target)
+            body = await handle_list(target, query.get('cursor', [None])[0])
             await send_gemini_response(writer, GEMINI_OK, "text/plain; charset=utf-8", body)
 
         elif path.startswith('/nmap'):
@@ -88,23 +208,44 @@ async def handle_gemini(reader: asyncio.StreamReader, writer: asyncio.StreamWrit
             body = await handle_nmap(target)
             await send_gemini_response(writer, GEMINI_OK, "text/plain; charset=utf-8", body)
 
+        elif path.startswith('/query'):
+            body = handle_query(query)
+            await send_gemini_response(writer, GEMINI_OK, "application/json; charset=utf-8", body)
+
+        elif path.startswith('/diff'):
+            body = handle_diff(query)
+            await send_gemini_response(writer, GEMINI_OK, "application/json; charset=utf-8", body)
+
+        elif path.startswith('/cache'):
+            # /cache (stats) or /cache/clear[?target=1.2.3.4]
+            body = handle_cache(path, query)
+            await send_gemini_response(writer, GEMINI_OK, "application/json; charset=utf-8", body)
+
         elif path.startswith('/info'):
             body = json.dumps({
                 'server': 'gemini-mcp-example',
-                'features': ['list', 'nmap']
+                'features': ['list', 'nmap', 'query', 'diff', 'cache', 'metrics']
             }, indent=2)
             await send_gemini_response(writer, GEMINI_OK, "application/json; charset=utf-8", body)
 
+        elif path.startswith('/metrics'):
+            await send_gemini_response(writer, GEMINI_OK, PROMETHEUS_CONTENT_TYPE, METRICS.render())
+
         else:
-            body = 'Unknown endpoint. Available: /list, /nmap, /info\n'
+            status = GEMINI_BAD_REQUEST
+            body = 'Unknown endpoint. Available: /list, /nmap, /query, /diff, /cache, /info, /metrics\n'
             await send_gemini_response(writer, GEMINI_BAD_REQUEST, "text/plain; charset=utf-8", body)
 
+    except ConnectionError:
+        raise  # client gone or too slow to read; nothing more to send
+
     except Exception as e:
+        status = GEMINI_BAD_REQUEST
         err = f"Error handling request: {e}\n"
         await send_gemini_response(writer, GEMINI_BAD_REQUEST, "text/plain; charset=utf-8", err)
 
-    writer.close()
-    await writer.wait_closed()
+    endpoint = path.strip('/').split('/', 1)[0]
+    REQUEST_SECONDS.observe(time.perf_counter() - t0, endpoint if endpoint in ENDPOINTS else 'other', status)
 
 async def send_gemini_response(writer, status_code, meta, body: str):
     # Gemini response: status SP meta CRLF body
@@ -112,39 +253,68 @@ async def send_gemini_response(writer, status_code, meta, body: str):
     writer.write(header)
     if body:
         writer.write(body.encode('utf-8'))
-    await writer.drain()
-
-def handle_list(path: str) -> str:
+    try:
+        await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+    except asyncio.TimeoutError:
+        DROPPED.inc('write_timeout')
+        writer.transport.abort()
+        raise ConnectionAbortedError('client did not read the response in time') from None
+
+async def slow_down(writer, reason: str):
+    # 44: the server is saturated, retry after SLOW_DOWN_SECONDS
+    DROPPED.inc(reason)
+    await send_gemini_response(writer, GEMINI_SLOW_DOWN, str(SLOW_DOWN_SECONDS), '')
+
+async def close_connection(writer):
+    # drain() returns once the TLS layer has taken the data, so most of a large
+    # response is flushed here; a client that stopped reading is dropped after
+    # WRITE_TIMEOUT instead of holding the connection open
+    writer.close()
+    try:
+        await asyncio.wait_for(writer.wait_closed(), WRITE_TIMEOUT)
+    except asyncio.TimeoutError:
+        DROPPED.inc('write_timeout')
+        writer.transport.abort()
+    except (ConnectionError, ssl.SSLError):
+        pass
+
+async def handle_list(path: str, cursor: str = None) -> str:
     if not path:
         return 'No path provided. Use /list?path=/some/dir\n'
     # Prevent directory traversal beyond allowed root(s) if desired.
-    if not os.path.exists(path):
+    # The scan runs in LISTER's thread pool, so a huge directory doesn't stall other clients.
+    try:
+        page = await LISTER.page(path, cursor, LIST_PAGE_SIZE)
+    except FileNotFoundError:
         return f'Path not found: {path}\n'
-    if not os.path.isdir(path):
+    except NotADirectoryError:
         return f'Not a directory: {path}\n'
-
-    entries = []
-    try:
-        with os.scandir(path) as it:
-            for e in it:
-                typ = 'DIR' if e.is_dir() else 'FILE'
-                size = e.stat().st_size if e.is_file() else ''
-                entries.append(f"{typ:4}  {e.name}  {size}")
     except PermissionError:
         return f'Permission denied: {path}\n'
 
+    entries = [f"{'DIR' if is_dir else 'FILE':4}  {name}  {'' if size is None else size}"
+               for name, is_dir, size in page['entries']]
+    if page['next'] is not None:
+        next_query = urllib.parse.urlencode({'path': path, 'cursor': page['next']})
+        entries.append(f"-- {page['total']} entries; next page: /list?{next_query}")
     return "\n".join(entries) + "\n"
 
 def is_target_allowed(target: str) -> bool:
-    # Basic validation: must be an IP (v4 or v6)
+    # Basic validation: must be an IP (v4 or v6) inside the allowlist
+    return ALLOWLIST.allows(target)
+
+NMAP_ARGS = ('-sV', '--reason')
+
+async def exec_nmap(target: str) -> str:
+    # nmap writes XML which is parsed into compact records, stored for /query
+    # and rendered as a short summary (avoids shell=True; raises NmapError)
+    t0 = time.perf_counter()
     try:
-        ip = ip_address(target)
-    except Exception:
-        return False
-    for net in ALLOWED_NETWORKS:
-        if ip in net:
-            return True
-    return False
+        hosts = await exec_nmap_xml(target, NMAP_ARGS, SUBPROCESS_TIMEOUT, NMAP_XML_LIMIT)
+    finally:
+        NMAP_SECONDS.observe(time.perf_counter() - t0)
+    SCAN_STORE.record(target, NMAP_ARGS, hosts)
+    return format_hosts(hosts)
 
 async def handle_nmap(target: str) -> str:
     if not target:
@@ -154,55 +324,156 @@ async def handle_nmap(target: str) -> str:
     if not is_target_allowed(target):
         return f'Target not allowed: {target}\n'
 
-    # Build nmap command carefully (avoid shell=True)
-    cmd = ['nmap', '-sV', '--reason', target]
+    # Identical scans within NMAP_CACHE_TTL share one nmap process
     try:
-        proc = await asyncio.create_subprocess_exec(*cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE)
-
-        try:
-            stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=SUBPROCESS_TIMEOUT)
-        except asyncio.TimeoutError:
-            proc.kill()
-            return f'nmap timed out after {SUBPROCESS_TIMEOUT} seconds\n'
-
-        out = stdout[:NMAP_OUTPUT_LIMIT].decode('utf-8', errors='replace')
-        if len(stdout) > NMAP_OUTPUT_LIMIT:
-            out += '\n---output truncated---\n'
-        if stderr:
-            out += '\n[nmap stderr]\n' + stderr.decode('utf-8', errors='replace')
-        return out
-
-    except FileNotFoundError:
-        return 'nmap not installed on server. Install nmap to enable scan.\n'
-    except Exception as e:
-        return f'Failed to run nmap: {e}\n'
+        return await NMAP_CACHE.get_or_compute((target, NMAP_ARGS), lambda: exec_nmap(target))
+    except NmapError as e:
+        return str(e)
 
-async def main(args):
+def handle_query(query) -> str:
+    # /query?port=443 (hosts with 443 open), /query?service=ssh, optional &state= &target=
+    try:
+        port = int(query['port'][0]) if 'port' in query else None
+    except ValueError:
+        return json.dumps({'error': 'port must be an integer'}) + '\n'
+    results = SCAN_STORE.query(
+        port=port,
+        state=query.get('state', ['open'])[0] or None,
+        service=query.get('service', [None])[0],
+        target=query.get('target', [None])[0])
+    return json.dumps({'results': results}, indent=2) + '\n'
+
+def handle_diff(query) -> str:
+    # /diff?target=1.2.3.4[&since=<scan id>]: changes since the previous scan
+    target = query.get('target', [None])[0]
+    if not target:
+        return json.dumps({'error': 'No target specified. Use /diff?target=1.2.3.4'}) + '\n'
+    since = query.get('since', [None])[0]
+    if since is not None and not since.isdigit():
+        return json.dumps({'error': 'since must be a scan id'}) + '\n'
+    diff = SCAN_STORE.diff(target, int(since) if since else None)
+    return json.dumps(diff, indent=2) + '\n'
+
+def handle_cache(path: str, query) -> str:
+    if path.startswith('/cache/clear'):
+        # /cache/clear or /cache/clear?target=1.2.3.4
+        target = query.get('target', [None])[0]
+        removed = NMAP_CACHE.invalidate(None if target is None else (lambda k: k[0] == target))
+        return json.dumps({'removed': removed}) + '\n'
+    return json.dumps(NMAP_CACHE.stats(), indent=2) + '\n'
+
+def refuse_when_full(sslobj, server_name, sslctx):
+    # Runs on the ClientHello, before the key exchange and certificate signature.
+    # At MAX_CONNECTIONS the client that has been slowest to send its request
+    # line is dropped to make room; if every connection is busy with a request,
+    # the handshake is refused here rather than completed only to answer 44.
+    if CONNECTION_GATE.active < CONNECTION_GATE.limit:
+        return None
+    if AWAITING_REQUEST:
+        idle, _ = AWAITING_REQUEST.popitem(last=False)
+        idle.transport.abort()
+        DROPPED.inc('evicted')
+        return None
+    DROPPED.inc('handshake_refused')
+    return ssl.ALERT_DESCRIPTION_INTERNAL_ERROR
+
+def make_ssl_context(cert: str, key: str) -> ssl.SSLContext:
     sslctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-    sslctx.load_cert_chain(args.cert, args.key)
-
-    server = await asyncio.start_server(handle_gemini, host=args.host, port=args.port, ssl=sslctx)
+    sslctx.load_cert_chain(cert, key)
+    # Resumed TLS 1.3 sessions skip the certificate exchange and signature.
+    # Tickets are encrypted with a key that belongs to this context, so workers
+    # forked after it was created all accept each other's tickets.
+    sslctx.num_tickets = TLS_SESSION_TICKETS
+    if TLS_SESSION_TICKETS:
+        sslctx.options &= ~ssl.OP_NO_TICKET
+    else:
+        sslctx.options |= ssl.OP_NO_TICKET
+    sslctx.sni_callback = refuse_when_full  # called with or without SNI
+    return sslctx
+
+async def main(args, sslctx: ssl.SSLContext, reuse_port: bool = False):
+    server = await asyncio.start_server(handle_gemini, host=args.host, port=args.port, ssl=sslctx,
+                                        reuse_port=reuse_port, limit=REQUEST_LINE_LIMIT,
+                                        ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
 
     addr = server.sockets[0].getsockname()
-    print(f'Gemini MCP server listening on {addr}')
+    print(f'Gemini MCP server listening on {addr} (pid {os.getpid()})')
 
     async with server:
         await server.serve_forever()
 
+def run_workers(args, sslctx: ssl.SSLContext):
+    # Every worker binds its own socket to the port with SO_REUSEPORT and the
+    # kernel spreads connections over them. Caches and metrics are per worker;
+    # the nmap process cap is shared through NMAP_SLOT_DIR.
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit('--workers needs SO_REUSEPORT (Linux, BSD, macOS)')
+    slot_dir = None
+    if not mcp_common.NMAP_SLOT_DIR:
+        slot_dir = mcp_common.NMAP_SLOT_DIR = tempfile.mkdtemp(prefix='gemini-nmap-slots-')
+    children = []
+    for _ in range(args.workers):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                asyncio.run(main(args, sslctx, reuse_port=True))
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                os._exit(code)
+        children.append(pid)
+
+    def stop(signum, frame):
+        for child in children:
+            try:
+                os.kill(child, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for child in children:
+            while True:
+                try:
+                    os.waitpid(child, 0)
+                    break
+                except InterruptedError:
+                    continue
+                except ChildProcessError:
+                    break
+    except KeyboardInterrupt:
+        stop(signal.SIGINT, None)
+        for child in children:
+            try:
+                os.waitpid(child, 0)
+            except ChildProcessError:
+                pass
+    finally:
+        if slot_dir:
+            shutil.rmtree(slot_dir, ignore_errors=True)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Minimal Gemini MCP server (list, nmap)')
     parser.add_argument('--cert', required=True, help='Path to TLS certificate (PEM)')
     parser.add_argument('--key', required=True, help='Path to TLS private key (PEM)')
     parser.add_argument('--host', default='127.0.0.1', help='Host to bind')
     parser.add_argument('--port', type=int, default=1965, help='Port to bind (Gemini default 1965)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Worker processes sharing the port via SO_REUSEPORT')
     args = parser.parse_args()
 
     # Quick check: ensure ALLOWED_TARGETS parsed
     print('Allowed target networks:', ALLOWED_TARGETS)
 
+    # created once, before any fork, so all workers share the ticket key
+    sslctx = make_ssl_context(args.cert, args.key)
     try:
-        asyncio.run(main(args))
+        if args.workers > 1:
+            run_workers(args, sslctx)
+        else:
+            asyncio.run(main(args, sslctx))
     except KeyboardInterrupt:
         print('\nShutting down')